@@ -20,16 +20,24 @@ from __future__ import annotations
 
 from typing import List, Dict, Optional, Literal, Any
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timezone
 import uuid
 import re
 import json
 import logging
+import asyncio
+import functools
+import queue
+import threading
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import requests
 from fastapi import FastAPI, HTTPException, Body, Query, Depends, Request, UploadFile, File, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse, Response
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field
 from jinja2 import Template
 from weasyprint import HTML
@@ -95,8 +103,6 @@ FRONTEND_URL = os.environ.get("HOPSCOTCH_FRONTEND_URL", "https://hopscotchai.us"
 DOCS_DIR = ROOT / "server" / "resources"
 INDEX_DIR = ROOT / "server" / "index"
 INDEX_DIR.mkdir(parents=True, exist_ok=True)
-INDEX_PATH = INDEX_DIR / "faiss.index"
-META_PATH = INDEX_DIR / "chunks.json"  # keep chunk texts
 
 # -------------------------------------------------
 # Optional RAG deps (safe import)
@@ -104,25 +110,33 @@ META_PATH = INDEX_DIR / "chunks.json"  # keep chunk texts
 RAG_AVAILABLE = True
 try:
     import faiss  # type: ignore
-    from sentence_transformers import SentenceTransformer  # type: ignore
     from pypdf import PdfReader  # type: ignore
 except Exception:
     RAG_AVAILABLE = False
     faiss = None
-    SentenceTransformer = None
     PdfReader = None
 
-# Optional pdfminer fallback (used only if installed)
-try:
-    from pdfminer_high_level import extract_text as pdfminer_extract_text  # type: ignore
-except Exception:
-    try:
-        from pdfminer.high_level import extract_text as pdfminer_extract_text  # type: ignore
-    except Exception:
-        pdfminer_extract_text = None
+import numpy as np
+
+import embedders
+import intent_classifier
+import llm_clients
+import moderation_prescreen
+import rag_index
+from rag_index import EMBED_MODEL_NAME, RESOURCE_EXTS
+
+# Query/document embedder: torch (sentence-transformers) or onnx (int8, no torch).
+EMBED_BACKEND = embedders.EMBED_BACKEND
+if not embedders.backend_available(EMBED_BACKEND):
+    RAG_AVAILABLE = False
 
-EMBED_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
 EMBED_DIM = 384  # for the model above
+# Vector index type for rebuilds: auto (by chunk count) | flat | hnsw | ivf.
+RAG_INDEX_TYPE = os.environ.get("RAG_INDEX_TYPE", "auto")
+# Vector storage: none | fp16 | pq (compressed indexes re-rank against exact vectors).
+RAG_INDEX_COMPRESSION = os.environ.get("RAG_INDEX_COMPRESSION", "none")
+# Restrict retrieval to the active step's resources plus the general papers.
+RAG_STEP_FILTER = os.environ.get("RAG_STEP_FILTER", "1") != "0"
 
 logger = logging.getLogger("uvicorn.error")
 
@@ -147,15 +161,22 @@ OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "24h")
 # Set MODERATION_ENABLED=0 to disable, or point MODERATION_MODEL at another guard model.
 MODERATION_ENABLED = os.environ.get("MODERATION_ENABLED", "1") not in ("0", "false", "False", "")
 MODERATION_MODEL = os.environ.get("MODERATION_MODEL", "llama-guard3:1b")
+# Local pre-screen (moderation_prescreen.py) deciding which messages need the
+# guard model: "on" skips it for clearly benign messages, "audit" still sends
+# every message to it and counts disagreements, "off" sends everything.
+MODERATION_PRESCREEN = os.environ.get("MODERATION_PRESCREEN", "on").lower()
 
 import time as _time_mod
 _SERVER_START_TIME = _time_mod.time()
 
 # runtime globals for RAG
 _embedder = None
-_faiss_index = None
-_chunks: List[Dict[str, Any]] = []  # [{"id": int, "text": str, "source": str}]
-_raw_docs_cache: Optional[List[Dict[str, str]]] = None  # for keyword fallback
+# The published index snapshot (FAISS index + chunks + manifest). It is only
+# ever replaced as a whole; read it into a local once per query so a rebuild
+# finishing mid-request can't pair the new index with the old chunk list.
+_snapshot: Optional[rag_index.Snapshot] = None
+# BM25 over freshly chunked docs, only for when no snapshot exists at all
+_keyword_fallback_index: Optional[tuple] = None  # (chunks, rag_index.BM25Index)
 
 # runtime global for path config
 _paths_config: Dict[str, Any] = {}
@@ -382,216 +403,719 @@ def _get_chat(sess: SessionData) -> List[ChatTurn]:
 # ============================================================
 # RAG (with pdfminer + keyword fallback)
 # ============================================================
-def _read_txt(path: Path) -> str:
-    return path.read_text(encoding="utf-8", errors="ignore")
+def _load_all_docs() -> List[Dict[str, str]]:
+    return rag_index.load_docs(DOCS_DIR)
+
+
+class _LRUCache:
+    """Small thread-safe LRU map with hit/miss counters (shown in /admin/health)."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = max(0, maxsize)
+        self._data: "OrderedDict[Any, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value) -> None:
+        if not self.maxsize:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
 
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
 
-def _read_md(path: Path) -> str:
-    return path.read_text(encoding="utf-8", errors="ignore")
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits,
+                "misses": self.misses, "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0}
 
 
-def _read_pdf(path: Path) -> str:
-    txt = ""
-    # Try pypdf first
-    if PdfReader is not None:
-        try:
-            reader = PdfReader(str(path))
-            txt = "\n".join((page.extract_text() or "") for page in reader.pages)
-        except Exception:
-            txt = ""
-    # Fallback to pdfminer if installed
-    if (not txt or not txt.strip()) and pdfminer_extract_text is not None:
-        try:
-            txt = pdfminer_extract_text(str(path)) or ""
-        except Exception:
-            txt = ""
-    return txt
+# Query text -> embedding. Students in one class paste near-identical questions
+# minutes apart; re-encoding each one costs a CPU forward pass per message.
+EMBED_CACHE_SIZE = int(os.environ.get("EMBED_CACHE_SIZE", "2048"))
+_embed_cache = _LRUCache(EMBED_CACHE_SIZE)
+# (model, backend) the cached vectors came from; part of every cache key.
+_embed_cache_key: Optional[tuple] = None
 
 
-def _load_all_docs() -> List[Dict[str, str]]:
-    docs: List[Dict[str, str]] = []
-    if not DOCS_DIR.exists():
-        return docs
-    for p in sorted(DOCS_DIR.glob("**/*")):
-        ext = p.suffix.lower()
-        try:
-            if ext == ".txt":
-                docs.append({"source": p.name, "text": _read_txt(p)})
-            elif ext in (".md", ".markdown"):
-                docs.append({"source": p.name, "text": _read_md(p)})
-            elif ext == ".pdf":
-                docs.append({"source": p.name, "text": _read_pdf(p)})
-        except Exception:
-            continue
-    return docs
+# (normalized query, k, snapshot version, step) -> passages. The version in the key
+# retires every entry the moment a new snapshot is swapped in; the swap also
+# clears the cache so stale entries don't sit there taking up room.
+RETRIEVAL_CACHE_SIZE = int(os.environ.get("RETRIEVAL_CACHE_SIZE", "1024"))
+_retrieval_cache = _LRUCache(RETRIEVAL_CACHE_SIZE)
 
 
-def _chunk(text: str, max_chars: int = 2400, overlap: int = 400) -> List[str]:
-    text = re.sub(r"\s+", " ", text).strip()
-    if not text:
-        return []
-    step = max(1, max_chars - overlap)
-    return [text[i: i + max_chars] for i in range(0, len(text), step)]
+def _normalize_query(query: str) -> str:
+    """Case/whitespace/trailing-punctuation-insensitive cache key text."""
+    q = unicodedata.normalize("NFKC", query or "").casefold()
+    return " ".join(q.split()).rstrip("?？!！.。 ")
 
 
 def _ensure_embedder():
-    global _embedder
+    global _embedder, _embed_cache_key
     if not RAG_AVAILABLE:
         return
     if _embedder is None:
-        _embedder = SentenceTransformer(EMBED_MODEL_NAME)
+        _embedder = embedders.load_embedder(EMBED_MODEL_NAME, EMBED_BACKEND)
+    key = (EMBED_MODEL_NAME, embedders.describe(_embedder))
+    if _embed_cache_key != key:
+        # Vectors from another model or backend don't match this embedder's.
+        _embed_cache.clear()
+        _sentence_cache.clear()
+        _embed_cache_key = key
+
+
+def _embed_query(query: str):
+    """(1, dim) normalized query vector, served from the LRU cache when possible.
+    Encoded on the batcher thread unless batching is off."""
+    if RAG_BATCH_WINDOW_MS > 0:
+        return _retrieval_batcher.submit(None, query, 0, None).result(timeout=RAG_BATCH_TIMEOUT)[2]
+    return _encode_queries([query])
+
+
+async def _embed_query_async(query: str):
+    """_embed_query() without holding a thread; None if it can't be computed."""
+    if not RAG_AVAILABLE or not (query or "").strip():
+        return None
+    try:
+        if RAG_BATCH_WINDOW_MS > 0:
+            # Shielded: a timeout or a client disconnect must not cancel the
+            # batcher's future; the vector still lands in the cache.
+            fut = asyncio.shield(asyncio.wrap_future(_retrieval_batcher.submit(None, query, 0, None)))
+            return (await asyncio.wait_for(fut, RAG_BATCH_TIMEOUT))[2]
+        return await _run_cpu(_encode_queries, [query])
+    except Exception as e:
+        logger.warning("Query embedding failed: %s", e)
+        return None
+
+
+def _encode_queries(queries: List[str]):
+    """(n, dim) normalized query vectors. Cache misses are encoded together in
+    one batch; each row is cached as its own (1, dim) vector. Runs on the
+    batcher thread (see _RetrievalBatcher)."""
+    _ensure_embedder()
+    keys = [(_embed_cache_key, _normalize_query(q)) for q in queries]
+    rows: Dict[Any, Any] = {}
+    for key in keys:
+        if key not in rows:
+            rows[key] = _embed_cache.get(key)
+    missing = {key: q for key, q in zip(keys, queries) if rows[key] is None}
+    if missing:
+        vecs = _embedder.encode(list(missing.values()), convert_to_numpy=True, normalize_embeddings=True)
+        for key, v in zip(missing, vecs):
+            qv = np.asarray(v, dtype="float32").reshape(1, -1)
+            qv.setflags(write=False)  # shared between requests
+            _embed_cache.put(key, qv)
+            rows[key] = qv
+    return np.vstack([rows[key] for key in keys])
+
+
+# ---- Micro-batched retrieval ----
+# Chat requests arrive on many threadpool threads at once. Instead of each one
+# running its own single-query forward pass (every one of them spinning up
+# torch's intra-op threads on the same cores), queries are queued, gathered
+# for up to RAG_BATCH_WINDOW_MS, embedded in one encode() call and searched
+# with one index.search() per snapshot/step. The batcher thread is the only
+# one that runs the embedder for chat traffic: the gates' query vector and
+# passage compression's sentence vectors are computed there too. Index
+# builds and the pre-screen's exemplars (embedded once at startup) use the
+# embedder directly. 0 disables batching; callers then encode on their own
+# threads.
+RAG_BATCH_WINDOW_MS = float(os.environ.get("RAG_BATCH_WINDOW_MS", "3"))
+RAG_BATCH_MAX = int(os.environ.get("RAG_BATCH_MAX", "32"))
+RAG_BATCH_TIMEOUT = float(os.environ.get("RAG_BATCH_TIMEOUT", "10"))
+
+
+class _RetrievalBatcher:
+    """One background thread that embeds and searches queued queries in
+    batches. submit() returns a Future resolving to that query's
+    (scores, ids, query vector); embed_sentences() one resolving to the
+    sentences' vectors."""
+
+    def __init__(self, window_ms: float, max_batch: int):
+        self.window = max(0.0, window_ms) / 1000.0
+        self.max_batch = max(1, max_batch)
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.queries = 0
+        self.sentence_requests = 0
+        self.largest = 0
+
+    def submit(self, snap, query: str, k: int, step: Optional[int]) -> Future:
+        """With snap=None only the query vector is computed (scores and ids
+        are None)."""
+        return self._put(("query", snap, query, k, step))
+
+    def embed_sentences(self, sentences: List[str]) -> Future:
+        return self._put(("sentences", sentences))
+
+    def _put(self, item: tuple) -> Future:
+        fut: Future = Future()
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="rag-batcher", daemon=True)
+                self._thread.start()
+        self._queue.put(item + (fut,))
+        return fut
+
+    @staticmethod
+    def _take(batch: list, item: tuple) -> None:
+        # Marks the future running, so a caller giving up can no longer cancel
+        # it under us; items cancelled while still queued are dropped.
+        if item[-1].set_running_or_notify_cancel():
+            batch.append(item)
+
+    def _collect(self) -> list:
+        batch: list = []
+        while not batch:
+            self._take(batch, self._queue.get())
+        deadline = _time_mod.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            wait = deadline - _time_mod.monotonic()
+            try:
+                item = self._queue.get(timeout=wait) if wait > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            self._take(batch, item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                queries = [item for item in batch if item[0] == "query"]
+                sentences = [item for item in batch if item[0] == "sentences"]
+                self.batches += 1
+                self.queries += len(queries)
+                self.sentence_requests += len(sentences)
+                self.largest = max(self.largest, len(batch))
+                if sentences:
+                    self._encode_sentence_batch(sentences)
+                if queries:
+                    self._search(queries)
+            except Exception as e:
+                # This is the only thread embedding chat queries: fail the
+                # batch, not the thread.
+                logger.exception("Retrieval batch failed: %s", e)
+                for item in batch:
+                    if not item[-1].done():
+                        item[-1].set_exception(e)
+
+    def _encode_sentence_batch(self, batch: list):
+        try:
+            vecs = _encode_sentences([s for item in batch for s in item[1]])
+        except Exception as e:
+            for item in batch:
+                item[2].set_exception(e)
+            return
+        at = 0
+        for _, sentences, fut in batch:
+            fut.set_result(vecs[at: at + len(sentences)])
+            at += len(sentences)
+
+    def _search(self, batch: list):
+        try:
+            qvecs = _encode_queries([item[2] for item in batch])
+        except Exception as e:
+            for item in batch:
+                item[5].set_exception(e)
+            return
+        groups: Dict[Any, List[int]] = {}
+        for i, (_, snap, _, _, step, fut) in enumerate(batch):
+            if snap is None:
+                fut.set_result((None, None, qvecs[i: i + 1]))
+            else:
+                groups.setdefault((id(snap), step), []).append(i)
+        for rows in groups.values():
+            snap, step = batch[rows[0]][1], batch[rows[0]][4]
+            try:
+                D, I = snap.search(qvecs[rows], max(batch[i][3] for i in rows), step=step)
+            except Exception as e:
+                for i in rows:
+                    batch[i][5].set_exception(e)
+                continue
+            for j, i in enumerate(rows):
+                k = batch[i][3]
+                batch[i][5].set_result((D[j: j + 1, :k], I[j: j + 1, :k], qvecs[i: i + 1]))
 
+    def stats(self) -> Dict[str, Any]:
+        return {"window_ms": self.window * 1000, "batches": self.batches, "queries": self.queries,
+                "sentence_requests": self.sentence_requests,
+                "avg_batch": round((self.queries + self.sentence_requests) / self.batches, 2)
+                if self.batches else 0.0,
+                "largest_batch": self.largest, "queued": self._queue.qsize()}
 
-def _build_index(force: bool = False):
-    """Build or load the FAISS index; if RAG unavailable, no-op.
-    With force=True, always rebuild from the resources folder (used by the
-    admin 'rebuild knowledge base' action after files change)."""
-    global _faiss_index, _chunks, _raw_docs_cache
+
+_retrieval_batcher = _RetrievalBatcher(RAG_BATCH_WINDOW_MS, RAG_BATCH_MAX)
+
+
+def _indexed_source_counts() -> Dict[str, int]:
+    """Chunks per source in the published snapshot (reads only the id column)."""
+    snap = _snapshot
+    return snap.chunks.source_counts() if snap is not None else {}
+
+
+def _build_index(force: bool = False, full: bool = False, progress=None):
+    """Load the published index snapshot, building one if none exists yet; if
+    RAG unavailable, no-op. With force=True, build a new snapshot from the
+    resources folder and swap it in (used by the background rebuild job).
+    Only added/changed files are re-embedded unless full=True."""
+    global _snapshot
     if not RAG_AVAILABLE:
-        _faiss_index = None
-        _chunks = []
+        # No vector search, but a built snapshot still serves BM25 keyword retrieval.
+        try:
+            _snapshot = rag_index.load_snapshot(INDEX_DIR)
+        except Exception as e:
+            logger.warning("Failed to load index snapshot for keyword retrieval: %s", e)
+            _snapshot = None
         return {"rag_available": False, "sources": 0, "chunks": 0}
 
     _ensure_embedder()
 
-    if not force and INDEX_PATH.exists() and META_PATH.exists():
+    if not force:
         try:
-            _faiss_index = faiss.read_index(str(INDEX_PATH))
-            _chunks = json.loads(META_PATH.read_text(encoding="utf-8"))
-            return {"rag_available": True,
-                    "sources": len({c.get("source") for c in _chunks}),
-                    "chunks": len(_chunks)}
+            snap = rag_index.load_snapshot(INDEX_DIR)
+            if snap is not None:
+                _snapshot = snap
+                return {"rag_available": True, "version": snap.version,
+                        "sources": len(snap.chunks.source_counts()),
+                        "chunks": len(snap.chunks)}
         except Exception as e:
             logger.warning("Failed to load existing index; rebuilding. %s", e)
 
-    # Fresh build — re-read every doc so newly added/removed files are reflected.
-    _raw_docs_cache = None
-    docs = _load_all_docs()
-    chunks: List[Dict[str, Any]] = []
-    for d in docs:
-        for piece in _chunk(d["text"]):
-            chunks.append({"text": piece, "source": d["source"]})
+    snap, stats = rag_index.build_snapshot(
+        DOCS_DIR, INDEX_DIR, _embedder, model_name=EMBED_MODEL_NAME,
+        full=full, progress=progress, index_type=RAG_INDEX_TYPE,
+        compression=RAG_INDEX_COMPRESSION,
+    )
+    _snapshot = snap  # single reference swap — readers see old or new, never a mix
+    _retrieval_cache.clear()
+    return stats
 
-    if not chunks:
-        _faiss_index = faiss.IndexFlatIP(EMBED_DIM) if RAG_AVAILABLE else None
-        _chunks = []
-        return {"rag_available": True, "sources": 0, "chunks": 0}
 
-    texts = [c["text"] for c in chunks]
-    _ensure_embedder()
-    vecs = _embedder.encode(
-        texts, convert_to_numpy=True, normalize_embeddings=True
-    )
+# Other uvicorn workers (and create_index.py) can publish a new snapshot; each
+# worker notices via the CURRENT pointer and loads it off the request path.
+_SNAPSHOT_CHECK_SECONDS = 5.0
+_snapshot_checked_at = 0.0
+_snapshot_reload_lock = threading.Lock()
+
+
+def _refresh_snapshot():
+    """Swap in a snapshot published elsewhere. Reads the CURRENT pointer at most
+    every few seconds; the load runs on a background thread, so the calling
+    request keeps using the snapshot it already has."""
+    global _snapshot_checked_at
+    now = _time_mod.time()
+    if not RAG_AVAILABLE or now - _snapshot_checked_at < _SNAPSHOT_CHECK_SECONDS:
+        return
+    _snapshot_checked_at = now
+    version = rag_index.read_current_version(INDEX_DIR)
+    cur = _snapshot
+    if version is None or (cur is not None and cur.version == version):
+        return
+    if not _snapshot_reload_lock.acquire(blocking=False):
+        return
+
+    def _load():
+        global _snapshot
+        try:
+            snap = rag_index.load_snapshot(INDEX_DIR)
+            if snap is not None:
+                _snapshot = snap
+                _retrieval_cache.clear()
+                logger.info("Loaded knowledge-base snapshot %s (%d chunks)", snap.version, len(snap.chunks))
+        except Exception as e:
+            logger.warning("Failed to load published snapshot %s: %s", version, e)
+        finally:
+            _snapshot_reload_lock.release()
+
+    threading.Thread(target=_load, daemon=True).start()
+
+
+# ---- Background rebuild jobs ----
+
+# job_id -> {"id", "status": queued|running|done|failed, "stage", "done", "total",
+#            "progress": 0..1, "full", "started_at", "finished_at", "stats", "error"}
+# The worker running a job keeps it here and mirrors it to
+# server/index/jobs/<id>.json, so any uvicorn worker can answer a poll and
+# see that a rebuild is already under way.
+_rebuild_jobs: Dict[str, Dict[str, Any]] = {}
+_rebuild_jobs_lock = threading.Lock()
+_REBUILD_JOBS_DIR = INDEX_DIR / "jobs"
+_REBUILD_JOBS_KEPT = 20
+# Cross-process guard: the worker that creates a job holds the index dir's
+# build lock until the job finishes, so neither another worker nor
+# create_index.py builds into INDEX_DIR at the same time.
+_rebuild_lock = rag_index.BuildLock(INDEX_DIR)
+# How long a worker that lost the lock race waits for the winner's job file.
+_REBUILD_LOCK_WAIT = 2.0
+# Progress is written to disk at most every _REBUILD_JOB_SAVE_INTERVAL seconds,
+# and at least every _REBUILD_JOB_HEARTBEAT while a job runs. A queued/running
+# job whose file is older than _REBUILD_JOB_STALE_SECONDS belongs to a worker
+# that died mid-build.
+_REBUILD_JOB_SAVE_INTERVAL = 1.0
+_REBUILD_JOB_HEARTBEAT = 30.0
+_REBUILD_JOB_STALE_SECONDS = 120
+# Share of the overall progress bar each build stage covers.
+_REBUILD_STAGE_SPAN = {"extract": (0.0, 0.3), "embed": (0.3, 0.9), "write": (0.9, 1.0)}
+
+
+def _utcnow_iso() -> str:
+    return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+def _save_rebuild_job(job: Dict[str, Any]) -> None:
+    try:
+        _REBUILD_JOBS_DIR.mkdir(parents=True, exist_ok=True)
+        path = _REBUILD_JOBS_DIR / f"{job['id']}.json"
+        tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+        tmp.write_text(json.dumps(job), encoding="utf-8")
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.warning("Could not save rebuild job %s: %s", job.get("id"), e)
+
+
+def _load_rebuild_job(path: Path) -> Optional[Dict[str, Any]]:
+    try:
+        job = json.loads(path.read_text(encoding="utf-8"))
+        age = _time_mod.time() - path.stat().st_mtime
+    except (OSError, ValueError):
+        return None
+    if job.get("status") in ("queued", "running") and age > _REBUILD_JOB_STALE_SECONDS:
+        job.update(status="failed", error="The worker running this rebuild stopped responding")
+    return job
+
+
+def _stored_rebuild_jobs() -> List[Dict[str, Any]]:
+    """Jobs on disk (from every worker), oldest first. Only the newest
+    _REBUILD_JOBS_KEPT files are kept."""
+    if not _REBUILD_JOBS_DIR.is_dir():
+        return []
+    paths = []
+    for p in _REBUILD_JOBS_DIR.glob("*.json"):
+        try:
+            paths.append((p.stat().st_mtime, p))
+        except OSError:
+            pass
+    paths = [p for _, p in sorted(paths)]
+    for old in paths[:-_REBUILD_JOBS_KEPT]:
+        try:
+            old.unlink()
+        except OSError:
+            pass
+    return [job for job in map(_load_rebuild_job, paths[-_REBUILD_JOBS_KEPT:]) if job]
+
+
+def _start_rebuild_job(full: bool = False):
+    """Queue a rebuild unless one is already pending/running in any worker.
+    Returns (job, created)."""
+    with _rebuild_jobs_lock:
+        active = _active_rebuild_job_locked()
+        if active:
+            return active, False
+        if not _rebuild_lock.acquire():
+            # Another worker just took the lock (its job file follows shortly),
+            # or create_index.py is building.
+            deadline = _time_mod.monotonic() + _REBUILD_LOCK_WAIT
+            while _time_mod.monotonic() < deadline:
+                _time_mod.sleep(0.05)
+                active = _active_rebuild_job_locked()
+                if active:
+                    return active, False
+            raise HTTPException(status_code=409, detail="A knowledge-base rebuild is already in progress")
+        job = {
+            "id": uuid.uuid4().hex[:12],
+            "status": "queued",
+            "full": full,
+            "stage": "queued",
+            "done": 0,
+            "total": 0,
+            "progress": 0.0,
+            "queued_at": _utcnow_iso(),
+            "started_at": None,
+            "finished_at": None,
+            "stats": None,
+            "error": None,
+        }
+        _rebuild_jobs[job["id"]] = job
+        for old_id in list(_rebuild_jobs)[:-_REBUILD_JOBS_KEPT]:
+            del _rebuild_jobs[old_id]
+        _save_rebuild_job(job)
+        return dict(job), True
+
+
+def _get_rebuild_job(job_id: str) -> Optional[Dict[str, Any]]:
+    with _rebuild_jobs_lock:
+        job = _rebuild_jobs.get(job_id)
+        if job:
+            return dict(job)
+    if not re.fullmatch(r"[0-9a-f]{12}", job_id or ""):
+        return None
+    return _load_rebuild_job(_REBUILD_JOBS_DIR / f"{job_id}.json")
+
+
+def _active_rebuild_job_locked() -> Optional[Dict[str, Any]]:
+    for job in _rebuild_jobs.values():
+        if job["status"] in ("queued", "running"):
+            return dict(job)
+    for job in _stored_rebuild_jobs():
+        if job["status"] in ("queued", "running"):
+            return job
+    return None
+
+
+def _active_rebuild_job() -> Optional[Dict[str, Any]]:
+    with _rebuild_jobs_lock:
+        return _active_rebuild_job_locked()
 
-    index = faiss.IndexFlatIP(vecs.shape[1])
-    index.add(vecs)
-    _faiss_index = index
-
-    faiss.write_index(_faiss_index, str(INDEX_PATH))
-    META_PATH.write_text(
-        json.dumps(
-            [{"id": i, "text": c["text"], "source": c["source"]} for i, c in enumerate(chunks)],
-            ensure_ascii=False,
-        ),
-        encoding="utf-8",
-    )
-    _chunks = [{"id": i, **c} for i, c in enumerate(chunks)]
-    return {"rag_available": True,
-            "sources": len({c["source"] for c in chunks}),
-            "chunks": len(chunks)}
 
+def _run_rebuild_job(job_id: str):
+    """Build a new snapshot in the background and publish it. Chat traffic keeps
+    using the previous snapshot until the swap at the very end."""
+    job = _rebuild_jobs[job_id]
+    last_save = [0.0]
 
-# Extensions the knowledge base can ingest.
-RESOURCE_EXTS = (".pdf", ".txt", ".md", ".markdown")
+    def _progress(stage: str, done: int, total: int):
+        lo, hi = _REBUILD_STAGE_SPAN.get(stage, (0.0, 1.0))
+        frac = (done / total) if total else 1.0
+        job.update(stage=stage, done=done, total=total,
+                   progress=round(lo + (hi - lo) * frac, 3))
+        now = _time_mod.monotonic()
+        if now - last_save[0] >= _REBUILD_JOB_SAVE_INTERVAL:
+            last_save[0] = now
+            _save_rebuild_job(job)
+
+    job.update(status="running", started_at=_utcnow_iso())
+    _save_rebuild_job(job)
+    finished = threading.Event()
+
+    def _heartbeat():
+        while not finished.wait(_REBUILD_JOB_HEARTBEAT):
+            _save_rebuild_job(job)
+
+    heartbeat = threading.Thread(target=_heartbeat, name=f"rebuild-{job_id}-heartbeat", daemon=True)
+    heartbeat.start()
+    try:
+        stats = _build_index(force=True, full=job["full"], progress=_progress)
+        job.update(status="done", stage="done", progress=1.0, stats=stats)
+    except Exception as e:
+        logger.exception("Knowledge-base rebuild %s failed: %s", job_id, e)
+        job.update(status="failed", error=str(e)[:500])
+    finally:
+        finished.set()
+        heartbeat.join()  # its last write must not land after the final one
+        job["finished_at"] = _utcnow_iso()
+        _save_rebuild_job(job)
+        with _rebuild_jobs_lock:
+            _rebuild_lock.release()
 
 
 def _list_resource_files() -> List[Dict[str, Any]]:
     """List files in the resources folder with index coverage info."""
-    indexed_counts: Dict[str, int] = {}
-    for c in _chunks:
-        s = c.get("source", "")
-        indexed_counts[s] = indexed_counts.get(s, 0) + 1
+    indexed_counts = _indexed_source_counts()
+    manifest_files = (_snapshot.manifest.get("files", {}) if _snapshot else {})
     files: List[Dict[str, Any]] = []
-    if DOCS_DIR.exists():
-        for p in sorted(DOCS_DIR.glob("*")):
-            if not p.is_file() or p.suffix.lower() not in RESOURCE_EXTS:
-                continue
-            st = p.stat()
-            files.append({
-                "name": p.name,
-                "ext": p.suffix.lower().lstrip("."),
-                "size": st.st_size,
-                "modified": datetime.utcfromtimestamp(st.st_mtime).isoformat() + "Z",
-                "chunks": indexed_counts.get(p.name, 0),
-                "indexed": p.name in indexed_counts,
-            })
+    for p in rag_index.list_resource_files(DOCS_DIR):
+        # Same key as the index: subfolder files are listed as "sub/name.pdf".
+        name = rag_index.resource_name(DOCS_DIR, p)
+        entry = manifest_files.get(name, {})
+        st = p.stat()
+        files.append({
+            "name": name,
+            "ext": p.suffix.lower().lstrip("."),
+            "size": st.st_size,
+            "modified": datetime.utcfromtimestamp(st.st_mtime).isoformat() + "Z",
+            "chunks": indexed_counts.get(name, 0),
+            "indexed": name in indexed_counts,
+            "extract_seconds": entry.get("extract_seconds"),
+            "duplicate_of": entry.get("duplicate_of"),
+            "collapsed_chunks": entry.get("collapsed", 0),
+            "collapsed_into": entry.get("collapsed_into", []),
+            "repeated_chunks": entry.get("collapsed_within", 0),
+        })
     return files
 
 
 def _index_stale() -> bool:
     """True if the resources folder no longer matches the built index."""
-    on_disk = {p.name for p in DOCS_DIR.glob("*")
-               if p.is_file() and p.suffix.lower() in RESOURCE_EXTS} if DOCS_DIR.exists() else set()
-    in_index = {c.get("source", "") for c in _chunks}
+    on_disk = {rag_index.resource_name(DOCS_DIR, p) for p in rag_index.list_resource_files(DOCS_DIR)}
+    in_index = set(_indexed_source_counts())
     return on_disk != in_index
 
 
-def _keyword_fallback(query: str, k: int = 5) -> List[Dict[str, Any]]:
-    """Very simple keyword scoring fallback when FAISS/chunks unavailable."""
-    global _raw_docs_cache
-    if _raw_docs_cache is None:
-        _raw_docs_cache = _load_all_docs()
-    q = (query or "").strip().lower()
-    if not q:
-        return []
-    scored: List[Dict[str, Any]] = []
-    for d in _raw_docs_cache:
-        text = d.get("text") or ""
-        if not text:
-            continue
-        tl = text.lower()
-        occ = tl.count(q)
-        score = occ + (1.0 if q in tl else 0.0)
-        if score > 0:
-            scored.append(
-                {
-                    "text": text[:2000],
-                    "source": d["source"],
-                    "score": float(score),
-                }
-            )
-    scored.sort(key=lambda x: x["score"], reverse=True)
-    return scored[:k]
+def _keyword_fallback(query: str, k: int = 5, step: Optional[int] = None) -> List[Dict[str, Any]]:
+    """BM25 keyword retrieval over the same chunks the FAISS index uses; the
+    fallback when the embedder/FAISS is unavailable or vector search fails."""
+    global _keyword_fallback_index
+    snap = _snapshot
+    allowed = None
+    if snap is not None and snap.bm25 is not None:
+        chunks, bm25 = snap.chunks, snap.bm25
+        allowed = snap.step_mask(_retrieval_step(step))
+    else:
+        if _keyword_fallback_index is None:
+            docs_chunks = [{"text": piece, "source": d["source"]}
+                           for d in _load_all_docs() for piece in rag_index.chunk_text(d["text"])]
+            _keyword_fallback_index = (
+                docs_chunks, rag_index.BM25Index.build(c["text"] for c in docs_chunks))
+        chunks, bm25 = _keyword_fallback_index
+    if snap is not None and chunks is snap.chunks:
+        hits = bm25.search(query, k * max(1, rag_index.MMR_FETCH), allowed)
+        return _select_passages(snap, [i for i, _ in hits], [s for _, s in hits], k)
+    out: List[Dict[str, Any]] = []
+    for idx, score in bm25.search(query, k, allowed):
+        ch = chunks[idx]
+        out.append({"text": ch["text"], "source": ch["source"],
+                    "sources": ch.get("sources", [ch["source"]]), "score": score})
+    return out
 
 
-def _retrieve(query: str, k: int = 5) -> List[Dict[str, Any]]:
-    """Try vector search; if nothing, use keyword fallback."""
-    if RAG_AVAILABLE and _faiss_index is not None and _chunks:
-        _ensure_embedder()
+def _retrieval_step(step: Optional[int]) -> Optional[int]:
+    """The step to filter retrieval by, or None to search the whole corpus."""
+    if not RAG_STEP_FILTER or not step:
+        return None
+    return int(step) if 1 <= int(step) <= 9 else None
+
+
+def _retrieve(query: str, k: int = 5, step: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Try vector search (cached per index snapshot); if nothing, use keyword fallback.
+    With step, only that step's resources and the general material are searched."""
+    _refresh_snapshot()
+    snap = _snapshot
+    step = _retrieval_step(step)
+    if RAG_AVAILABLE and snap is not None and len(snap.chunks):
+        cache_key = (_normalize_query(query), k, snap.version, step)
+        cached = _retrieval_cache.get(cache_key)
+        if cached is not None:
+            return [dict(p) for p in cached]
         try:
-            qv = _embedder.encode(
-                [query], convert_to_numpy=True, normalize_embeddings=True
-            )
-            D, I = _faiss_index.search(qv, k)
-            out = []
-            for idx, score in zip(I[0], D[0]):
-                idx = int(idx)
-                if 0 <= idx < len(_chunks):
-                    ch = _chunks[idx]
-                    out.append(
-                        {
-                            "text": ch["text"],
-                            "source": ch["source"],
-                            "score": float(score),
-                        }
-                    )
+            fetch = k * max(1, rag_index.MMR_FETCH)
+            if RAG_BATCH_WINDOW_MS > 0:
+                D, I, qvec = _retrieval_batcher.submit(snap, query, fetch, step).result(timeout=RAG_BATCH_TIMEOUT)
+            else:
+                qvec = _encode_queries([query])
+                D, I = snap.search(qvec, fetch, step=step)
+            out = _select_passages(snap, I[0], D[0], k, qvec)
             if out:
-                return out
+                _retrieval_cache.put(cache_key, out)
+                return [dict(p) for p in out]
         except Exception as e:
             logger.warning(
                 "Vector retrieval failed; falling back to keywords. %s", e
             )
-    return _keyword_fallback(query, k=k)
+    return _keyword_fallback(query, k=k, step=step)
+
+
+def _select_passages(snap, ids, scores, k: int, qvec=None) -> List[Dict[str, Any]]:
+    """The prompt's passages from the ranked candidates: MMR over the stored
+    vectors (when the snapshot has them), then adjacent chunks of the same
+    file merged, within the budget of k passages."""
+    order = None
+    valid = [j for j, i in enumerate(ids) if 0 <= int(i) < len(snap.chunks)]
+    if qvec is not None and snap.vectors is not None and len(valid) > 1:
+        rows = np.asarray([int(ids[j]) for j in valid])
+        order = [valid[j] for j in rag_index.mmr_order(qvec, snap.vectors[rows])]
+    passages = rag_index.select_passages(snap.chunks, ids, scores, k, _passage_tokens(), order)
+    merged = sum(len(p["rows"]) - 1 for p in passages)
+    if merged or order is not None:
+        logger.debug("Selected %d passages from %d candidates (%d adjacent chunks merged)",
+                     len(passages), len(valid), merged)
+    return passages
+
+
+def _passage_tokens() -> int:
+    """Token budget per passage in the prompt: the size the published snapshot
+    was chunked to, so retrieved chunks are sent whole."""
+    snap = _snapshot
+    params = (snap.manifest or {}).get("params", {}) if snap is not None else {}
+    return int(params.get("chunk_tokens") or rag_index.CHUNK_TOKENS)
+
+
+# ---- Extractive passage compression ----
+# Each passage is cut down to its sentences closest to the question (cosine
+# against the query vector), at most RAG_COMPRESS_TOKENS per chunk, kept in
+# their original order. 0 sends passages whole. Sentence vectors come from a
+# fixed corpus, so they are cached like query vectors.
+RAG_COMPRESS_TOKENS = int(os.environ.get("RAG_COMPRESS_TOKENS", "120"))
+SENTENCE_CACHE_SIZE = int(os.environ.get("SENTENCE_CACHE_SIZE", "8192"))
+_sentence_cache = _LRUCache(SENTENCE_CACHE_SIZE)
+
+
+def _embed_sentences(sentences: List[str]):
+    """(n, dim) normalized sentence vectors, encoded on the batcher thread
+    unless batching is off."""
+    if RAG_BATCH_WINDOW_MS > 0:
+        return _retrieval_batcher.embed_sentences(sentences).result(timeout=RAG_BATCH_TIMEOUT)
+    return _encode_sentences(sentences)
+
+
+def _encode_sentences(sentences: List[str]):
+    """(n, dim) normalized sentence vectors; cache misses encoded in one batch."""
+    _ensure_embedder()
+    keys = [(_embed_cache_key, s) for s in sentences]
+    rows = {key: _sentence_cache.get(key) for key in keys}
+    missing = [key for key, v in rows.items() if v is None]
+    if missing:
+        vecs = _embedder.encode([key[1] for key in missing], convert_to_numpy=True,
+                                normalize_embeddings=True)
+        for key, v in zip(missing, vecs):
+            v = np.asarray(v, dtype="float32")
+            v.setflags(write=False)
+            _sentence_cache.put(key, v)
+            rows[key] = v
+    return np.vstack([rows[key] for key in keys])
+
+
+def _compress_passages(query: str, passages: List[Dict[str, Any]]) -> List[str]:
+    """Prompt text of each passage: its best sentences for query within the
+    compression budget, or the chunk truncated to the chunk size when
+    compression is off or the embedder is unavailable."""
+    chunk_budget = _passage_tokens()
+    texts = [rag_index.truncate_tokens(p["text"], chunk_budget * len(p.get("rows") or [0]))
+             for p in passages]
+    if RAG_COMPRESS_TOKENS <= 0 or not RAG_AVAILABLE or not texts:
+        return texts
+    t0 = _time_mod.perf_counter()
+    budgets = [RAG_COMPRESS_TOKENS * len(p.get("rows") or [0]) for p in passages]
+    sentences = [rag_index.split_sentences(t) for t in texts]
+    todo = [i for i, t in enumerate(texts) if rag_index.count_tokens(t) > budgets[i] and sentences[i]]
+    if not todo:
+        return texts
+    try:
+        qvec = _embed_query(query).reshape(-1)
+        flat = [s for i in todo for s in sentences[i]]
+        scores = _embed_sentences(flat) @ qvec
+    except Exception as e:
+        logger.warning("Passage compression skipped: %s", e)
+        return texts
+    before = sum(rag_index.count_tokens(t) for t in texts)
+    at = 0
+    for i in todo:
+        n = len(sentences[i])
+        texts[i] = rag_index.extract_sentences(sentences[i], scores[at: at + n], budgets[i])
+        at += n
+    after = sum(rag_index.count_tokens(t) for t in texts)
+    logger.info("Compressed %d/%d passages: %d -> %d tokens (%.0f%%) in %.1f ms",
+                len(todo), len(texts), before, after, 100.0 * after / max(before, 1),
+                (_time_mod.perf_counter() - t0) * 1000)
+    return texts
 
 
 # ---- GeoIP resolution (ip-api.com, free, no key) ----
@@ -696,10 +1220,18 @@ def _startup():
     _seed_admin()
     _seed_glossary()
     _seed_step_resources()
+    _load_intent_classifier()
+    _load_moderation_prescreen()
     # Pre-warm the LLM so the first chat request doesn't cold-start
     _warm_llm()
 
 
+@app.on_event("shutdown")
+async def _shutdown():
+    llm_clients.close_all()
+    await llm_clients.aclose_all()
+
+
 def _warm_llm():
     """Pre-warm the LLM — works with both vLLM and Ollama backends."""
     if LLM_BACKEND == "vllm":
@@ -708,11 +1240,11 @@ def _warm_llm():
             headers = {"Content-Type": "application/json"}
             if VLLM_API_KEY:
                 headers["Authorization"] = f"Bearer {VLLM_API_KEY}"
-            resp = requests.post(VLLM_URL, json={
+            resp = llm_clients.vllm.post(VLLM_URL, json={
                 "model": VLLM_MODEL,
                 "messages": [{"role": "user", "content": "hi"}],
                 "max_tokens": 1,
-            }, headers=headers, timeout=300)
+            }, headers=headers, timeout=llm_clients.LLM_STREAM_TIMEOUT)
             resp.raise_for_status()
             logger.info("vLLM model %s is warm and ready.", VLLM_MODEL)
         except Exception as e:
@@ -720,13 +1252,13 @@ def _warm_llm():
     else:
         try:
             logger.info("Pre-warming Ollama model %s ...", LLM_MODEL)
-            resp = requests.post(OLLAMA_URL, json={
+            resp = llm_clients.ollama.post(OLLAMA_URL, json={
                 "model": LLM_MODEL,
                 "messages": [{"role": "user", "content": "hi"}],
                 "stream": False,
                 "keep_alive": OLLAMA_KEEP_ALIVE,
                 "options": {"num_predict": 1},
-            }, timeout=300)
+            }, timeout=llm_clients.LLM_STREAM_TIMEOUT)
             resp.raise_for_status()
             logger.info("Ollama model %s is warm and ready.", LLM_MODEL)
         except Exception as e:
@@ -784,6 +1316,11 @@ STEP_NAMES = {
 }
 
 
+def _step_uses_passages(active_step: Optional[int]) -> bool:
+    """Steps 1-3 get no resource snippets: students find their own sources."""
+    return not (active_step and active_step <= 3)
+
+
 def build_ollama_payload(worldview_profile, step_context, user_msg, passages,
                          stream=False, active_step=None, step_llm_guidance=None,
                          chat_history=None, language="en"):
@@ -792,9 +1329,12 @@ def build_ollama_payload(worldview_profile, step_context, user_msg, passages,
     Set stream=True when you want chunked responses, False for normal JSON.
     """
     ctx_blocks = []
-    for i, p in enumerate(passages):
+    if not _step_uses_passages(active_step):
+        passages = []  # dropped below; don't spend sentence embeds compressing them
+    for i, (p, text) in enumerate(zip(passages, _compress_passages(user_msg, passages))):
         ctx_blocks.append(
-            f"[{i+1}] Source: {p['source']}\n{p['text'][:800]}"
+            f"[{i+1}] Source: {', '.join(p.get('sources') or [p['source']])}\n"
+            f"{text}"
         )
     ctx_text = "\n\n".join(ctx_blocks) if ctx_blocks else "No matching passages."
 
@@ -1005,7 +1545,7 @@ def build_ollama_payload(worldview_profile, step_context, user_msg, passages,
             system_msg += f"\nStep-specific instructions for Step {cur}:\n{step_llm_guidance}\n"
 
     # Steps 1-3: no resource snippets — student must find their own sources
-    if active_step and active_step <= 3:
+    if not _step_uses_passages(active_step):
         context_msg = (
             f"Student context:\n{worldview_profile}\n\n"
             f"STUDENT'S RESEARCH DESIGN (from 'My Research Design' panel — reference these directly):\n{step_context}\n"
@@ -1065,20 +1605,30 @@ def build_ollama_payload(worldview_profile, step_context, user_msg, passages,
     }
 
 
-def _call_vllm(messages: list, temperature: float = LLM_TEMP,
-               max_tokens: int = 2048, timeout: int = 120) -> Optional[str]:
-    """Call vLLM (OpenAI-compatible API). Returns content string or None on failure."""
+def _vllm_headers() -> dict:
     headers = {"Content-Type": "application/json"}
     if VLLM_API_KEY:
         headers["Authorization"] = f"Bearer {VLLM_API_KEY}"
+    return headers
+
+
+def _vllm_body(messages: list, temperature: float = LLM_TEMP,
+               max_tokens: int = 2048, stream: bool = False) -> dict:
+    return {
+        "model": VLLM_MODEL,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "stream": stream,
+    }
+
+
+def _call_vllm(messages: list, temperature: float = LLM_TEMP,
+               max_tokens: int = 2048, timeout: Optional[float] = None) -> Optional[str]:
+    """Call vLLM (OpenAI-compatible API). Returns content string or None on failure."""
     try:
-        resp = requests.post(VLLM_URL, json={
-            "model": VLLM_MODEL,
-            "messages": messages,
-            "temperature": temperature,
-            "max_tokens": max_tokens,
-            "stream": False,
-        }, headers=headers, timeout=timeout)
+        resp = llm_clients.vllm.post(VLLM_URL, json=_vllm_body(messages, temperature, max_tokens),
+                                     headers=_vllm_headers(), timeout=timeout)
         resp.raise_for_status()
         data = resp.json()
         return data["choices"][0]["message"]["content"].strip()
@@ -1087,11 +1637,25 @@ def _call_vllm(messages: list, temperature: float = LLM_TEMP,
         return None
 
 
-def _call_ollama(payload: dict, timeout: int = 120) -> Optional[str]:
+async def _call_vllm_async(messages: list, temperature: float = LLM_TEMP,
+                           max_tokens: int = 2048, timeout: Optional[float] = None) -> Optional[str]:
+    """_call_vllm() on the async client."""
+    try:
+        resp = await llm_clients.async_vllm.post(VLLM_URL, json=_vllm_body(messages, temperature, max_tokens),
+                                                 headers=_vllm_headers(), timeout=timeout)
+        resp.raise_for_status()
+        data = resp.json()
+        return data["choices"][0]["message"]["content"].strip()
+    except Exception as e:
+        logger.warning("vLLM call failed: %s", e)
+        return None
+
+
+def _call_ollama(payload: dict, timeout: Optional[float] = None) -> Optional[str]:
     """Call Ollama. Returns content string or None on failure."""
     try:
         payload.setdefault("keep_alive", OLLAMA_KEEP_ALIVE)
-        resp = requests.post(OLLAMA_URL, json=payload, timeout=timeout)
+        resp = llm_clients.ollama.post(OLLAMA_URL, json=payload, timeout=timeout)
         resp.raise_for_status()
         data = resp.json()
         return data.get("message", {}).get("content", "").strip()
@@ -1100,35 +1664,39 @@ def _call_ollama(payload: dict, timeout: int = 120) -> Optional[str]:
         return None
 
 
-def call_llm(worldview_profile: str, step_context: str, user_msg: str,
-             passages: List[Dict[str, Any]],
-             active_step: Optional[int] = None,
-             step_llm_guidance: Optional[str] = None,
-             chat_history=None, language: str = "en") -> str:
+async def _call_ollama_async(payload: dict, timeout: Optional[float] = None) -> Optional[str]:
+    """_call_ollama() on the async client."""
+    try:
+        payload.setdefault("keep_alive", OLLAMA_KEEP_ALIVE)
+        resp = await llm_clients.async_ollama.post(OLLAMA_URL, json=payload, timeout=timeout)
+        resp.raise_for_status()
+        data = resp.json()
+        return data.get("message", {}).get("content", "").strip()
+    except Exception as e:
+        logger.warning("Ollama call failed: %s", e)
+        return None
 
-    payload = build_ollama_payload(
-        worldview_profile, step_context, user_msg, passages,
-        stream=False, active_step=active_step, step_llm_guidance=step_llm_guidance,
-        chat_history=chat_history, language=language,
-    )
 
-    result = None
-    # Try vLLM first if configured
+_LLM_FAILED_MESSAGE = (
+    "I ran into an issue calling the language model. "
+    "Please try again or check the backend logs."
+)
+
+
+async def _complete(payload: dict) -> str:
+    """Non-streaming answer for payload from the primary backend, falling back
+    to the other one."""
     if LLM_BACKEND == "vllm":
-        result = _call_vllm(payload["messages"], temperature=LLM_TEMP)
+        result = await _call_vllm_async(payload["messages"], temperature=LLM_TEMP)
         if result is None:
             logger.info("vLLM failed, falling back to Ollama...")
-            result = _call_ollama(payload)
+            result = await _call_ollama_async(payload)
     else:
-        result = _call_ollama(payload)
-        if result is None and LLM_BACKEND != "vllm":
+        result = await _call_ollama_async(payload)
+        if result is None:
             logger.info("Ollama failed, trying vLLM fallback...")
-            result = _call_vllm(payload["messages"], temperature=LLM_TEMP)
-
-    return result or (
-        "I ran into an issue calling the language model. "
-        "Please try again or check the backend logs."
-    )
+            result = await _call_vllm_async(payload["messages"], temperature=LLM_TEMP)
+    return result or _LLM_FAILED_MESSAGE
 
 
 # ============================================================
@@ -2318,25 +2886,39 @@ def _canned(lang: str, en_text: str, es_text: str, zh_text: str = None) -> str:
 
 
 
-def _moderate_input(user_msg: str) -> tuple:
-    """Run Llama Guard 3 locally (via Ollama) on the student's message.
+async def _moderate_input(user_msg: str, qvec=None, language: Optional[str] = None) -> tuple:
+    """Run Llama Guard 3 locally (via Ollama) on the student's message, unless
+    the local pre-screen finds it clearly benign. qvec is the message's query
+    vector (see _pre_generation); language the chat's UI language.
     Returns (is_safe: bool, categories: str). Fails OPEN (treated as safe) if the
     guard model is unavailable, so moderation can never break the chat."""
     if not MODERATION_ENABLED or not (user_msg or "").strip():
         return True, ""
+    screen = _prescreen_message(user_msg, qvec, language)
+    if screen is not None and not screen.escalate and MODERATION_PRESCREEN != "audit":
+        return True, ""
     try:
-        r = requests.post(OLLAMA_URL, json={
-            "model": MODERATION_MODEL,
-            "messages": [{"role": "user", "content": user_msg}],
-            "stream": False,
-            "keep_alive": OLLAMA_KEEP_ALIVE,
-            "options": {"temperature": 0.0, "num_predict": 20},
-        }, timeout=20)
+        r = await llm_clients.async_moderation.post(OLLAMA_URL, json=_moderation_body(user_msg))
         r.raise_for_status()
         out = ((r.json().get("message", {}) or {}).get("content", "") or "").strip()
     except Exception as e:
         logger.warning("Moderation (Llama Guard) unavailable — allowing message: %s", e)
         return True, ""
+    return _record_guard_verdict(user_msg, screen, _guard_verdict(out))
+
+
+def _moderation_body(user_msg: str) -> dict:
+    return {
+        "model": MODERATION_MODEL,
+        "messages": [{"role": "user", "content": user_msg}],
+        "stream": False,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        "options": {"temperature": 0.0, "num_predict": 20},
+    }
+
+
+def _guard_verdict(out: str) -> tuple:
+    """(is_safe, categories) from Llama Guard's reply ("safe" / "unsafe\nS1,...")."""
     lines = [l.strip() for l in out.splitlines() if l.strip()]
     if lines and lines[0].lower().startswith("unsafe"):
         categories = lines[1] if len(lines) > 1 else ""
@@ -2345,6 +2927,89 @@ def _moderate_input(user_msg: str) -> tuple:
     return True, ""
 
 
+# ---- Moderation pre-screen ----
+_prescreen: Optional[moderation_prescreen.Prescreen] = None
+_prescreen_stats = {"screened": 0, "skipped": 0, "escalated": 0, "guard_calls": 0, "guard_unsafe": 0,
+                    # audit mode: guard verdicts on messages the pre-screen would skip / escalate
+                    "audit_missed": 0, "audit_skip_agreed": 0,
+                    "audit_escalated_safe": 0, "audit_escalated_unsafe": 0}
+_prescreen_reasons: Dict[str, int] = {}
+_prescreen_stats_lock = threading.Lock()
+
+
+def _load_moderation_prescreen():
+    global _prescreen
+    if MODERATION_PRESCREEN not in ("on", "audit") or not MODERATION_ENABLED:
+        return
+    try:
+        _ensure_embedder()
+        _prescreen = moderation_prescreen.Prescreen.load(_embedder)
+    except Exception as e:
+        logger.warning("Moderation pre-screen disabled; every message goes to Llama Guard: %s", e)
+        return
+    logger.info("Moderation pre-screen %s (%d patterns, %d exemplars, similarity >= %.2f escalates)",
+                MODERATION_PRESCREEN, len(_prescreen.patterns), len(_prescreen.exemplar_categories),
+                _prescreen.threshold)
+
+
+def _prescreen_message(user_msg: str, qvec=None,
+                       language: Optional[str] = None) -> Optional[moderation_prescreen.Screen]:
+    """The pre-screen's verdict, or None when it is off. Without qvec only the
+    lexicon, length, script and language checks can run, so nothing skips the
+    guard."""
+    if _prescreen is None:
+        return None
+    try:
+        screen = _prescreen.screen(user_msg, qvec, language)
+    except Exception as e:
+        logger.warning("Moderation pre-screen failed; asking Llama Guard: %s", e)
+        screen = moderation_prescreen.Screen(True, "error")
+    reason = screen.reason or "benign"
+    with _prescreen_stats_lock:
+        _prescreen_stats["screened"] += 1
+        _prescreen_stats["escalated" if screen.escalate else "skipped"] += 1
+        _prescreen_reasons[reason] = _prescreen_reasons.get(reason, 0) + 1
+    return screen
+
+
+def _record_guard_verdict(user_msg: str, screen: Optional[moderation_prescreen.Screen],
+                          verdict: tuple) -> tuple:
+    """Count a Llama Guard verdict against the pre-screen's; in audit mode a
+    message the pre-screen would have let through unchecked is logged."""
+    is_safe = verdict[0]
+    audit = screen is not None and MODERATION_PRESCREEN == "audit"
+    with _prescreen_stats_lock:
+        _prescreen_stats["guard_calls"] += 1
+        if not is_safe:
+            _prescreen_stats["guard_unsafe"] += 1
+        if audit:
+            if screen.escalate:
+                _prescreen_stats["audit_escalated_safe" if is_safe else "audit_escalated_unsafe"] += 1
+            else:
+                _prescreen_stats["audit_skip_agreed" if is_safe else "audit_missed"] += 1
+    if audit and not screen.escalate and not is_safe:
+        logger.warning("Moderation pre-screen would have skipped a message Llama Guard flagged (%s, "
+                       "nearest exemplar %.3f): %r", verdict[1] or "unspecified",
+                       screen.similarity or 0.0, user_msg[:200])
+    return verdict
+
+
+def _prescreen_status() -> Dict[str, Any]:
+    with _prescreen_stats_lock:
+        stats, reasons = dict(_prescreen_stats), dict(_prescreen_reasons)
+    screened = stats["screened"]
+    out = {"mode": MODERATION_PRESCREEN if _prescreen else "off",
+           "similarity_threshold": _prescreen.threshold if _prescreen else None,
+           "embedding_check": bool(_prescreen and _prescreen.exemplars is not None),
+           **stats, "reasons": reasons,
+           "skip_rate": round(stats["skipped"] / screened, 3) if screened else 0.0}
+    audited = stats["audit_missed"] + stats["audit_skip_agreed"]
+    if MODERATION_PRESCREEN == "audit" and audited:
+        # Share of would-be-skipped messages the guard flagged: must stay ~0.
+        out["audit_miss_rate"] = round(stats["audit_missed"] / audited, 4)
+    return out
+
+
 # ---------------- Academic-integrity guardrail (coach, don't author) ----------------
 
 # Step-specific guiding nudges used when redirecting a "do it for me" request.
@@ -2571,59 +3236,88 @@ def _sanitize_stream(raw_iter, own_q_terms=None, own_q_nudge=None, own_q_texts=N
     AI-looking punctuation (em/en dashes) in everything the student sees."""
     for piece in _sanitize_stream_blocks(raw_iter, own_q_terms=own_q_terms,
                                          own_q_nudge=own_q_nudge, own_q_texts=own_q_texts):
-        yield piece.replace("—", "-").replace("–", "-")
+        yield _plain_dashes(piece)
+
+
+def _plain_dashes(piece: str) -> str:
+    return piece.replace("—", "-").replace("–", "-")
 
 
 def _sanitize_stream_blocks(raw_iter, own_q_terms=None, own_q_nudge=None, own_q_texts=None):
     """Line-buffer a token stream and drop 'handed-over deliverable' blocks, emitting a
     single coaching nudge in their place. Yields sanitized text pieces."""
-    pending = ""
-    st = {"suppress": False, "seen_content": False, "nudges": 0}
-
-    def start_block():
+    guard = _OutputGuard(own_q_terms=own_q_terms, own_q_nudge=own_q_nudge, own_q_texts=own_q_texts)
+    for delta in raw_iter:
+        yield from guard.feed(delta)
+    yield from guard.finish()
+
+
+class _OutputGuard:
+    """Incremental form of _sanitize_stream_blocks(): feed() the stream's
+    deltas as they arrive and get back the sanitized pieces completed so far;
+    finish() flushes the last, unterminated line. Lines are only judged once
+    complete, so feed() is just a string append until a newline arrives."""
+
+    def __init__(self, own_q_terms=None, own_q_nudge=None, own_q_texts=None):
+        self.own_q_terms = own_q_terms
+        self.own_q_nudge = own_q_nudge
+        self.own_q_texts = own_q_texts
+        self.pending = ""
+        self.suppress = False
+        self.seen_content = False
+        self.nudges = 0
+
+    def _start_block(self):
         # Drop held-back blocks SILENTLY — the student shouldn't see an internal
         # "I've held back the wording" note; they just get clean feedback.
-        st["suppress"] = True
-        st["seen_content"] = False
+        self.suppress = True
+        self.seen_content = False
         return ""
 
-    def process_line(line):
+    def _process_line(self, line):
         s = line.strip()
         is_label = bool(_HANDED_LABEL_RE.match(s))
-        if st["suppress"]:
+        if self.suppress:
             if is_label or s.startswith("#"):
                 # A new label/heading ends the current block; handle this line fresh.
-                st["suppress"] = False
+                self.suppress = False
             elif s == "":
-                if not st["seen_content"]:
+                if not self.seen_content:
                     return ""  # blank sitting between the label and its value → drop
-                st["suppress"] = False
+                self.suppress = False
                 return "\n"       # blank after the value → block ends here
             else:
-                st["seen_content"] = True
+                self.seen_content = True
                 return ""         # the handed-over value itself → drop
         if is_label:
-            return start_block()
-        if own_q_terms and _is_own_topic_question(line, own_q_terms, own_q_texts):
+            return self._start_block()
+        if self.own_q_terms and _is_own_topic_question(line, self.own_q_terms, self.own_q_texts):
             # A ready-made research question about the student's own topic —
             # drop it; the first time, replace it with a coaching nudge.
-            if st["nudges"] == 0 and own_q_nudge:
-                st["nudges"] += 1
-                return own_q_nudge + "\n"
+            if self.nudges == 0 and self.own_q_nudge:
+                self.nudges += 1
+                return self.own_q_nudge + "\n"
             return ""
         return _fix_signoff(line) + "\n"
 
-    for delta in raw_iter:
-        pending += delta
-        while "\n" in pending:
-            line, pending = pending.split("\n", 1)
-            out = process_line(line)
-            if out:
-                yield out
-    if pending:
-        out = process_line(pending)
-        if out:
-            yield out.rstrip("\n") if not pending.endswith("\n") else out
+    def feed(self, delta: str) -> List[str]:
+        self.pending += delta
+        out = []
+        while "\n" in self.pending:
+            line, self.pending = self.pending.split("\n", 1)
+            piece = self._process_line(line)
+            if piece:
+                out.append(piece)
+        return out
+
+    def finish(self) -> List[str]:
+        pending, self.pending = self.pending, ""
+        if not pending:
+            return []
+        out = self._process_line(pending)
+        if not out:
+            return []
+        return [out.rstrip("\n") if not pending.endswith("\n") else out]
 
 
 def _strip_handed_answers(text: str, own_q_terms=None, own_q_nudge=None, own_q_texts=None) -> str:
@@ -2690,12 +3384,86 @@ def _coach_redirect_message(active_step) -> str:
     )
 
 
-def _asks_ai_to_author(user_msg: str, active_step) -> bool:
+async def _asks_ai_to_author(user_msg: str, active_step, qvec=None) -> bool:
     """Fast local self-check (intent gate): is the student asking the AI to PRODUCE
     their own design content (topic, research question, aim, hypothesis, or any step
     plan) rather than asking for an explanation, feedback, or guidance? Returns True
     only for 'do it for me' requests. Fails OPEN (False) if the classifier is
-    unavailable — the strengthened system prompt still applies as a backstop."""
+    unavailable — the strengthened system prompt still applies as a backstop.
+    The local classifier answers first (on qvec, the message's query vector);
+    the LLM is only asked when it is unsure."""
+    local = _local_author_intent(user_msg, active_step, qvec)
+    if local is not None:
+        return local
+    msgs = _author_intent_messages(user_msg, active_step)
+    raw = None
+    try:
+        if LLM_BACKEND == "vllm":
+            raw = await _call_vllm_async(msgs, temperature=0.0, max_tokens=4, timeout=20)
+        if raw is None:
+            raw = await _call_ollama_async(_author_intent_payload(msgs), timeout=20)
+    except Exception as e:
+        logger.warning("Intent gate classifier failed: %s", e)
+        return False
+    return _is_author_verdict(raw)
+
+
+# ---- Local intent classifier ----
+# A logistic regression on the message's MiniLM query vector (embedded once
+# by _pre_generation and shared with retrieval) decides AUTHOR vs COACH without the
+# chat model whenever it is at least INTENT_CONFIDENCE sure. Train it with
+# `python intent_classifier.py train`; without a model every message goes to
+# the LLM as before. INTENT_CLASSIFIER=0 turns it off.
+INTENT_CLASSIFIER = os.environ.get("INTENT_CLASSIFIER", "1") != "0"
+_intent_model: Optional[intent_classifier.IntentClassifier] = None
+_intent_stats = {"local_author": 0, "local_coach": 0, "llm": 0}
+_intent_stats_lock = threading.Lock()
+
+
+def _count_intent(outcome: str):
+    with _intent_stats_lock:
+        _intent_stats[outcome] += 1
+
+
+def _load_intent_classifier():
+    global _intent_model
+    if not INTENT_CLASSIFIER:
+        return
+    _intent_model = intent_classifier.IntentClassifier.load(model_name=EMBED_MODEL_NAME)
+    if _intent_model is not None:
+        logger.info("Intent classifier loaded (%s, %d examples, threshold %.2f)",
+                    _intent_model.meta.get("kind"), _intent_model.meta.get("examples", 0),
+                    intent_classifier.CONFIDENCE)
+
+
+def _local_author_intent(user_msg: str, active_step, qvec=None) -> Optional[bool]:
+    """The local classifier's verdict, or None when it (or qvec) is unavailable
+    or it is not confident enough (the caller then asks the LLM)."""
+    if _intent_model is None or qvec is None or not (user_msg or "").strip():
+        _count_intent("llm")
+        return None
+    try:
+        verdict, p_author = _intent_model.decide(qvec, active_step)
+    except Exception as e:
+        logger.warning("Local intent classifier failed; asking the LLM: %s", e)
+        verdict, p_author = None, None
+    _count_intent("llm" if verdict is None else ("local_author" if verdict else "local_coach"))
+    logger.debug("Intent gate: P(AUTHOR)=%s -> %s", p_author,
+                 "LLM" if verdict is None else ("AUTHOR" if verdict else "COACH"))
+    return verdict
+
+
+def _intent_gate_status() -> Dict[str, Any]:
+    with _intent_stats_lock:
+        stats = dict(_intent_stats)
+    decided = sum(stats.values())
+    local = stats["local_author"] + stats["local_coach"]
+    return {"classifier": bool(_intent_model), "threshold": intent_classifier.CONFIDENCE,
+            **stats, "local_share": round(local / decided, 3) if decided else 0.0,
+            "model": (_intent_model.meta if _intent_model else None)}
+
+
+def _author_intent_messages(user_msg: str, active_step) -> list:
     prompt = (
         "You are a classifier for a research-methods tutoring app. A student is on "
         f"Step {active_step or '?'} of designing their OWN research study.\n"
@@ -2719,28 +3487,186 @@ def _asks_ai_to_author(user_msg: str, active_step) -> bool:
         f"Student message: \"{(user_msg or '')[:500]}\"\n\n"
         "One word (AUTHOR or COACH):"
     )
-    msgs = [{"role": "user", "content": prompt}]
-    raw = None
-    try:
-        if LLM_BACKEND == "vllm":
-            raw = _call_vllm(msgs, temperature=0.0, max_tokens=4, timeout=20)
-        if raw is None:
-            raw = _call_ollama({
-                "model": LLM_MODEL, "messages": msgs, "stream": False,
-                "options": {"temperature": 0.0, "num_predict": 4},
-            }, timeout=20)
-    except Exception as e:
-        logger.warning("Intent gate classifier failed: %s", e)
-        return False
+    return [{"role": "user", "content": prompt}]
+
+
+def _author_intent_payload(msgs: list) -> dict:
+    return {
+        "model": LLM_MODEL, "messages": msgs, "stream": False,
+        "options": {"temperature": 0.0, "num_predict": 4},
+    }
+
+
+def _is_author_verdict(raw: Optional[str]) -> bool:
     if not raw:
         return False
     # Take the first word to avoid stray tokens flipping the result
     return raw.strip().upper().startswith("AUTHOR") or "AUTHOR" in raw.strip().upper()[:12]
 
 
+# ---- Async chat pipeline ----
+# The chat endpoints are async so a message waiting on moderation, the intent
+# check or a 300 s generation holds no threadpool thread: LLM calls and streams
+# go through the pooled httpx clients in llm_clients. CPU-bound work (query
+# embedding, retrieval, prompt compression, the output guard) runs on a
+# bounded pool of CHAT_CPU_WORKERS threads; blocking MongoDB calls use
+# Starlette's threadpool.
+CHAT_CPU_WORKERS = int(os.environ.get("CHAT_CPU_WORKERS", str(min(8, os.cpu_count() or 4))))
+_chat_cpu_pool = ThreadPoolExecutor(max_workers=max(1, CHAT_CPU_WORKERS), thread_name_prefix="chat-cpu")
+
+
+async def _run_cpu(fn, *args, **kwargs):
+    """Run fn on the bounded chat CPU pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_chat_cpu_pool, functools.partial(fn, *args, **kwargs))
+
+
+def _chat_payload(sess: SessionData, user_msg: str, active_step: Optional[int],
+                  history: List[ChatTurn], language: str, stream: bool) -> dict:
+    """Retrieval plus the full Ollama payload for a chat message (CPU-bound)."""
+    worldview_profile = _render_worldview_profile(sess)
+    step_context = _render_step_context(sess)
+    passages = _retrieve(user_msg, k=5, step=active_step) if _step_uses_passages(active_step) else []
+    step_llm_guidance = _get_step_llm_guidance(sess, active_step)
+    return build_ollama_payload(
+        worldview_profile, step_context, user_msg, passages,
+        stream=stream, active_step=active_step, step_llm_guidance=step_llm_guidance,
+        chat_history=history, language=language,
+    )
+
+
+async def _timed(stage: str, timings: Dict[str, float], coro):
+    t0 = _time_mod.perf_counter()
+    try:
+        return await coro
+    finally:
+        timings[stage] = (_time_mod.perf_counter() - t0) * 1000
+
+
+async def _pre_generation(sess: SessionData, user_msg: str, active_step: Optional[int],
+                          history: List[ChatTurn], language: str, stream: bool):
+    """Run the independent pre-generation stages concurrently: moderation,
+    the intent gate and retrieval + prompt assembly. Returns (is_safe,
+    asks_to_author, payload). When a local gate needs the message's query
+    vector, it is embedded on the batcher thread in a task that overlaps
+    retrieval (whose lookup of the same text shares its batch or hits the
+    query cache); both gates await that one task. The gates keep their fail-open
+    behaviour; a failed payload is returned as its exception and only raised
+    (by _payload_or_raise) when a reply is actually generated."""
+    timings: Dict[str, float] = {}
+    t0 = _time_mod.perf_counter()
+    embed = None
+    if (_prescreen is not None and _prescreen.exemplars is not None) or _intent_model is not None:
+        embed = asyncio.ensure_future(_timed("embed", timings, _embed_query_async(user_msg)))
+
+    async def with_qvec(gate, *args, **kwargs):
+        # Shielded: one gate being cancelled must not cancel the shared embed.
+        qvec = await asyncio.shield(embed) if embed is not None else None
+        return await gate(user_msg, *args, qvec=qvec, **kwargs)
+
+    try:
+        moderation, authoring, payload = await asyncio.gather(
+            _timed("moderation", timings, with_qvec(_moderate_input, language=language)),
+            _timed("intent", timings, with_qvec(_asks_ai_to_author, active_step)),
+            _timed("retrieval", timings, _run_cpu(_chat_payload, sess, user_msg, active_step,
+                                                  history, language, stream)),
+            return_exceptions=True,
+        )
+    finally:
+        if embed is not None and not embed.done():
+            embed.cancel()
+    logger.info("Pre-generation for session %s: embed %.0f ms, moderation %.0f ms, intent %.0f ms, "
+                "retrieval+prompt %.0f ms, wall %.0f ms", sess.id, timings.get("embed", 0),
+                timings.get("moderation", 0),
+                timings.get("intent", 0), timings.get("retrieval", 0),
+                (_time_mod.perf_counter() - t0) * 1000)
+    # Both gates catch their own errors; anything escaping them still fails open.
+    if isinstance(moderation, BaseException):
+        logger.warning("Moderation failed — allowing message: %s", moderation)
+        moderation = (True, "")
+    if isinstance(authoring, BaseException):
+        logger.warning("Intent gate classifier failed: %s", authoring)
+        authoring = False
+    return moderation[0], authoring, payload
+
+
+def _payload_or_raise(payload):
+    if isinstance(payload, BaseException):
+        raise payload
+    return payload
+
+
+async def _stream_vllm_async(payload: dict):
+    """Stream from vLLM (OpenAI SSE format)."""
+    body = _vllm_body(payload["messages"], temperature=LLM_TEMP, stream=True)
+    async with llm_clients.async_vllm.stream("POST", VLLM_URL, json=body, headers=_vllm_headers(),
+                                             timeout=llm_clients.LLM_STREAM_TIMEOUT) as resp:
+        resp.raise_for_status()
+        async for line in resp.aiter_lines():
+            if not line:
+                continue
+            if line.startswith("data: "):
+                line = line[6:]
+            if line.strip() == "[DONE]":
+                break
+            try:
+                data = json.loads(line)
+            except Exception:
+                continue
+            delta = data.get("choices", [{}])[0].get("delta", {}).get("content", "")
+            if delta:
+                yield delta
+
+
+async def _stream_ollama_async(payload: dict):
+    """Stream from Ollama (native format)."""
+    payload.setdefault("keep_alive", OLLAMA_KEEP_ALIVE)
+    async with llm_clients.async_ollama.stream("POST", OLLAMA_URL, json=payload,
+                                               timeout=llm_clients.LLM_STREAM_TIMEOUT) as resp:
+        resp.raise_for_status()
+        async for line in resp.aiter_lines():
+            if not line:
+                continue
+            try:
+                data = json.loads(line)
+            except Exception:
+                continue
+            delta = data.get("message", {}).get("content", "")
+            if delta:
+                yield delta
+
+
+async def _stream_llm_async(payload: dict):
+    """Raw model token stream: try primary backend, fall back to the other."""
+    primary, fallback = ((_stream_vllm_async, _stream_ollama_async) if LLM_BACKEND == "vllm"
+                         else (_stream_ollama_async, _stream_vllm_async))
+    try:
+        async for delta in primary(payload):
+            yield delta
+    except (GeneratorExit, asyncio.CancelledError):
+        raise
+    except Exception as primary_err:
+        logger.warning("Primary stream (%s) failed: %s — trying fallback", LLM_BACKEND, primary_err)
+        async for delta in fallback(payload):
+            yield delta
+
+
+def _canned_stream(text: str, history: List[ChatTurn], sess: SessionData, active_step,
+                   split: bool = False):
+    """Stream a fixed reply (split into paragraph-sized chunks so it feels like a
+    normal response) and record it in the session."""
+    try:
+        for chunk in (re.split(r"(?<=\n\n)", text) if split else [text]):
+            if chunk:
+                yield chunk
+    finally:
+        history.append(ChatTurn(role="assistant", content=text, step=active_step))
+        _persist_session(sess)
+
+
 @app.post("/chat/send", response_model=ChatHistoryResp)
-def chat_send(req: ChatSendReq = Body(...), user: dict = Depends(get_current_user)):
-    sess = _require_session(req.session_id)
+async def chat_send(req: ChatSendReq = Body(...), user: dict = Depends(get_current_user)):
+    sess = await run_in_threadpool(_require_session, req.session_id)
     history = _get_chat(sess)
     chat_lang = (req.language or "").strip().lower()
     if chat_lang not in SUPPORTED_LANGUAGES:
@@ -2754,9 +3680,9 @@ def chat_send(req: ChatSendReq = Body(...), user: dict = Depends(get_current_use
     history.append(ChatTurn(role="user", content=user_msg, step=req.active_step))
 
     # Teacher-controlled mode: AI assistant may be turned off for this student's class.
-    if not _student_ai_enabled(user):
+    if not await run_in_threadpool(_student_ai_enabled, user):
         history.append(ChatTurn(role="assistant", content=_canned(chat_lang,_AI_OFF_MESSAGE, _AI_OFF_MESSAGE_ES, _AI_OFF_MESSAGE_ZH), step=req.active_step))
-        _persist_session(sess)
+        await run_in_threadpool(_persist_session, sess)
         return ChatHistoryResp(session_id=req.session_id, history=history)
 
     # Source gate (deterministic): a citation/source request is never a safety concern,
@@ -2764,51 +3690,47 @@ def chat_send(req: ChatSendReq = Body(...), user: dict = Depends(get_current_use
     if _asks_for_sources(user_msg):
         answer = _source_redirect_message(req.active_step)
         history.append(ChatTurn(role="assistant", content=answer, step=req.active_step))
-        _persist_session(sess)
+        await run_in_threadpool(_persist_session, sess)
         return ChatHistoryResp(session_id=req.session_id, history=history)
 
+    # Moderation, the intent gate and retrieval run concurrently; the gates'
+    # verdicts are then applied in order, as if they had run one by one.
+    is_safe, asks_to_author, payload = await _pre_generation(
+        sess, user_msg, req.active_step, history, chat_lang, stream=False)
+
     # Safety gate: refuse harmful/unethical requests (Llama Guard 3, local).
-    is_safe, _cats = _moderate_input(user_msg)
     if not is_safe:
         history.append(ChatTurn(role="assistant", content=_canned(chat_lang,_SAFETY_REFUSAL, _SAFETY_REFUSAL_ES, _SAFETY_REFUSAL_ZH), step=req.active_step))
-        _persist_session(sess)
+        await run_in_threadpool(_persist_session, sess)
         return ChatHistoryResp(session_id=req.session_id, history=history)
 
     # Academic-integrity gate: if the student is asking the AI to author their design
     # content, coach them instead of doing the work for them.
-    if _asks_ai_to_author(user_msg, req.active_step):
+    if asks_to_author:
         answer = _coach_redirect_message(req.active_step)
         history.append(ChatTurn(role="assistant", content=answer, step=req.active_step))
-        _persist_session(sess)
+        await run_in_threadpool(_persist_session, sess)
         return ChatHistoryResp(session_id=req.session_id, history=history)
 
     # Normal LLM + RAG chat using worldview and resources
-    worldview_profile = _render_worldview_profile(sess)
-    step_context = _render_step_context(sess)
-    passages = _retrieve(user_msg, k=5)
-    step_llm_guidance = _get_step_llm_guidance(sess, req.active_step)
-    answer = call_llm(
-        worldview_profile, step_context, user_msg, passages,
-        active_step=req.active_step, step_llm_guidance=step_llm_guidance,
-        chat_history=history, language=chat_lang,
-    )
+    answer = await _complete(_payload_or_raise(payload))
     # Output guard: strip any handed-over deliverable blocks the model slipped in.
     oq_terms, oq_nudge, oq_texts = _own_question_guard_args(sess, req.active_step, chat_lang, user_msg)
-    answer = _strip_handed_answers(answer, own_q_terms=oq_terms, own_q_nudge=oq_nudge,
-                                   own_q_texts=oq_texts)
+    answer = await _run_cpu(_strip_handed_answers, answer, own_q_terms=oq_terms,
+                            own_q_nudge=oq_nudge, own_q_texts=oq_texts)
 
     history.append(ChatTurn(role="assistant", content=answer, step=req.active_step))
-    _persist_session(sess)
+    await run_in_threadpool(_persist_session, sess)
     return ChatHistoryResp(session_id=req.session_id, history=history)
 
 
 # ---------------- Optional streaming endpoint ----------------
 @app.post("/chat/send_stream")
-def chat_send_stream(req: ChatSendReq = Body(...), user: dict = Depends(get_current_user)):
+async def chat_send_stream(req: ChatSendReq = Body(...), user: dict = Depends(get_current_user)):
     """
     Streaming variant of /chat/send — streams the LLM's answer chunk-by-chunk.
     """
-    sess = _require_session(req.session_id)
+    sess = await run_in_threadpool(_require_session, req.session_id)
     history = _get_chat(sess)
     chat_lang = (req.language or "").strip().lower()
     if chat_lang not in SUPPORTED_LANGUAGES:
@@ -2822,153 +3744,73 @@ def chat_send_stream(req: ChatSendReq = Body(...), user: dict = Depends(get_curr
     history.append(ChatTurn(role="user", content=user_msg, step=req.active_step))
 
     # Teacher-controlled mode: AI assistant may be turned off for this student's class.
-    if not _student_ai_enabled(user):
-        def _ai_off_stream():
-            try:
-                yield _canned(chat_lang,_AI_OFF_MESSAGE, _AI_OFF_MESSAGE_ES, _AI_OFF_MESSAGE_ZH)
-            finally:
-                history.append(ChatTurn(role="assistant", content=_canned(chat_lang,_AI_OFF_MESSAGE, _AI_OFF_MESSAGE_ES, _AI_OFF_MESSAGE_ZH), step=req.active_step))
-                _persist_session(sess)
-        return StreamingResponse(_ai_off_stream(), media_type="text/plain")
+    # (The canned streams are sync generators; Starlette iterates them in its threadpool.)
+    if not await run_in_threadpool(_student_ai_enabled, user):
+        text = _canned(chat_lang,_AI_OFF_MESSAGE, _AI_OFF_MESSAGE_ES, _AI_OFF_MESSAGE_ZH)
+        return StreamingResponse(_canned_stream(text, history, sess, req.active_step),
+                                 media_type="text/plain")
 
     # Source gate (deterministic): a citation/source request is never a safety concern,
     # so handle it before moderation to return the helpful coaching message.
     if _asks_for_sources(user_msg):
         redirect_text = _source_redirect_message(req.active_step)
+        return StreamingResponse(_canned_stream(redirect_text, history, sess, req.active_step, split=True),
+                                 media_type="text/plain")
 
-        def _src_stream():
-            try:
-                for chunk in re.split(r"(?<=\n\n)", redirect_text):
-                    if chunk:
-                        yield chunk
-            finally:
-                history.append(ChatTurn(role="assistant", content=redirect_text, step=req.active_step))
-                _persist_session(sess)
-
-        return StreamingResponse(_src_stream(), media_type="text/plain")
+    # Moderation, the intent gate and retrieval run concurrently; the gates'
+    # verdicts are then applied in order, as if they had run one by one.
+    is_safe, asks_to_author, payload = await _pre_generation(
+        sess, user_msg, req.active_step, history, chat_lang, stream=True)
 
     # Safety gate: refuse harmful/unethical requests (Llama Guard 3, local).
-    is_safe, _cats = _moderate_input(user_msg)
     if not is_safe:
-        def _refusal_stream():
-            try:
-                yield _canned(chat_lang,_SAFETY_REFUSAL, _SAFETY_REFUSAL_ES, _SAFETY_REFUSAL_ZH)
-            finally:
-                history.append(ChatTurn(role="assistant", content=_canned(chat_lang,_SAFETY_REFUSAL, _SAFETY_REFUSAL_ES, _SAFETY_REFUSAL_ZH), step=req.active_step))
-                _persist_session(sess)
-        return StreamingResponse(_refusal_stream(), media_type="text/plain")
+        text = _canned(chat_lang,_SAFETY_REFUSAL, _SAFETY_REFUSAL_ES, _SAFETY_REFUSAL_ZH)
+        return StreamingResponse(_canned_stream(text, history, sess, req.active_step),
+                                 media_type="text/plain")
 
     # Academic-integrity gate: block "do/rewrite it for me" requests.
-    if _asks_ai_to_author(user_msg, req.active_step):
+    if asks_to_author:
         redirect_text = _coach_redirect_message(req.active_step)
-
-        def _redirect_stream():
-            try:
-                # Emit in sentence-sized chunks so it feels like a normal response
-                for chunk in re.split(r"(?<=\n\n)", redirect_text):
-                    if chunk:
-                        yield chunk
-            finally:
-                history.append(ChatTurn(role="assistant", content=redirect_text, step=req.active_step))
-                _persist_session(sess)
-
-        return StreamingResponse(_redirect_stream(), media_type="text/plain")
+        return StreamingResponse(_canned_stream(redirect_text, history, sess, req.active_step, split=True),
+                                 media_type="text/plain")
 
     # Stream LLM answer
-    worldview_profile = _render_worldview_profile(sess)
-    step_context = _render_step_context(sess)
-    passages = _retrieve(user_msg, k=5)
-    step_llm_guidance = _get_step_llm_guidance(sess, req.active_step)
-    payload = build_ollama_payload(
-        worldview_profile, step_context, user_msg, passages,
-        stream=True, active_step=req.active_step, step_llm_guidance=step_llm_guidance,
-        chat_history=history, language=chat_lang,
-    )
+    payload = _payload_or_raise(payload)
 
     # Capture session_id for persistence inside the generator
     session_id = sess.id
 
-    def _stream_vllm():
-        """Stream from vLLM (OpenAI SSE format)."""
-        headers = {"Content-Type": "application/json"}
-        if VLLM_API_KEY:
-            headers["Authorization"] = f"Bearer {VLLM_API_KEY}"
-        vllm_payload = {
-            "model": VLLM_MODEL,
-            "messages": payload["messages"],
-            "temperature": LLM_TEMP,
-            "max_tokens": 2048,
-            "stream": True,
-        }
-        with requests.post(VLLM_URL, json=vllm_payload, headers=headers,
-                           stream=True, timeout=300) as resp:
-            resp.raise_for_status()
-            for line in resp.iter_lines(decode_unicode=True):
-                if not line:
-                    continue
-                if line.startswith("data: "):
-                    line = line[6:]
-                if line.strip() == "[DONE]":
-                    break
-                try:
-                    data = json.loads(line)
-                except Exception:
-                    continue
-                delta = data.get("choices", [{}])[0].get("delta", {}).get("content", "")
-                if delta:
-                    yield delta
-
-    def _stream_ollama():
-        """Stream from Ollama (native format)."""
-        with requests.post(OLLAMA_URL, json=payload, stream=True, timeout=300) as resp:
-            resp.raise_for_status()
-            for line in resp.iter_lines(decode_unicode=True):
-                if not line:
-                    continue
-                try:
-                    data = json.loads(line)
-                except Exception:
-                    continue
-                delta = data.get("message", {}).get("content", "")
-                if delta:
-                    yield delta
-
-    def _raw_deltas():
-        """Raw model token stream: try primary backend, fall back to the other."""
-        stream_fn = _stream_vllm if LLM_BACKEND == "vllm" else _stream_ollama
-        try:
-            for delta in stream_fn():
-                yield delta
-        except GeneratorExit:
-            raise
-        except Exception as primary_err:
-            logger.warning("Primary stream (%s) failed: %s — trying fallback", LLM_BACKEND, primary_err)
-            fallback_fn = _stream_ollama if LLM_BACKEND == "vllm" else _stream_vllm
-            for delta in fallback_fn():
-                yield delta
-
     oq_terms, oq_nudge, oq_texts = _own_question_guard_args(sess, req.active_step, chat_lang, user_msg)
 
-    def event_stream():
+    async def event_stream():
         assistant_text_parts: List[str] = []
+        # Output guard: sanitized, line-buffered stream (drops handed-over answers).
+        # A line is judged once complete, so only deltas that finish one go to the pool.
+        guard = _OutputGuard(own_q_terms=oq_terms, own_q_nudge=oq_nudge, own_q_texts=oq_texts)
         try:
-            # Output guard: sanitized, line-buffered stream (drops handed-over answers).
-            for piece in _sanitize_stream(_raw_deltas(), own_q_terms=oq_terms, own_q_nudge=oq_nudge,
-                                          own_q_texts=oq_texts):
+            async for delta in _stream_llm_async(payload):
+                pieces = await _run_cpu(guard.feed, delta) if "\n" in delta else guard.feed(delta)
+                for piece in pieces:
+                    piece = _plain_dashes(piece)
+                    assistant_text_parts.append(piece)
+                    yield piece
+            for piece in guard.finish():
+                piece = _plain_dashes(piece)
                 assistant_text_parts.append(piece)
                 yield piece
-        except GeneratorExit:
+        except (GeneratorExit, asyncio.CancelledError):
             logger.info("Client disconnected during stream for session %s", session_id)
-            return  # finally block still runs
+            raise  # finally block still runs
         except Exception as e:
             logger.exception("LLM stream failed (both backends): %s", e)
             yield "\n[Error streaming from model]\n"
         finally:
-            # Always persist the sanitized text, even if client disconnected mid-stream
+            # Always persist the sanitized text, even if client disconnected mid-stream.
+            # Submitted to the chat pool, not awaited: a cancelled task can't await.
             full_text = "".join(assistant_text_parts).strip()
             if full_text:
                 history.append(ChatTurn(role="assistant", content=full_text, step=req.active_step))
-            _persist_session(sess)
+            _chat_cpu_pool.submit(_persist_session, sess)
 
     return StreamingResponse(event_stream(), media_type="text/plain")
 
@@ -2976,26 +3818,42 @@ def chat_send_stream(req: ChatSendReq = Body(...), user: dict = Depends(get_curr
 # ---------------- RAG utilities ----------------
 @app.get("/rag/status")
 def rag_status():
+    snap = _snapshot
     return {
         "RAG_AVAILABLE": RAG_AVAILABLE,
         "docs_dir": str(DOCS_DIR),
-        "index_path_exists": INDEX_PATH.exists(),
-        "meta_path_exists": META_PATH.exists(),
-        "num_chunks": len(_chunks),
+        "embed_backend": EMBED_BACKEND,
+        "index_version": snap.version if snap else None,
+        "index_dir": str(snap.path) if snap else None,
+        "num_chunks": len(snap.chunks) if snap else 0,
+        "index": snap.manifest.get("index", {"type": "flat"}) if snap else None,
+        "index_resident_bytes": snap.index_bytes() if snap else 0,
+        "index_recall_loss": (snap.manifest.get("index") or {}).get("recall_loss", 0.0) if snap else None,
+        "rebuild": _active_rebuild_job(),
+        "embed_cache": _embed_cache.stats(),
+        "retrieval_cache": _retrieval_cache.stats(),
+        "sentence_cache": _sentence_cache.stats(),
     }
 
 
 @app.post("/rag/reindex")
-def rag_reindex():
-    try:
-        if INDEX_PATH.exists():
-            INDEX_PATH.unlink()
-        if META_PATH.exists():
-            META_PATH.unlink()
-    except Exception as e:
-        logger.exception("Failed clearing index files: %s", e)
-    _build_index()
-    return {"ok": True, "num_chunks": len(_chunks)}
+def rag_reindex(background_tasks: BackgroundTasks):
+    """Full re-embed of every resource, built in the background. The current
+    index keeps serving until the new snapshot is published."""
+    if not RAG_AVAILABLE:
+        raise HTTPException(status_code=503, detail="Retrieval engine is not available on this server")
+    job, created = _start_rebuild_job(full=True)
+    if created:
+        background_tasks.add_task(_run_rebuild_job, job["id"])
+    return {"ok": True, "job": job}
+
+
+@app.get("/rag/reindex/{job_id}")
+def rag_reindex_status(job_id: str):
+    job = _get_rebuild_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
 
 # ---------------- PDF Export ----------------
@@ -4349,15 +5207,33 @@ def _safe_resource_name(filename: str) -> str:
     return name
 
 
+def _resource_path(name: str) -> Path:
+    """The file under DOCS_DIR for a name from /admin/resources, which may
+    include subfolders ("sub/name.pdf")."""
+    root = DOCS_DIR.resolve()
+    target = (root / (name or "")).resolve()
+    if target == root or not target.is_relative_to(root):
+        raise HTTPException(status_code=400, detail="Invalid file name")
+    if target.suffix.lower() not in RESOURCE_EXTS:
+        raise HTTPException(status_code=400, detail="Only PDF, TXT, or Markdown files are allowed")
+    return target
+
+
 @app.get("/admin/resources")
 def admin_list_resources(admin: dict = Depends(require_admin)):
+    _refresh_snapshot()
+    counts = _indexed_source_counts()
     return {
         "files": _list_resource_files(),
         "index": {
             "rag_available": RAG_AVAILABLE,
-            "total_chunks": len(_chunks),
-            "sources": len({c.get("source") for c in _chunks}),
+            "version": _snapshot.version if _snapshot else None,
+            "total_chunks": len(_snapshot.chunks) if _snapshot else 0,
+            "sources": len(counts),
+            "duplicates": rag_index.dedupe_summary(_snapshot.manifest.get("files", {})) if _snapshot else None,
             "stale": _index_stale(),
+            "rebuild": _active_rebuild_job(),
+            "text_cache": rag_index.text_cache.stats(),
         },
     }
 
@@ -4379,11 +5255,11 @@ async def admin_upload_resource(file: UploadFile = File(...), admin: dict = Depe
     return {"ok": True, "name": name, "size": len(data), "stale": _index_stale()}
 
 
-@app.delete("/admin/resources/{filename}")
+@app.delete("/admin/resources/{filename:path}")
 def admin_delete_resource(filename: str, admin: dict = Depends(require_admin)):
-    name = _safe_resource_name(filename)
-    target = DOCS_DIR / name
-    if not target.exists():
+    target = _resource_path(filename)
+    name = rag_index.resource_name(DOCS_DIR.resolve(), target)
+    if not target.is_file():
         raise HTTPException(status_code=404, detail="File not found")
     target.unlink()
     record_admin_action(
@@ -4394,24 +5270,36 @@ def admin_delete_resource(filename: str, admin: dict = Depends(require_admin)):
 
 
 @app.post("/admin/resources/rebuild")
-def admin_rebuild_index(admin: dict = Depends(require_admin)):
+def admin_rebuild_index(background_tasks: BackgroundTasks, admin: dict = Depends(require_admin)):
+    """Start a background rebuild (or return the one already running); poll
+    /admin/resources/rebuild/{job_id} for progress."""
     if not RAG_AVAILABLE:
         raise HTTPException(status_code=503, detail="Retrieval engine is not available on this server")
-    stats = _build_index(force=True)
-    record_admin_action(
-        str(admin["_id"]), admin.get("email", ""),
-        "rebuild_knowledge_base", "", "", stats or {}
-    )
-    return {"ok": True, **(stats or {}), "stale": _index_stale()}
+    job, created = _start_rebuild_job()
+    if created:
+        background_tasks.add_task(_run_rebuild_job, job["id"])
+        record_admin_action(
+            str(admin["_id"]), admin.get("email", ""),
+            "rebuild_knowledge_base", "", "", {"job_id": job["id"]}
+        )
+    return {"ok": True, "job": job}
+
+
+@app.get("/admin/resources/rebuild/{job_id}")
+def admin_rebuild_status(job_id: str, admin: dict = Depends(require_admin)):
+    job = _get_rebuild_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {**job, "stale": _index_stale() if job["status"] == "done" else None}
 
 
-@app.get("/admin/resources/file/{filename}")
+@app.get("/admin/resources/file/{filename:path}")
 def admin_get_resource_file(filename: str, download: int = Query(0), admin: dict = Depends(require_admin)):
     """View (inline) or download a knowledge-base document."""
     from fastapi.responses import FileResponse
-    name = _safe_resource_name(filename)
-    target = DOCS_DIR / name
-    if not target.exists():
+    target = _resource_path(filename)
+    name = target.name
+    if not target.is_file():
         raise HTTPException(status_code=404, detail="File not found")
     media = {
         "pdf": "application/pdf",
@@ -4725,6 +5613,36 @@ def admin_get_session(session_id: str, admin: dict = Depends(require_admin)):
 
 # ── Admin: System Health ────────────────────────────────
 
+def _worker_memory() -> List[Dict[str, Any]]:
+    """RSS of every uvicorn worker (this process and its siblings started the
+    same way), and how much of it is pages of the published index files. A
+    memory-mapped index lives in the shared page cache, so its RSS shows up in
+    every worker while its PSS splits it between them."""
+    import psutil
+    me = psutil.Process()
+    try:
+        workers = [p for p in psutil.Process(me.ppid()).children() if p.cmdline() == me.cmdline()]
+    except psutil.Error:
+        workers = [me]
+    index_root = str(INDEX_DIR.resolve())
+    out = []
+    for proc in sorted(workers or [me], key=lambda p: p.pid):
+        try:
+            entry = {"pid": proc.pid, "self": proc.pid == me.pid, "rss_bytes": proc.memory_info().rss,
+                     "index_rss_bytes": 0, "index_pss_bytes": 0, "snapshot_rss_bytes": 0}
+            for m in proc.memory_maps(grouped=True):
+                if not m.path.startswith(index_root):
+                    continue
+                entry["snapshot_rss_bytes"] += m.rss  # index, exact vectors, chunk store
+                if m.path.endswith(rag_index.INDEX_NAME):
+                    entry["index_rss_bytes"] += m.rss
+                    entry["index_pss_bytes"] += getattr(m, "pss", 0)
+        except psutil.Error:
+            continue
+        out.append(entry)
+    return out
+
+
 @app.get("/admin/health")
 def admin_system_health(admin: dict = Depends(require_admin)):
     import time
@@ -4747,24 +5665,40 @@ def admin_system_health(admin: dict = Depends(require_admin)):
     # vLLM health
     try:
         vllm_health_url = VLLM_URL.replace("/v1/chat/completions", "/health")
-        r = requests.get(vllm_health_url, timeout=3)
+        r = llm_clients.vllm.get(vllm_health_url, timeout=llm_clients.HEALTH_TIMEOUT)
         health["vllm"] = "ok" if r.status_code == 200 else f"status {r.status_code}"
     except Exception as e:
         health["vllm"] = f"error: {e}"
 
     # Ollama health
     try:
-        r = requests.get(f"{OLLAMA_BASE}/api/tags", timeout=3)
+        r = llm_clients.ollama.get(f"{OLLAMA_BASE}/api/tags", timeout=llm_clients.HEALTH_TIMEOUT)
         models = [m.get("name", "") for m in r.json().get("models", [])]
         health["ollama"] = "ok"
         health["ollama_models"] = models
     except Exception as e:
         health["ollama"] = f"error: {e}"
         health["ollama_models"] = []
+    health["llm_pools"] = llm_clients.stats()
 
     # RAG
     health["rag_available"] = RAG_AVAILABLE
-    health["rag_index_loaded"] = _faiss_index is not None
+    health["rag_index_loaded"] = _snapshot is not None
+    health["rag_index_version"] = _snapshot.version if _snapshot else None
+    health["rag_embed_backend"] = EMBED_BACKEND
+    health["rag_embed_cache"] = _embed_cache.stats()
+    health["rag_retrieval_cache"] = _retrieval_cache.stats()
+    health["rag_sentence_cache"] = _sentence_cache.stats()
+    health["intent_gate"] = _intent_gate_status()
+    health["moderation_prescreen"] = _prescreen_status()
+    health["rag_batcher"] = _retrieval_batcher.stats()
+    health["rag_text_cache"] = rag_index.text_cache.stats()
+    health["rag_index_mmap"] = bool(_snapshot and _snapshot.mmapped)
+    try:
+        health["rag_workers"] = _worker_memory()
+    except Exception as e:
+        health["rag_workers"] = []
+        health["rag_workers_error"] = f"error: {e}"
 
     # Disk
     import shutil
@@ -4824,7 +5758,7 @@ def admin_llm_latency_test(admin: dict = Depends(require_admin)):
     import time as _time
     start = _time.time()
     try:
-        r = requests.post(f"{OLLAMA_BASE}/api/generate", json={
+        r = llm_clients.ollama.post(f"{OLLAMA_BASE}/api/generate", json={
             "model": LLM_MODEL,
             "prompt": "Reply with the single word: ok",
             "stream": False,
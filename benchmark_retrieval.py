@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+Hopscotch Retrieval Benchmark — compare vector index variants on the real corpus.
+
+Embeds server/resources once, builds every index variant from those vectors and
+replays a query set against each: the LLM benchmark's TEST_PROMPTS plus
+questions labeled with the step whose resource guide should answer them.
+Reports, per variant, p50/p95 search time, recall@5 against exact (flat)
+search, how often the step guide makes the top 5 (with and without the step
+filter the chat uses), index size and build time; p50/p95 query-embedding
+time is reported once, since it does not depend on the index.
+
+Results are written as JSON. Pass --baseline with an earlier results file to
+flag regressions (exit status 1) after changing chunking or index settings.
+
+Usage:
+    python benchmark_retrieval.py
+    python benchmark_retrieval.py --variants flat hnsw ivf-pq --repeat 10
+    python benchmark_retrieval.py --backend onnx --baseline benchmark_retrieval.json --out new.json
+"""
+
+import argparse
+import json
+import platform
+import shutil
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import embedders
+import rag_index
+from benchmark_llm import TEST_PROMPTS
+from rag_index import EMBED_MODEL_NAME
+
+ROOT = Path(__file__).parent.resolve()
+DOCS_DIR = ROOT / "server" / "resources"
+DEFAULT_OUT = ROOT / "benchmark_retrieval.json"
+
+# name -> (index type, compression)
+VARIANTS = {
+    "flat": ("flat", "none"),
+    "hnsw": ("hnsw", "none"),
+    "ivf": ("ivf", "none"),
+    "flat-fp16": ("flat", "fp16"),
+    "hnsw-fp16": ("hnsw", "fp16"),
+    "ivf-pq": ("ivf", "pq"),
+}
+
+# Student questions and the step whose stepN_resource_database.txt covers them.
+STEP_QUESTIONS: List[Tuple[int, str]] = [
+    (1, "How does my personal background and positionality shape me as a researcher?"),
+    (1, "What is a research paradigm and which worldview fits me?"),
+    (2, "How do I turn a general interest into a researchable topic?"),
+    (2, "How can I narrow down what I am wondering about into a focused problem?"),
+    (3, "How do I search for and review the existing literature on my topic?"),
+    (3, "What is a theoretical or conceptual framework and how do I build one from prior studies?"),
+    (4, "Should I use a qualitative, quantitative or mixed methods design?"),
+    (4, "What research designs exist, like case study, experiment or ethnography?"),
+    (5, "How do I write a clear and focused research question?"),
+    (5, "What is the difference between a hypothesis and a research question?"),
+    (6, "What data should I collect: interviews, surveys, observations or documents?"),
+    (6, "How do I choose a sampling strategy and sample size for data collection?"),
+    (7, "How do I code and analyze qualitative interview transcripts?"),
+    (7, "Which statistical tests should I use to analyze my survey data?"),
+    (8, "How do I establish credibility, dependability and transferability?"),
+    (8, "What is triangulation and member checking?"),
+    (9, "How do I get informed consent and IRB approval for my study?"),
+    (9, "How do I protect participant confidentiality and avoid harm?"),
+]
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    return float(np.percentile(values, q)) if len(values) else 0.0
+
+
+def timing_summary(seconds: Sequence[float]) -> Dict[str, float]:
+    ms = [s * 1000 for s in seconds]
+    return {"p50_ms": round(percentile(ms, 50), 3), "p95_ms": round(percentile(ms, 95), 3),
+            "mean_ms": round(float(np.mean(ms)) if ms else 0.0, 3)}
+
+
+def embed_queries(embedder, queries: List[str], repeat: int) -> Tuple[np.ndarray, Dict[str, float]]:
+    """Embed each query on its own (as a chat request does), `repeat` times."""
+    times, vecs = [], []
+    embedder.encode(["warm-up"], convert_to_numpy=True, normalize_embeddings=True)
+    for q in queries:
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            v = embedder.encode([q], convert_to_numpy=True, normalize_embeddings=True)
+            times.append(time.perf_counter() - t0)
+        vecs.append(np.asarray(v, dtype="float32")[0])
+    return np.vstack(vecs), timing_summary(times)
+
+
+def run_variant(name: str, base: rag_index.Snapshot, qvecs: np.ndarray, steps: List[Optional[int]],
+                exact_ids: np.ndarray, guide_rows: Dict[int, set], repeat: int, k: int) -> Dict:
+    index_type, compression = VARIANTS[name]
+    vecs = base.vectors
+    t0 = time.perf_counter()
+    index, info = rag_index.build_vector_index(vecs, index_type, None, compression, min_recall=0.0)
+    build_seconds = time.perf_counter() - t0
+    snap = rag_index.Snapshot(version=name, path=base.path, index=index, chunks=base.chunks,
+                              manifest={"index": info}, vectors=vecs)
+
+    times, recalls, hits, hits_filtered = [], [], [], []
+    for qi, qv in enumerate(qvecs):
+        q = qv[None, :]
+        snap.search(q, k)  # warm-up
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            _, ids = snap.search(q, k)
+            times.append(time.perf_counter() - t0)
+        found = {int(i) for i in ids[0] if i >= 0}
+        recalls.append(len(found & {int(i) for i in exact_ids[qi]}) / max(1, min(k, len(vecs))))
+        step = steps[qi]
+        if step:
+            hits.append(bool(found & guide_rows[step]))
+            _, fids = snap.search(q, k, step=step)
+            hits_filtered.append(bool({int(i) for i in fids[0] if i >= 0} & guide_rows[step]))
+    return {
+        "variant": name,
+        "type": info["type"],
+        "compression": info["compression"],
+        "params": info["params"],
+        "build_seconds": round(build_seconds, 3),
+        "index_bytes": int(faiss_bytes(index)),
+        "search": timing_summary(times),
+        f"recall_at_{k}": round(float(np.mean(recalls)), 4),
+        f"step_hit_at_{k}": round(float(np.mean(hits)), 4) if hits else None,
+        f"step_hit_at_{k}_filtered": round(float(np.mean(hits_filtered)), 4) if hits_filtered else None,
+    }
+
+
+def faiss_bytes(index) -> int:
+    return len(rag_index.faiss.serialize_index(index))
+
+
+def benchmark(docs_dir: Path, embedder, backend: str, variants: List[str], repeat: int, k: int) -> Dict:
+    work = Path(tempfile.mkdtemp(prefix="hopscotch-bench-"))
+    try:
+        t0 = time.perf_counter()
+        base, stats = rag_index.build_snapshot(docs_dir, work, embedder, full=True, index_type="flat")
+        corpus_seconds = time.perf_counter() - t0
+        if not len(base.chunks):
+            raise SystemExit(f"No text extracted from {docs_dir}")
+        queries = list(TEST_PROMPTS) + [q for _, q in STEP_QUESTIONS]
+        steps: List[Optional[int]] = [None] * len(TEST_PROMPTS) + [s for s, _ in STEP_QUESTIONS]
+        qvecs, embed_timing = embed_queries(embedder, queries, repeat)
+        _, exact_ids = rag_index.exact_search(base.vectors, qvecs, k)
+        # Chunks of each step's resource guide (the label a step question should hit).
+        guide_rows: Dict[int, set] = {s: set() for s in range(1, 10)}
+        for i in range(len(base.chunks)):
+            for source in base.chunks.sources_of(i):
+                if source.lower().startswith("step") and source[4:5].isdigit():
+                    guide_rows.setdefault(int(source[4]), set()).add(i)
+        results = []
+        for name in variants:
+            print(f"  {name}...")
+            results.append(run_variant(name, base, qvecs, steps, exact_ids, guide_rows, repeat, k))
+        return {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "host": platform.node(),
+            "embedder": {"model": EMBED_MODEL_NAME, "backend": backend},
+            "corpus": {"docs_dir": str(docs_dir), "sources": stats["sources"], "chunks": stats["chunks"],
+                       "dim": int(base.vectors.shape[1]), "build_seconds": round(corpus_seconds, 3),
+                       "chunking": rag_index.build_params(EMBED_MODEL_NAME, embedders.describe(embedder))},
+            "queries": {"test_prompts": len(TEST_PROMPTS), "step_questions": len(STEP_QUESTIONS),
+                        "repeat": repeat, "k": k},
+            "embed": embed_timing,
+            "variants": results,
+        }
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def compare(report: Dict, baseline: Dict, k: int, recall_drop: float, slowdown: float) -> List[str]:
+    """Regressions of report against baseline, as readable lines."""
+    problems = []
+    before = {v["variant"]: v for v in baseline.get("variants", [])}
+    for v in report["variants"]:
+        old = before.get(v["variant"])
+        if old is None:
+            continue
+        for key in (f"recall_at_{k}", f"step_hit_at_{k}", f"step_hit_at_{k}_filtered"):
+            if v.get(key) is not None and old.get(key) is not None and v[key] < old[key] - recall_drop:
+                problems.append(f"{v['variant']}: {key} {old[key]} -> {v[key]}")
+        if old["search"]["p95_ms"] and v["search"]["p95_ms"] > old["search"]["p95_ms"] * slowdown:
+            problems.append(f"{v['variant']}: search p95 {old['search']['p95_ms']}ms -> {v['search']['p95_ms']}ms")
+    return problems
+
+
+def print_results_table(report: Dict, k: int):
+    print("\n" + "=" * 100)
+    print(f"{'Variant':<11} {'Build':<9} {'Size':<10} {'p50':<10} {'p95':<10} "
+          f"{'Recall@' + str(k):<10} {'Step hit':<10} {'Filtered':<10}")
+    print("=" * 100)
+    for v in report["variants"]:
+        hit, filt = v[f"step_hit_at_{k}"], v[f"step_hit_at_{k}_filtered"]
+        print(f"{v['variant']:<11} {v['build_seconds']:<9} {v['index_bytes'] / 1e6:<10.2f} "
+              f"{v['search']['p50_ms']:<10} {v['search']['p95_ms']:<10} {v[f'recall_at_{k}']:<10} "
+              f"{'N/A' if hit is None else hit:<10} {'N/A' if filt is None else filt:<10}")
+    print("=" * 100)
+    e = report["embed"]
+    print(f"Query embedding ({report['embedder']['backend']}): p50 {e['p50_ms']}ms, p95 {e['p95_ms']}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hopscotch Retrieval Benchmark")
+    parser.add_argument("--docs", default=str(DOCS_DIR), help="Docs directory (default: server/resources)")
+    parser.add_argument("--variants", nargs="+", default=list(VARIANTS), choices=list(VARIANTS),
+                        help="Index variants to build and query")
+    parser.add_argument("--backend", default=embedders.EMBED_BACKEND, choices=embedders.BACKENDS,
+                        help="Embedder backend (default: $RAG_EMBED_BACKEND or torch)")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per query")
+    parser.add_argument("-k", type=int, default=rag_index.RECALL_K, help="Passages retrieved per query")
+    parser.add_argument("--out", default=str(DEFAULT_OUT), help="Results file (JSON)")
+    parser.add_argument("--baseline", help="Earlier results file to check for regressions")
+    parser.add_argument("--max-recall-drop", type=float, default=0.02,
+                        help="Largest tolerated drop in recall / step hit rate vs the baseline")
+    parser.add_argument("--max-slowdown", type=float, default=1.5,
+                        help="Largest tolerated p95 search time ratio vs the baseline")
+    args = parser.parse_args()
+
+    if "flat" in args.variants:
+        args.variants = ["flat"] + [v for v in args.variants if v != "flat"]
+    print(f"Loading embedder: {EMBED_MODEL_NAME} ({args.backend})")
+    embedder = embedders.load_embedder(EMBED_MODEL_NAME, args.backend)
+    print(f"Building variants from {args.docs}")
+    report = benchmark(Path(args.docs).resolve(), embedder, args.backend, args.variants,
+                       max(1, args.repeat), args.k)
+    print_results_table(report, args.k)
+
+    problems = []
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        problems = compare(report, baseline, args.k, args.max_recall_drop, args.max_slowdown)
+        report["regressions"] = problems
+    Path(args.out).write_text(json.dumps(report, indent=2), encoding="utf-8")
+    print(f"\nDetailed results saved to {args.out}")
+    if problems:
+        print("\nRegressions vs baseline:")
+        for line in problems:
+            print(f"  {line}")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,142 +2,189 @@
 """
 Build a FAISS index from docs in server/resources and write to server/index.
 Supports .txt, .md, .pdf (pypdf with pdfminer fallback).
-Embeddings: sentence-transformers/all-MiniLM-L6-v2 (dim=384), normalized + Inner Product.
+Embeddings: sentence-transformers/all-MiniLM-L6-v2 (dim=384), normalized + Inner Product,
+computed with PyTorch or the int8 ONNX export (--backend onnx, see embedders.py).
+
+Rebuilds are incremental (see rag_index.py): only files added or changed since
+the last build are extracted and embedded. Use --full to re-embed everything.
+Each build is written to server/index/snapshots/<version>/ and published by
+swapping server/index/CURRENT.
 """
 
 from __future__ import annotations
-import argparse, json, re
+import argparse, logging
 from pathlib import Path
-from typing import List, Dict, Any
+
+import embedders
+import rag_index
+from rag_index import EMBED_MODEL_NAME
 
 # --- Paths relative to this file ---
 ROOT = Path(__file__).parent.resolve()
 DOCS_DIR = ROOT / "server" / "resources"
 INDEX_DIR = ROOT / "server" / "index"
 INDEX_DIR.mkdir(parents=True, exist_ok=True)
-INDEX_PATH = INDEX_DIR / "faiss.index"
-META_PATH  = INDEX_DIR / "chunks.json"
+INDEX_PATH = INDEX_DIR / rag_index.INDEX_NAME
 
 # --- Optional deps ---
-try:
-    import faiss  # faiss-cpu on Windows
-except Exception as e:
-    raise SystemExit("FAISS not installed. Run: pip install faiss-cpu") from e
-
-try:
-    from sentence_transformers import SentenceTransformer
-except Exception as e:
-    raise SystemExit("sentence-transformers not installed. Run: pip install sentence-transformers") from e
-
-try:
-    from pypdf import PdfReader
-except Exception:
-    PdfReader = None
-
-try:
-    from pdfminer.high_level import extract_text as pdfminer_extract_text
-except Exception:
-    pdfminer_extract_text = None
-
-EMBED_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
-
-def read_txt(p: Path) -> str:
-    return p.read_text(encoding="utf-8", errors="ignore")
-
-def read_md(p: Path) -> str:
-    return p.read_text(encoding="utf-8", errors="ignore")
-
-def read_pdf(p: Path) -> str:
-    txt = ""
-    if PdfReader is not None:
-        try:
-            reader = PdfReader(str(p))
-            txt = "\n".join((page.extract_text() or "") for page in reader.pages)
-        except Exception:
-            txt = ""
-    if (not txt or not txt.strip()) and pdfminer_extract_text is not None:
-        try:
-            txt = pdfminer_extract_text(str(p)) or ""
-        except Exception:
-            txt = ""
-    return txt
-
-def load_docs(dirpath: Path) -> List[Dict[str, str]]:
-    docs: List[Dict[str, str]] = []
-    if not dirpath.exists():
-        return docs
-    for p in sorted(dirpath.glob("**/*")):
-        if not p.is_file(): 
-            continue
-        ext = p.suffix.lower()
-        try:
-            if ext == ".txt":
-                docs.append({"source": p.name, "text": read_txt(p)})
-            elif ext in (".md", ".markdown"):
-                docs.append({"source": p.name, "text": read_md(p)})
-            elif ext == ".pdf":
-                docs.append({"source": p.name, "text": read_pdf(p)})
-        except Exception:
-            # skip unreadable files
-            continue
-    return docs
-
-def chunk_text(text: str, max_chars: int = 2400, overlap: int = 400) -> List[str]:
-    text = re.sub(r"\s+", " ", text or "").strip()
-    if not text:
-        return []
-    step = max(1, max_chars - overlap)
-    return [text[i:i+max_chars] for i in range(0, len(text), step)]
+if rag_index.faiss is None:
+    raise SystemExit("FAISS not installed. Run: pip install faiss-cpu")
+
+# Chunks compared by the torch/ONNX parity check.
+PARITY_SAMPLE = 64
+
+
+def _parity_texts(docs_dir: Path, n: int = PARITY_SAMPLE):
+    chunks = [c for d in rag_index.load_docs(docs_dir) for c in rag_index.chunk_text(d["text"])]
+    if len(chunks) <= n:
+        return chunks
+    step = len(chunks) / n
+    return [chunks[int(i * step)] for i in range(n)]
+
+
+def check_embedder(docs_dir: Path, tolerance: float) -> bool:
+    texts = _parity_texts(docs_dir)
+    if not texts:
+        print("[create_index] Parity check skipped: no text extracted from docs.")
+        return True
+    report = embedders.parity_report(EMBED_MODEL_NAME, texts, tolerance)
+    print(f"[create_index] ONNX vs torch over {report['texts']} chunks: "
+          f"mean cosine drift {report['mean_drift']:.5f}, max {report['max_drift']:.5f} "
+          f"(tolerance {tolerance})")
+    return report["ok"]
+
 
 def main():
     ap = argparse.ArgumentParser(description="Build FAISS index for IRML resources")
     ap.add_argument("-d", "--docs", default=str(DOCS_DIR), help="Docs directory (default: server/resources)")
     ap.add_argument("-o", "--out",  default=str(INDEX_DIR), help="Index directory (default: server/index)")
     ap.add_argument("--rebuild", action="store_true", help="Force rebuild (ignore existing files)")
+    ap.add_argument("--full", action="store_true",
+                    help="With --rebuild: ignore the manifest and re-embed every file")
+    ap.add_argument("--index-type", default="auto", choices=("auto",) + rag_index.INDEX_TYPES,
+                    help="Vector index type (default: auto, picked from the chunk count)")
+    ap.add_argument("--nlist", type=int, help="IVF: number of inverted lists")
+    ap.add_argument("--nprobe", type=int, help="IVF: lists probed per query")
+    ap.add_argument("--ef-search", type=int, help="HNSW: efSearch (query-time beam width)")
+    ap.add_argument("--compression", default="none", choices=rag_index.COMPRESSIONS,
+                    help="Vector storage: none, fp16 (scalar quantization) or pq (product quantization)")
+    ap.add_argument("--pq-m", type=int, help="PQ: sub-quantizers per vector (must divide the dimension)")
+    ap.add_argument("--rerank", type=int,
+                    help="Compressed indexes: re-rank RERANK x k candidates against exact vectors (0 = off)")
+    ap.add_argument("--extract-workers", type=int, default=rag_index.EXTRACT_WORKERS,
+                    help="Processes extracting PDF text (default: $RAG_EXTRACT_WORKERS or one per core)")
+    ap.add_argument("--embed-workers", type=int, default=rag_index.EMBED_WORKERS,
+                    help="Concurrent embedding batches (default: $RAG_EMBED_WORKERS or 1)")
+    ap.add_argument("--embed-batch", type=int, default=rag_index.EMBED_BATCH,
+                    help="Chunks per embedding batch (default: $RAG_EMBED_BATCH or 64)")
+    ap.add_argument("--no-dedupe", action="store_true",
+                    help="Index duplicate files and near-duplicate chunks separately")
+    ap.add_argument("--backend", default=embedders.EMBED_BACKEND, choices=embedders.BACKENDS,
+                    help="Embedder backend (default: $RAG_EMBED_BACKEND or torch)")
+    ap.add_argument("--export-onnx", action="store_true",
+                    help=f"Write the int8 ONNX embedder to {embedders.ONNX_MODEL_DIR} and exit")
+    ap.add_argument("--check-embedder", action="store_true",
+                    help="Compare ONNX and torch embeddings on the docs and exit")
+    ap.add_argument("--parity-tol", type=float, default=embedders.PARITY_TOLERANCE,
+                    help="Largest acceptable 1 - cosine between ONNX and torch vectors")
+    ap.add_argument("--convert-chunks", metavar="DIR",
+                    help="Convert DIR/chunks.json to the binary chunk store and exit")
     args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO, format="[create_index] %(message)s")
 
     docs_dir = Path(args.docs).resolve()
     out_dir  = Path(args.out).resolve()
     out_dir.mkdir(parents=True, exist_ok=True)
-    index_path = out_dir / "faiss.index"
-    meta_path  = out_dir / "chunks.json"
+    current = rag_index.current_snapshot_dir(out_dir)
+    index_path = current / rag_index.INDEX_NAME
 
-    if index_path.exists() and meta_path.exists() and not args.rebuild:
-        print(f"[create_index] Index already exists at {index_path}. Use --rebuild to force.")
+    if args.convert_chunks:
+        rag_index.convert_chunks_json(Path(args.convert_chunks).resolve())
+        print("[create_index] DONE ✅")
         return
 
-    print(f"[create_index] Loading documents from: {docs_dir}")
-    docs = load_docs(docs_dir)
-    print(f"[create_index] Loaded {len(docs)} documents")
+    if args.export_onnx:
+        print(f"[create_index] Exported {embedders.export_onnx(EMBED_MODEL_NAME)}")
+        return
 
-    chunks: List[Dict[str, Any]] = []
-    for d in docs:
-        for piece in chunk_text(d["text"]):
-            chunks.append({"text": piece, "source": d["source"]})
+    if args.check_embedder or args.backend == "onnx":
+        if not (embedders.backend_available("torch") and embedders.backend_available("onnx")):
+            if args.check_embedder:
+                raise SystemExit("[create_index] Parity check needs both sentence-transformers and onnxruntime.")
+            print("[create_index] sentence-transformers not installed; skipping the ONNX parity check.")
+        elif not check_embedder(docs_dir, args.parity_tol):
+            raise SystemExit("[create_index] ONNX embeddings drift too far from torch; not using them.")
+        if args.check_embedder:
+            print("[create_index] DONE ✅")
+            return
+
+    if not embedders.backend_available(args.backend):
+        hint = "onnxruntime tokenizers" if args.backend == "onnx" else "sentence-transformers"
+        raise SystemExit(f"{args.backend} embedder not installed. Run: pip install {hint}")
+
+    if index_path.exists() and rag_index.has_chunks(current) and not args.rebuild:
+        print(f"[create_index] Index already exists at {index_path}. Use --rebuild to force.")
+        return
 
+    print(f"[create_index] Loading documents from: {docs_dir}")
+    print(f"[create_index] Loading embedder: {EMBED_MODEL_NAME} ({args.backend})")
+    embedder = embedders.load_embedder(EMBED_MODEL_NAME, args.backend)
+
+    overrides = {"nlist": args.nlist, "nprobe": args.nprobe, "efSearch": args.ef_search,
+                 "pq_m": args.pq_m, "rerank": args.rerank}
+    lock = rag_index.BuildLock(out_dir)
+    if not lock.acquire():
+        raise SystemExit(f"[create_index] Another build is running in {out_dir} (the server's rebuild job?). "
+                         "Try again when it finishes.")
+    try:
+        snapshot, stats = rag_index.build_snapshot(docs_dir, out_dir, embedder,
+                                                   model_name=EMBED_MODEL_NAME, full=args.full,
+                                                   index_type=args.index_type,
+                                                   index_params={k: v for k, v in overrides.items() if v is not None},
+                                                   compression=args.compression,
+                                                   extract_workers=args.extract_workers,
+                                                   embed_workers=args.embed_workers,
+                                                   embed_batch=args.embed_batch,
+                                                   dedupe=rag_index.DEDUPE and not args.no_dedupe)
+    finally:
+        lock.release()
+    chunks = snapshot.chunks
     if not chunks:
         raise SystemExit("[create_index] No text extracted from docs. Ensure server/resources has readable .pdf/.txt/.md files.")
 
-    texts = [c["text"] for c in chunks]
-    print(f"[create_index] Total chunks: {len(texts)}")
-
-    print("[create_index] Loading embedder:", EMBED_MODEL_NAME)
-    embedder = SentenceTransformer(EMBED_MODEL_NAME)
-    vecs = embedder.encode(texts, convert_to_numpy=True, normalize_embeddings=True)
-    dim = vecs.shape[1]
-    print(f"[create_index] Embedding dim: {dim}, vectors: {vecs.shape[0]}")
-
-    print("[create_index] Building FAISS index (Inner Product)...")
-    index = faiss.IndexFlatIP(dim)
-    index.add(vecs)
-
-    print(f"[create_index] Writing index -> {index_path}")
-    faiss.write_index(index, str(index_path))
-
-    print(f"[create_index] Writing chunks metadata -> {meta_path}")
-    meta = [{"id": i, "text": c["text"], "source": c["source"]} for i, c in enumerate(chunks)]
-    meta_path.write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
-
+    print(f"[create_index] Total chunks: {len(chunks)} ({stats['embedded_chunks']} embedded this run)")
+    for label in ("added", "changed", "removed"):
+        if stats[label]:
+            print(f"[create_index] {label.capitalize()}: {', '.join(stats[label])}")
+    dups = stats["duplicates"]
+    for f in dups["files"]:
+        print(f"[create_index] Duplicate: {f['name']} (same bytes as {f['duplicate_of']})")
+    for f in dups["collapsed"]:
+        print(f"[create_index] Collapsed: {f['chunks']} near-duplicate chunks of {f['source']} "
+              f"into {', '.join(f['into'])}")
+    for f in dups["repeated"]:
+        print(f"[create_index] Repeated: {f['chunks']} near-duplicate chunks within {f['source']} stored once")
+    ingest = stats["ingest"]
+    if ingest["files"]:
+        ex, ch, em = ingest["extract"], ingest["chunk"], ingest["embed"]
+        print(f"[create_index] Extract: {ingest['files']} files in {ex['seconds']}s of worker time "
+              f"({ex['workers']} processes, {ex['files_per_sec']} files/s)")
+        print(f"[create_index] Chunk:   {ingest['chunks']} chunks in {ch['seconds']}s")
+        print(f"[create_index] Embed:   {em['seconds']}s ({em['workers']} x batch {em['batch']}, "
+              f"{em['chunks_per_sec']} chunks/s); pipeline wall time {ingest['wall_seconds']}s")
+        for f in ingest["slowest_files"][:3]:
+            print(f"[create_index]   slowest: {f['source']} {f['seconds']}s")
+    info = stats["index"]
+    if "rejected" in info:
+        print(f"[create_index] {info['rejected']['type']} index recall too low "
+              f"({info['rejected'].get('recall_at_5')}); fell back to flat")
+    else:
+        print(f"[create_index] Index type: {info['type']} ({info['compression']}) {info['params'] or ''}"
+              + (f" recall@5={info['recall_at_5']}" if "recall_at_5" in info else ""))
+    print(f"[create_index] Index size: {info['bytes'] / 1e6:.1f} MB "
+          f"(exact vectors: {info['exact_bytes'] / 1e6:.1f} MB)")
+    print(f"[create_index] Published snapshot {snapshot.version} -> {snapshot.path}")
+    print("[create_index] Running servers pick it up within a few seconds; no restart needed.")
     print("[create_index] DONE ✅")
 
 if __name__ == "__main__":
@@ -0,0 +1,176 @@
+# embedders.py — sentence-embedding backends shared by app_chat.py and create_index.py
+"""
+Two interchangeable backends produce the normalized all-MiniLM-L6-v2 vectors
+the RAG index is built from:
+
+  torch  sentence-transformers on PyTorch (the reference implementation)
+  onnx   an int8-quantized ONNX export run with onnxruntime + tokenizers;
+         never imports torch, so workers start fast and stay small
+
+Pick one with RAG_EMBED_BACKEND. Both expose the subset of the
+SentenceTransformer API the rest of the code uses: encode(...) and
+get_sentence_embedding_dimension(). Because the ONNX export only approximates
+the torch weights, `create_index.py --check-embedder` measures the cosine
+drift between the two on real chunks before the ONNX backend is relied on.
+
+The ONNX model is read from ONNX_MODEL_DIR (model_int8.onnx + tokenizer.json),
+written by `create_index.py --export-onnx`. If that directory is missing, the
+pre-quantized export published with the model on the Hugging Face hub is used.
+"""
+
+from __future__ import annotations
+
+import importlib.util
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import List, Optional, Sequence, Union
+
+import numpy as np
+
+try:
+    import onnxruntime as ort  # type: ignore
+except Exception:
+    ort = None
+
+try:
+    from tokenizers import Tokenizer  # type: ignore
+except Exception:
+    Tokenizer = None
+
+try:
+    from huggingface_hub import hf_hub_download  # type: ignore
+except Exception:
+    hf_hub_download = None
+
+logger = logging.getLogger("uvicorn.error")
+
+BACKENDS = ("torch", "onnx")
+EMBED_BACKEND = os.environ.get("RAG_EMBED_BACKEND", "torch").strip().lower()
+ONNX_MODEL_DIR = Path(os.environ.get(
+    "RAG_ONNX_MODEL_DIR", Path(__file__).parent.resolve() / "server" / "models" / "minilm-int8"))
+ONNX_MODEL_FILE = "model_int8.onnx"
+# Fallbacks on the hub when ONNX_MODEL_DIR has not been exported.
+HUB_ONNX_FP32 = "onnx/model.onnx"
+HUB_ONNX_INT8 = "onnx/model_quint8_avx2.onnx"
+ONNX_THREADS = int(os.environ.get("RAG_ONNX_THREADS", "0"))  # 0 = onnxruntime default
+# all-MiniLM-L6-v2 was trained on at most 256 word pieces (sentence-transformers' max_seq_length).
+MAX_SEQ_LENGTH = 256
+# Largest acceptable 1 - cosine between the torch and ONNX vector of a text.
+PARITY_TOLERANCE = 0.02
+
+
+def backend_available(backend: str = EMBED_BACKEND) -> bool:
+    if backend == "onnx":
+        return ort is not None and Tokenizer is not None
+    # Checked without importing: sentence-transformers drags in torch.
+    return importlib.util.find_spec("sentence_transformers") is not None
+
+
+class OnnxEmbedder:
+    """Mean-pooled MiniLM sentence embeddings from an ONNX graph."""
+
+    def __init__(self, model_name: str, model_dir: Path = ONNX_MODEL_DIR,
+                 max_seq_length: int = MAX_SEQ_LENGTH, threads: int = ONNX_THREADS):
+        if ort is None or Tokenizer is None:
+            raise RuntimeError("onnxruntime and tokenizers are required for the onnx embedder")
+        model_path = model_dir / ONNX_MODEL_FILE
+        tokenizer_path = model_dir / "tokenizer.json"
+        if not model_path.exists() or not tokenizer_path.exists():
+            if hf_hub_download is None:
+                raise RuntimeError(f"{model_path} not found; run create_index.py --export-onnx")
+            logger.info("%s not found; using %s from the hub", model_path, HUB_ONNX_INT8)
+            model_path = Path(hf_hub_download(model_name, HUB_ONNX_INT8))
+            tokenizer_path = Path(hf_hub_download(model_name, "tokenizer.json"))
+        self.model_name = model_name
+        self.model_path = model_path
+        self.tokenizer = Tokenizer.from_file(str(tokenizer_path))
+        self.tokenizer.enable_truncation(max_length=max_seq_length)
+        self.tokenizer.enable_padding()
+        opts = ort.SessionOptions()
+        if threads:
+            opts.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(str(model_path), sess_options=opts,
+                                            providers=["CPUExecutionProvider"])
+        self._input_names = {i.name for i in self.session.get_inputs()}
+        self._dim = int(self.encode(["dimension probe"]).shape[1])
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self._dim
+
+    def encode(self, sentences: Union[str, Sequence[str]], batch_size: int = 32,
+               convert_to_numpy: bool = True, normalize_embeddings: bool = False,
+               show_progress_bar: bool = False, **_ignored) -> np.ndarray:
+        single = isinstance(sentences, str)
+        texts: List[str] = [sentences] if single else list(sentences)
+        out = []
+        for at in range(0, len(texts), batch_size):
+            encodings = self.tokenizer.encode_batch(texts[at: at + batch_size])
+            ids = np.array([e.ids for e in encodings], dtype="int64")
+            mask = np.array([e.attention_mask for e in encodings], dtype="int64")
+            feeds = {"input_ids": ids, "attention_mask": mask,
+                     "token_type_ids": np.array([e.type_ids for e in encodings], dtype="int64")}
+            hidden = self.session.run(None, {k: v for k, v in feeds.items() if k in self._input_names})[0]
+            weights = mask[..., None].astype("float32")
+            pooled = (hidden * weights).sum(axis=1) / np.clip(weights.sum(axis=1), 1e-9, None)
+            out.append(pooled.astype("float32"))
+        vecs = np.vstack(out) if out else np.zeros((0, getattr(self, "_dim", 0)), dtype="float32")
+        if normalize_embeddings:
+            vecs /= np.clip(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-12, None)
+        return vecs[0] if single else vecs
+
+
+def load_embedder(model_name: str, backend: str = EMBED_BACKEND):
+    """The embedder for backend ("torch" or "onnx")."""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown embedder backend {backend!r}; expected one of {BACKENDS}")
+    if backend == "onnx":
+        return OnnxEmbedder(model_name)
+    try:
+        from sentence_transformers import SentenceTransformer  # type: ignore
+    except Exception as e:
+        raise RuntimeError("sentence-transformers is not installed") from e
+    return SentenceTransformer(model_name)
+
+
+def export_onnx(model_name: str, out_dir: Path = ONNX_MODEL_DIR) -> Path:
+    """Download the model's fp32 ONNX graph and write an int8 (dynamic
+    quantization) copy plus its tokenizer to out_dir."""
+    if hf_hub_download is None or ort is None:
+        raise RuntimeError("huggingface_hub and onnxruntime are required to export the ONNX model")
+    from onnxruntime.quantization import QuantType, quantize_dynamic  # type: ignore
+
+    out_dir.mkdir(parents=True, exist_ok=True)
+    fp32 = hf_hub_download(model_name, HUB_ONNX_FP32)
+    shutil.copyfile(hf_hub_download(model_name, "tokenizer.json"), out_dir / "tokenizer.json")
+    target = out_dir / ONNX_MODEL_FILE
+    quantize_dynamic(fp32, str(target), weight_type=QuantType.QInt8)
+    return target
+
+
+def cosine_drift(reference, candidate, texts: Sequence[str]) -> np.ndarray:
+    """1 - cosine between the two embedders' normalized vectors, per text."""
+    a = reference.encode(list(texts), convert_to_numpy=True, normalize_embeddings=True)
+    b = candidate.encode(list(texts), convert_to_numpy=True, normalize_embeddings=True)
+    return 1.0 - np.sum(np.asarray(a, dtype="float32") * np.asarray(b, dtype="float32"), axis=1)
+
+
+def parity_report(model_name: str, texts: Sequence[str],
+                  tolerance: float = PARITY_TOLERANCE) -> dict:
+    """Compare the ONNX backend against torch on texts."""
+    drift = cosine_drift(load_embedder(model_name, "torch"), load_embedder(model_name, "onnx"), texts)
+    return {
+        "texts": len(texts),
+        "mean_drift": float(drift.mean()) if len(drift) else 0.0,
+        "max_drift": float(drift.max()) if len(drift) else 0.0,
+        "tolerance": tolerance,
+        "ok": bool(len(drift) and drift.max() <= tolerance),
+    }
+
+
+def describe(embedder) -> Optional[str]:
+    """Short backend label for status endpoints."""
+    if embedder is None:
+        return None
+    return "onnx" if isinstance(embedder, OnnxEmbedder) else "torch"
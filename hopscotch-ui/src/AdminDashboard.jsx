@@ -282,6 +282,7 @@ export default function AdminDashboard() {
   const [resourcesLoading, setResourcesLoading] = useState(false);
   const [uploadingResource, setUploadingResource] = useState(false);
   const [rebuildingIndex, setRebuildingIndex] = useState(false);
+  const [rebuildProgress, setRebuildProgress] = useState(0);
   const [resourceMsg, setResourceMsg] = useState("");
   const resourceFileRef = useRef(null);
 
@@ -463,8 +464,16 @@ export default function AdminDashboard() {
   async function handleRebuildIndex() {
     setResourceMsg("");
     setRebuildingIndex(true);
+    setRebuildProgress(0);
     try {
-      const r = await API.adminResourcesRebuild();
+      let { job } = await API.adminResourcesRebuild();
+      while (job.status === "queued" || job.status === "running") {
+        await new Promise((resolve) => setTimeout(resolve, 1500));
+        job = await API.adminResourcesRebuildStatus(job.id);
+        setRebuildProgress(Math.round((job.progress || 0) * 100));
+      }
+      if (job.status === "failed") throw new Error(job.error || t("ad.actionFailed"));
+      const r = job.stats || {};
       setResourceMsg(t(r.sources === 1 ? "ad.res.rebuiltOne" : "ad.res.rebuilt", { sources: r.sources, chunks: r.chunks }));
       loadResources();
     } catch (err) { setResourceMsg(err.message); }
@@ -2158,11 +2167,17 @@ export default function AdminDashboard() {
                   ) : (
                     <span><strong>{t("ad.res.upToDateBold")}</strong> {t(resourceIndex.sources === 1 ? "ad.res.indexSummaryOne" : "ad.res.indexSummary", { sources: resourceIndex.sources, chunks: resourceIndex.total_chunks })}</span>
                   )}
+                  {resourceIndex.duplicates && (resourceIndex.duplicates.files.length > 0 || resourceIndex.duplicates.chunks_collapsed > 0) && (
+                    <span className="ad-res__dot">· {t("ad.res.dedupeSummary", { files: resourceIndex.duplicates.files.length, chunks: resourceIndex.duplicates.chunks_collapsed })}</span>
+                  )}
+                  {resourceIndex.text_cache && (
+                    <span className="ad-res__dot">· {t("ad.res.textCache", { hits: resourceIndex.text_cache.hits, misses: resourceIndex.text_cache.misses, entries: resourceIndex.text_cache.entries })}</span>
+                  )}
                 </div>
               )}
 
               {resourceMsg && <div className="ad-res__msg">{resourceMsg}</div>}
-              {rebuildingIndex && <div className="ad-res__msg">{t("ad.res.reembedding")}</div>}
+              {rebuildingIndex && <div className="ad-res__msg">{t("ad.res.reembedding", { pct: rebuildProgress })}</div>}
 
               {resourcesLoading && <div className="ad-loading">{t("ad.res.loadingDocs")}</div>}
 
@@ -2187,6 +2202,30 @@ export default function AdminDashboard() {
                         {f.indexed
                           ? <span className="ad-res__indexed">{t(f.chunks === 1 ? "ad.res.chunksIndexedOne" : "ad.res.chunksIndexed", { n: f.chunks })}</span>
                           : <span className="ad-res__pending">{t("ad.res.notIndexed")}</span>}
+                        {f.extract_seconds != null && (
+                          <>
+                            <span className="ad-res__dot">·</span>
+                            <span title={t("ad.res.extractTimeHint")}>{t("ad.res.extractTime", { s: f.extract_seconds.toFixed(1) })}</span>
+                          </>
+                        )}
+                        {f.duplicate_of && (
+                          <>
+                            <span className="ad-res__dot">·</span>
+                            <span title={t("ad.res.duplicateHint")}>{t("ad.res.duplicateOf", { name: f.duplicate_of })}</span>
+                          </>
+                        )}
+                        {f.collapsed_chunks > 0 && (
+                          <>
+                            <span className="ad-res__dot">·</span>
+                            <span title={t("ad.res.collapsedHint")}>{t("ad.res.collapsed", { n: f.collapsed_chunks, names: f.collapsed_into.join(", ") })}</span>
+                          </>
+                        )}
+                        {f.repeated_chunks > 0 && (
+                          <>
+                            <span className="ad-res__dot">·</span>
+                            <span title={t("ad.res.repeatedHint")}>{t("ad.res.repeated", { n: f.repeated_chunks })}</span>
+                          </>
+                        )}
                       </div>
                     </div>
                     <div className="ad-res__actions">
@@ -2394,6 +2433,22 @@ export default function AdminDashboard() {
                     items={[
                       { label: t("ad.health.available"), value: health.rag_available ? t("ad.yes") : t("ad.no") },
                       { label: t("ad.health.indexLoaded"), value: health.rag_index_loaded ? t("ad.yes") : t("ad.no") },
+                      ...(health.rag_embed_cache ? [{
+                        label: t("ad.health.embedCache"),
+                        value: t("ad.health.cacheHits", {
+                          rate: Math.round(health.rag_embed_cache.hit_rate * 100),
+                          hits: health.rag_embed_cache.hits,
+                          total: health.rag_embed_cache.hits + health.rag_embed_cache.misses,
+                        }),
+                      }] : []),
+                      ...(health.rag_retrieval_cache ? [{
+                        label: t("ad.health.retrievalCache"),
+                        value: t("ad.health.cacheHits", {
+                          rate: Math.round(health.rag_retrieval_cache.hit_rate * 100),
+                          hits: health.rag_retrieval_cache.hits,
+                          total: health.rag_retrieval_cache.hits + health.rag_retrieval_cache.misses,
+                        }),
+                      }] : []),
                     ]}
                   />
                   <HealthCard
@@ -853,6 +853,15 @@ export const API = {
     return res.json();
   },
 
+  // Rebuilds run in the background; poll this with the job id from adminResourcesRebuild.
+  async adminResourcesRebuildStatus(jobId) {
+    const res = await fetch(`${API_BASE}/admin/resources/rebuild/${encodeURIComponent(jobId)}`, {
+      headers: authHeaders(),
+    });
+    if (!res.ok) throw new Error(`Failed to load rebuild status: ${res.status}`);
+    return res.json();
+  },
+
   // View (open in a new tab) or download a KB file - both need the auth header,
   // so fetch as a blob rather than linking to the URL directly.
   async adminResourceOpen(name, { download = false } = {}) {
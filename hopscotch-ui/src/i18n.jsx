@@ -959,13 +959,23 @@ const LOCALES = {
     "ad.res.upToDateBold": "Up to date.",
     "ad.res.indexSummaryOne": "{sources} document · {chunks} chunks indexed.",
     "ad.res.indexSummary": "{sources} documents · {chunks} chunks indexed.",
-    "ad.res.reembedding": "Re-embedding all documents… this can take up to a minute.",
+    "ad.res.reembedding": "Rebuilding in the background ({pct}%)… the assistant keeps using the current knowledge base until it finishes.",
     "ad.res.loadingDocs": "Loading documents…",
     "ad.res.documents": "Documents",
     "ad.res.emptyDocs": "No documents yet. Upload a PDF, TXT, or Markdown file.",
     "ad.res.chunksIndexedOne": "{n} chunk indexed",
     "ad.res.chunksIndexed": "{n} chunks indexed",
     "ad.res.notIndexed": "not yet indexed",
+    "ad.res.extractTime": "extracted in {s}s",
+    "ad.res.extractTimeHint": "Time the last text extraction of this file took",
+    "ad.res.textCache": "Text cache: {entries} files · {hits} hits · {misses} misses",
+    "ad.res.duplicateOf": "duplicate of {name}",
+    "ad.res.duplicateHint": "Byte-identical to another file; indexed once under both names",
+    "ad.res.collapsed": "{n} near-duplicate chunks merged into {names}",
+    "ad.res.collapsedHint": "Passages nearly identical to ones already indexed are stored once and cite every file they appear in",
+    "ad.res.repeated": "{n} repeated chunks within the file stored once",
+    "ad.res.repeatedHint": "Passages that recur inside this file, such as running headers or boilerplate, are indexed once",
+    "ad.res.dedupeSummary": "Deduplicated: {files} identical files · {chunks} near-duplicate chunks",
     "ad.res.download": "Download",
     "ad.res.uploaded": "Uploaded “{name}”. Rebuild the knowledge base to apply it.",
     "ad.res.deleteConfirm": "Delete “{name}” from the knowledge base? Rebuild afterward to apply.",
@@ -1012,6 +1022,9 @@ const LOCALES = {
     "ad.health.ragSystem": "RAG System",
     "ad.health.available": "Available",
     "ad.health.indexLoaded": "Index Loaded",
+    "ad.health.embedCache": "Query embedding cache",
+    "ad.health.retrievalCache": "Retrieval cache",
+    "ad.health.cacheHits": "{rate}% hits ({hits} of {total})",
     "ad.health.disk": "Disk Space",
     "ad.health.free": "Free",
     "ad.health.gbOf": "{free} GB of {total} GB",
@@ -1967,13 +1980,23 @@ const LOCALES = {
     "ad.res.upToDateBold": "Al día.",
     "ad.res.indexSummaryOne": "{sources} documento · {chunks} fragmentos indexados.",
     "ad.res.indexSummary": "{sources} documentos · {chunks} fragmentos indexados.",
-    "ad.res.reembedding": "Reindexando todos los documentos… esto puede tardar hasta un minuto.",
+    "ad.res.reembedding": "Reconstruyendo en segundo plano ({pct}%)… el asistente sigue usando la base de conocimiento actual hasta que termine.",
     "ad.res.loadingDocs": "Cargando documentos…",
     "ad.res.documents": "Documentos",
     "ad.res.emptyDocs": "Aún no hay documentos. Sube un archivo PDF, TXT o Markdown.",
     "ad.res.chunksIndexedOne": "{n} fragmento indexado",
     "ad.res.chunksIndexed": "{n} fragmentos indexados",
     "ad.res.notIndexed": "aún sin indexar",
+    "ad.res.extractTime": "extraído en {s}s",
+    "ad.res.extractTimeHint": "Tiempo que tardó la última extracción de texto de este archivo",
+    "ad.res.textCache": "Caché de texto: {entries} archivos · {hits} aciertos · {misses} fallos",
+    "ad.res.duplicateOf": "duplicado de {name}",
+    "ad.res.duplicateHint": "Idéntico byte a byte a otro archivo; se indexa una vez con ambos nombres",
+    "ad.res.collapsed": "{n} fragmentos casi duplicados fusionados en {names}",
+    "ad.res.collapsedHint": "Los pasajes casi idénticos a otros ya indexados se guardan una vez y citan todos los archivos donde aparecen",
+    "ad.res.repeated": "{n} fragmentos repetidos dentro del archivo guardados una vez",
+    "ad.res.repeatedHint": "Los pasajes que se repiten dentro de este archivo, como encabezados o texto estándar, se indexan una sola vez",
+    "ad.res.dedupeSummary": "Deduplicado: {files} archivos idénticos · {chunks} fragmentos casi duplicados",
     "ad.res.download": "Descargar",
     "ad.res.uploaded": "Se subió «{name}». Reconstruye la base de conocimiento para aplicarlo.",
     "ad.res.deleteConfirm": "¿Eliminar «{name}» de la base de conocimiento? Reconstruye después para aplicar.",
@@ -2020,6 +2043,9 @@ const LOCALES = {
     "ad.health.ragSystem": "Sistema RAG",
     "ad.health.available": "Disponible",
     "ad.health.indexLoaded": "Índice cargado",
+    "ad.health.embedCache": "Caché de embeddings de consultas",
+    "ad.health.retrievalCache": "Caché de recuperación",
+    "ad.health.cacheHits": "{rate}% de aciertos ({hits} de {total})",
     "ad.health.disk": "Espacio en disco",
     "ad.health.free": "Libre",
     "ad.health.gbOf": "{free} GB de {total} GB",
@@ -2969,13 +2995,23 @@ const LOCALES = {
     "ad.res.upToDateBold": "已是最新。",
     "ad.res.indexSummaryOne": "已索引 {sources} 份文档 · {chunks} 个文本块。",
     "ad.res.indexSummary": "已索引 {sources} 份文档 · {chunks} 个文本块。",
-    "ad.res.reembedding": "正在重新嵌入所有文档…最多可能需要一分钟。",
+    "ad.res.reembedding": "正在后台重建（{pct}%）…完成前助手会继续使用当前的知识库。",
     "ad.res.loadingDocs": "正在加载文档…",
     "ad.res.documents": "文档",
     "ad.res.emptyDocs": "暂无文档。请上传 PDF、TXT 或 Markdown 文件。",
     "ad.res.chunksIndexedOne": "已索引 {n} 个文本块",
     "ad.res.chunksIndexed": "已索引 {n} 个文本块",
     "ad.res.notIndexed": "尚未索引",
+    "ad.res.extractTime": "提取耗时 {s} 秒",
+    "ad.res.extractTimeHint": "该文件上次文本提取所用的时间",
+    "ad.res.textCache": "文本缓存：{entries} 个文件 · 命中 {hits} · 未命中 {misses}",
+    "ad.res.duplicateOf": "与 {name} 重复",
+    "ad.res.duplicateHint": "与另一文件逐字节相同；以两个文件名索引一次",
+    "ad.res.collapsed": "{n} 个近似重复片段已合并到 {names}",
+    "ad.res.collapsedHint": "与已索引内容几乎相同的段落只存储一次，并引用其出现的所有文件",
+    "ad.res.repeated": "文件内 {n} 个重复片段只存储一次",
+    "ad.res.repeatedHint": "在此文件中反复出现的段落（如页眉或模板文字）只索引一次",
+    "ad.res.dedupeSummary": "已去重：{files} 个相同文件 · {chunks} 个近似重复片段",
     "ad.res.download": "下载",
     "ad.res.uploaded": "已上传“{name}”。重建知识库后生效。",
     "ad.res.deleteConfirm": "从知识库中删除“{name}”？删除后请重建知识库以生效。",
@@ -3022,6 +3058,9 @@ const LOCALES = {
     "ad.health.ragSystem": "RAG 系统",
     "ad.health.available": "可用",
     "ad.health.indexLoaded": "索引已加载",
+    "ad.health.embedCache": "查询嵌入缓存",
+    "ad.health.retrievalCache": "检索结果缓存",
+    "ad.health.cacheHits": "命中率 {rate}%（{hits}/{total}）",
     "ad.health.disk": "磁盘空间",
     "ad.health.free": "剩余",
     "ad.health.gbOf": "{free} GB / 共 {total} GB",
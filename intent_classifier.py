@@ -0,0 +1,227 @@
+# intent_classifier.py — local "write it for me" intent gate used by app_chat.py
+"""
+The academic-integrity gate asks whether a student wants the AI to AUTHOR
+their design content or wants to be COACHed. Instead of a round trip to the
+chat model for that one word, a small classifier (logistic regression, or an
+MLP with --model mlp) runs on the all-MiniLM-L6-v2 query embedding the app
+already computes for retrieval, plus a one-hot of the active step (asking for
+a later step's content counts as AUTHOR). When its confidence is below
+INTENT_CONFIDENCE the app still asks the LLM.
+
+The labeled messages live in server/config/intent/author_intent.jsonl
+({"text", "label": "AUTHOR"|"COACH", "step"}; step may be null).
+
+  python intent_classifier.py eval    # cross-validated accuracy and LLM-fallback rate per threshold
+  python intent_classifier.py train   # fit on every example, write server/models/author_intent.joblib
+
+Running servers load the model at startup; restart them after retraining.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+try:
+    import joblib  # type: ignore
+    from sklearn.linear_model import LogisticRegression  # type: ignore
+    from sklearn.model_selection import StratifiedKFold  # type: ignore
+    from sklearn.neural_network import MLPClassifier  # type: ignore
+except Exception:
+    joblib = None
+
+logger = logging.getLogger("uvicorn.error")
+
+ROOT = Path(__file__).parent.resolve()
+DATA_PATH = ROOT / "server" / "config" / "intent" / "author_intent.jsonl"
+MODEL_PATH = Path(os.environ.get("INTENT_MODEL_PATH", ROOT / "server" / "models" / "author_intent.joblib"))
+# Probability the top label must reach for the local verdict to be used.
+CONFIDENCE = float(os.environ.get("INTENT_CONFIDENCE", "0.85"))
+LABELS = ("COACH", "AUTHOR")
+MODEL_KINDS = ("lr", "mlp")
+STEPS = 9
+FOLDS = 5
+
+
+def available() -> bool:
+    return joblib is not None
+
+
+def load_examples(path: Path = DATA_PATH) -> List[Dict[str, Any]]:
+    out = []
+    with open(path, encoding="utf-8") as f:
+        for n, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            ex = json.loads(line)
+            if ex.get("label") not in LABELS or not (ex.get("text") or "").strip():
+                raise ValueError(f"{path}:{n}: need a text and a label in {LABELS}")
+            out.append(ex)
+    return out
+
+
+def features(vecs: np.ndarray, steps: Sequence[Optional[int]]) -> np.ndarray:
+    """Normalized sentence vectors followed by a one-hot of the step (all
+    zeros when the step is unknown)."""
+    vecs = np.asarray(vecs, dtype="float32").reshape(len(steps), -1)
+    onehot = np.zeros((len(steps), STEPS), dtype="float32")
+    for i, step in enumerate(steps):
+        if step and 1 <= int(step) <= STEPS:
+            onehot[i, int(step) - 1] = 1.0
+    return np.hstack([vecs, onehot])
+
+
+def make_model(kind: str = "lr"):
+    if joblib is None:
+        raise RuntimeError("scikit-learn is not installed")
+    if kind == "mlp":
+        return MLPClassifier(hidden_layer_sizes=(64,), alpha=1e-3, max_iter=2000, random_state=0)
+    if kind == "lr":
+        return LogisticRegression(C=4.0, class_weight="balanced", max_iter=2000)
+    raise ValueError(f"Unknown model kind {kind!r}; expected one of {MODEL_KINDS}")
+
+
+def embed_examples(examples: List[Dict[str, Any]], embedder) -> Tuple[np.ndarray, np.ndarray]:
+    vecs = embedder.encode([ex["text"] for ex in examples], convert_to_numpy=True,
+                           normalize_embeddings=True, batch_size=64)
+    X = features(vecs, [ex.get("step") for ex in examples])
+    y = np.asarray([LABELS.index(ex["label"]) for ex in examples])
+    return X, y
+
+
+def threshold_report(proba: np.ndarray, y: np.ndarray,
+                     thresholds: Sequence[float] = (0.6, 0.7, 0.8, 0.85, 0.9, 0.95)) -> List[Dict[str, Any]]:
+    """For each threshold: the share of messages decided locally and the
+    accuracy on those (the rest go to the LLM)."""
+    conf = proba.max(axis=1)
+    pred = proba.argmax(axis=1)
+    out = []
+    for t in thresholds:
+        local = conf >= t
+        out.append({"threshold": t, "local_share": round(float(local.mean()), 3),
+                    "local_accuracy": round(float((pred[local] == y[local]).mean()), 3) if local.any() else None})
+    return out
+
+
+def evaluate(examples: List[Dict[str, Any]], embedder, kind: str = "lr",
+             folds: int = FOLDS) -> Dict[str, Any]:
+    """Stratified k-fold cross-validation on the labeled set."""
+    X, y = embed_examples(examples, embedder)
+    proba = np.zeros((len(y), len(LABELS)))
+    for train_idx, test_idx in StratifiedKFold(folds, shuffle=True, random_state=0).split(X, y):
+        model = make_model(kind).fit(X[train_idx], y[train_idx])
+        proba[test_idx] = model.predict_proba(X[test_idx])
+    pred = proba.argmax(axis=1)
+    author = LABELS.index("AUTHOR")
+    tp = int(((pred == author) & (y == author)).sum())
+    precision = tp / max(int((pred == author).sum()), 1)
+    recall = tp / max(int((y == author).sum()), 1)
+    return {"examples": len(y), "model": kind, "folds": folds,
+            "accuracy": round(float((pred == y).mean()), 3),
+            "author_precision": round(precision, 3), "author_recall": round(recall, 3),
+            "thresholds": threshold_report(proba, y),
+            "errors": [{"text": examples[i]["text"], "label": examples[i]["label"],
+                        "p_author": round(float(proba[i, author]), 3)}
+                       for i in np.flatnonzero(pred != y)]}
+
+
+def train(examples: List[Dict[str, Any]], embedder, model_name: str, kind: str = "lr",
+          out: Path = MODEL_PATH, folds: int = FOLDS) -> Dict[str, Any]:
+    """Fit on every example and write the model plus its metadata to out."""
+    report = evaluate(examples, embedder, kind, folds)
+    X, y = embed_examples(examples, embedder)
+    model = make_model(kind).fit(X, y)
+    meta = {"embed_model": model_name, "labels": list(LABELS), "steps": STEPS, "kind": kind,
+            "examples": len(y), "trained_at": datetime.now(timezone.utc).isoformat(),
+            "cv": {k: v for k, v in report.items() if k != "errors"}}
+    out.parent.mkdir(parents=True, exist_ok=True)
+    joblib.dump({"model": model, "meta": meta}, out)
+    return report
+
+
+class IntentClassifier:
+    """A trained model loaded for serving."""
+
+    def __init__(self, model, meta: Dict[str, Any]):
+        self.model = model
+        self.meta = meta
+        self._author = list(meta.get("labels", LABELS)).index("AUTHOR")
+
+    @classmethod
+    def load(cls, path: Path = MODEL_PATH, model_name: Optional[str] = None) -> Optional["IntentClassifier"]:
+        """The classifier at path, or None if it is missing, unreadable or was
+        trained on another embedding model."""
+        if joblib is None or not path.exists():
+            return None
+        try:
+            blob = joblib.load(path)
+        except Exception as e:
+            logger.warning("Ignoring unreadable intent classifier %s: %s", path, e)
+            return None
+        meta = blob.get("meta", {})
+        if model_name and meta.get("embed_model") != model_name:
+            logger.warning("Intent classifier %s was trained on %s, not %s; not using it",
+                           path, meta.get("embed_model"), model_name)
+            return None
+        return cls(blob["model"], meta)
+
+    def p_author(self, vec: np.ndarray, step: Optional[int]) -> float:
+        return float(self.model.predict_proba(features(vec, [step]))[0, self._author])
+
+    def decide(self, vec: np.ndarray, step: Optional[int],
+               threshold: float = CONFIDENCE) -> Tuple[Optional[bool], float]:
+        """(asks_to_author, P(AUTHOR)); the verdict is None when neither label
+        reaches threshold."""
+        p = self.p_author(vec, step)
+        if p >= threshold:
+            return True, p
+        if 1.0 - p >= threshold:
+            return False, p
+        return None, p
+
+
+def _print_report(report: Dict[str, Any]) -> None:
+    print(f"[intent] {report['examples']} examples, {report['model']}, {report['folds']}-fold CV: "
+          f"accuracy {report['accuracy']}, AUTHOR precision {report['author_precision']} "
+          f"recall {report['author_recall']}")
+    print("[intent] threshold  decided locally  accuracy when local")
+    for row in report["thresholds"]:
+        print(f"[intent]   {row['threshold']:<8} {row['local_share']:<16} {row['local_accuracy']}")
+    for err in report["errors"]:
+        print(f"[intent]   miss ({err['label']}, P(AUTHOR)={err['p_author']}): {err['text']}")
+
+
+def main():
+    import embedders
+    from rag_index import EMBED_MODEL_NAME
+
+    ap = argparse.ArgumentParser(description="Train/evaluate the local authoring-intent classifier")
+    ap.add_argument("command", choices=("train", "eval"))
+    ap.add_argument("--data", default=str(DATA_PATH), help="Labeled JSONL (default: server/config/intent/author_intent.jsonl)")
+    ap.add_argument("--out", default=str(MODEL_PATH), help="Model file written by train")
+    ap.add_argument("--model", default="lr", choices=MODEL_KINDS, help="Logistic regression or a small MLP")
+    ap.add_argument("--folds", type=int, default=FOLDS, help="Cross-validation folds")
+    ap.add_argument("--backend", default=embedders.EMBED_BACKEND, choices=embedders.BACKENDS,
+                    help="Embedder backend (default: $RAG_EMBED_BACKEND or torch)")
+    args = ap.parse_args()
+    if joblib is None:
+        raise SystemExit("scikit-learn not installed. Run: pip install scikit-learn")
+
+    examples = load_examples(Path(args.data))
+    embedder = embedders.load_embedder(EMBED_MODEL_NAME, args.backend)
+    if args.command == "eval":
+        _print_report(evaluate(examples, embedder, args.model, args.folds))
+        return
+    _print_report(train(examples, embedder, EMBED_MODEL_NAME, args.model, Path(args.out), args.folds))
+    print(f"[intent] Wrote {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+# llm_clients.py — pooled HTTP clients for the LLM and moderation backends used by app_chat.py
+"""
+Every call to Ollama or vLLM goes through one long-lived client per backend
+instead of a bare requests.post(): each client is a requests.Session whose
+urllib3 pool keeps up to LLM_POOL_SIZE keep-alive connections to the backend
+host, so a chat message reuses open connections rather than paying a TCP
+(and TLS) handshake per moderation check, classifier call and completion.
+
+  ollama      chat/generate calls to Ollama (OLLAMA_URL / OLLAMA_BASE)
+  vllm        OpenAI-compatible calls to vLLM (VLLM_URL)
+  moderation  Llama Guard checks (async client only); same Ollama host, its
+              own pool, so short guard calls never queue behind long-running
+              completion streams
+
+Timeouts are (connect, read) pairs: LLM_CONNECT_TIMEOUT for every call, and a
+per-client read timeout that call sites may override. stats() reports, per
+client, the requests sent and the connections opened for them; the rest were
+served on a reused connection.
+
+The async chat endpoints use the httpx.AsyncClient counterparts
+(async_ollama, async_vllm) with the same pool sizes and timeouts; awaiting a
+call or a stream holds no thread.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import os
+import threading
+from typing import Any, Dict, Optional, Tuple, Union
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+# Keep-alive connections kept open per backend host. Sync requests beyond this
+# still go through, on a connection that is closed afterwards; async ones wait
+# (up to their timeout) for a pooled connection, so a burst of chat traffic
+# never opens more than this many connections per async client.
+LLM_POOL_SIZE = int(os.environ.get("LLM_POOL_SIZE", "32"))
+MODERATION_POOL_SIZE = int(os.environ.get("MODERATION_POOL_SIZE", str(LLM_POOL_SIZE)))
+LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", "5"))
+LLM_READ_TIMEOUT = float(os.environ.get("LLM_READ_TIMEOUT", "120"))
+LLM_STREAM_TIMEOUT = float(os.environ.get("LLM_STREAM_TIMEOUT", "300"))
+MODERATION_TIMEOUT = float(os.environ.get("MODERATION_TIMEOUT", "20"))
+HEALTH_TIMEOUT = float(os.environ.get("LLM_HEALTH_TIMEOUT", "3"))
+
+Timeout = Union[float, Tuple[float, float]]
+
+
+class LLMClient:
+    """A requests.Session with a sized keep-alive pool, default timeouts and
+    request / new-connection counters. Safe to share between threads."""
+
+    def __init__(self, name: str, pool_size: int = LLM_POOL_SIZE,
+                 read_timeout: float = LLM_READ_TIMEOUT,
+                 connect_timeout: float = LLM_CONNECT_TIMEOUT):
+        self.name = name
+        self.pool_size = max(1, pool_size)
+        self.read_timeout = read_timeout
+        self.connect_timeout = connect_timeout
+        self._adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size)
+        self.session = requests.Session()
+        self.session.mount("http://", self._adapter)
+        self.session.mount("https://", self._adapter)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def timeout(self, read: Optional[float] = None) -> Tuple[float, float]:
+        return (self.connect_timeout, self.read_timeout if read is None else read)
+
+    def request(self, method: str, url: str, timeout: Optional[Timeout] = None,
+                **kwargs: Any) -> requests.Response:
+        """Session.request() with this client's timeouts. A bare number as
+        timeout overrides only the read timeout."""
+        if timeout is None or isinstance(timeout, (int, float)):
+            timeout = self.timeout(timeout)
+        with self._lock:
+            self.requests += 1
+        try:
+            return self.session.request(method, url, timeout=timeout, **kwargs)
+        except requests.RequestException:
+            with self._lock:
+                self.errors += 1
+            raise
+
+    def post(self, url: str, **kwargs: Any) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def get(self, url: str, **kwargs: Any) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def connections_opened(self) -> int:
+        """Connections urllib3 has opened for this client (all hosts)."""
+        pools = self._adapter.poolmanager.pools
+        return sum(getattr(pools[key], "num_connections", 0) for key in list(pools.keys()))
+
+    def stats(self) -> Dict[str, Any]:
+        opened = self.connections_opened()
+        return {"requests": self.requests, "errors": self.errors, "connections_opened": opened,
+                "reused": max(0, self.requests - opened),
+                "reuse_rate": round(1 - opened / self.requests, 3) if self.requests else 0.0,
+                "pool_size": self.pool_size,
+                "timeout": {"connect": self.connect_timeout, "read": self.read_timeout}}
+
+    def close(self) -> None:
+        self.session.close()
+
+
+class AsyncLLMClient:
+    """httpx.AsyncClient with the same pool size, timeouts and counters as
+    LLMClient, capped at pool_size open connections. New connections are
+    counted through httpcore's trace hook."""
+
+    def __init__(self, name: str, pool_size: int = LLM_POOL_SIZE,
+                 read_timeout: float = LLM_READ_TIMEOUT,
+                 connect_timeout: float = LLM_CONNECT_TIMEOUT):
+        self.name = name
+        self.pool_size = max(1, pool_size)
+        self.read_timeout = read_timeout
+        self.connect_timeout = connect_timeout
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+            timeout=self.timeout())
+        self.requests = 0
+        self.errors = 0
+        self.opened = 0
+
+    def timeout(self, read: Optional[float] = None) -> httpx.Timeout:
+        return httpx.Timeout(self.read_timeout if read is None else read, connect=self.connect_timeout)
+
+    async def _trace(self, event: str, info: Dict[str, Any]) -> None:
+        if event.endswith("connect_tcp.complete"):
+            self.opened += 1
+
+    def _prepare(self, timeout: Optional[float], kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        self.requests += 1  # only ever touched from the event loop thread
+        kwargs["timeout"] = self.timeout(timeout)
+        kwargs["extensions"] = {**kwargs.get("extensions", {}), "trace": self._trace}
+        return kwargs
+
+    async def request(self, method: str, url: str, timeout: Optional[float] = None,
+                      **kwargs: Any) -> httpx.Response:
+        try:
+            return await self.client.request(method, url, **self._prepare(timeout, kwargs))
+        except httpx.HTTPError:
+            self.errors += 1
+            raise
+
+    async def post(self, url: str, **kwargs: Any) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    async def get(self, url: str, **kwargs: Any) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    @contextlib.asynccontextmanager
+    async def stream(self, method: str, url: str, timeout: Optional[float] = None, **kwargs: Any):
+        """async with client.stream(...) as resp: async for line in resp.aiter_lines()
+
+        Errors while connecting or reading the body count like request()'s."""
+        try:
+            async with self.client.stream(method, url, **self._prepare(timeout, kwargs)) as resp:
+                yield resp
+        except httpx.HTTPError:
+            self.errors += 1
+            raise
+
+    def stats(self) -> Dict[str, Any]:
+        return {"requests": self.requests, "errors": self.errors, "connections_opened": self.opened,
+                "reused": max(0, self.requests - self.opened),
+                "reuse_rate": round(1 - self.opened / self.requests, 3) if self.requests else 0.0,
+                "pool_size": self.pool_size,
+                "timeout": {"connect": self.connect_timeout, "read": self.read_timeout}}
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+
+ollama = LLMClient("ollama")
+vllm = LLMClient("vllm")
+async_ollama = AsyncLLMClient("ollama")
+async_vllm = AsyncLLMClient("vllm")
+async_moderation = AsyncLLMClient("moderation", pool_size=MODERATION_POOL_SIZE,
+                                  read_timeout=MODERATION_TIMEOUT)
+CLIENTS = (ollama, vllm)
+ASYNC_CLIENTS = (async_ollama, async_vllm, async_moderation)
+
+
+def stats() -> Dict[str, Dict[str, Any]]:
+    """Per-client pool metrics for /admin/health."""
+    out = {c.name: c.stats() for c in CLIENTS}
+    out.update({f"{c.name}_async": c.stats() for c in ASYNC_CLIENTS})
+    return out
+
+
+def close_all() -> None:
+    for c in CLIENTS:
+        c.close()
+
+
+async def aclose_all() -> None:
+    for c in ASYNC_CLIENTS:
+        await c.aclose()
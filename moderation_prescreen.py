@@ -0,0 +1,172 @@
+# moderation_prescreen.py — local pre-screen in front of the Llama Guard check in app_chat.py
+"""
+Most student messages ("hi", "what is axiology?") are obviously benign, but
+each one still cost a Llama Guard call on the same Ollama GPU and queue as the
+chat model. The pre-screen decides locally which messages need the guard:
+
+  lexicon     case-insensitive regexes per hazard category (en/es/zh)
+  similarity  cosine between the message's MiniLM query vector and known
+              unsafe exemplars, escalated at PRESCREEN_SIMILARITY or above
+  script      text the English embedding model can't represent (e.g. CJK)
+  language    messages in a language the exemplars don't cover (the chat's
+              language, or the one rag_index.detect_language() finds); only
+              English so far, so Spanish always goes to the guard
+  length      messages over PRESCREEN_MAX_CHARS, where one bad sentence is
+              diluted in the averaged embedding
+
+A message that trips any check goes to Llama Guard as before; the rest skip
+it. Patterns and exemplars live in server/config/moderation/prescreen.json,
+keyed by Llama Guard 3's S1-S14 categories.
+
+  python moderation_prescreen.py messages.txt   # one message per line: verdict, reason, similarity
+
+The embedding check needs the RAG embedder; without it every message that
+passes the lexicon is escalated.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from rag_index import detect_language
+
+logger = logging.getLogger("uvicorn.error")
+
+ROOT = Path(__file__).parent.resolve()
+CONFIG_PATH = Path(os.environ.get("PRESCREEN_CONFIG",
+                                  ROOT / "server" / "config" / "moderation" / "prescreen.json"))
+# Cosine to the nearest unsafe exemplar at which a message is escalated.
+SIMILARITY = float(os.environ.get("PRESCREEN_SIMILARITY", "0.40"))
+MAX_CHARS = int(os.environ.get("PRESCREEN_MAX_CHARS", "600"))
+# Anything outside Latin, general punctuation and currency symbols.
+_UNCOVERED_SCRIPT_RE = re.compile(r"[^\u0000-\u024f\u2000-\u20cf]")
+# Letters outside ASCII (á, ñ, ü, ...): a short message detect_language() can't
+# place ("und") but that has these is treated as not English.
+_NON_ASCII_LETTER_RE = re.compile(r"[^\W\d_a-zA-Z]")
+
+
+@dataclass
+class Screen:
+    """The pre-screen's verdict on one message."""
+    escalate: bool
+    reason: str = ""  # lexicon / similarity / script / language / length / no-embedder
+    category: str = ""
+    similarity: Optional[float] = None
+
+
+class Prescreen:
+    """Compiled lexicon plus the normalized exemplar vectors."""
+
+    def __init__(self, patterns: List[Tuple[str, "re.Pattern[str]"]],
+                 exemplars: Optional[np.ndarray], exemplar_categories: List[str],
+                 threshold: float = SIMILARITY, max_chars: int = MAX_CHARS,
+                 languages: Tuple[str, ...] = ("en",)):
+        self.patterns = patterns
+        self.exemplars = exemplars
+        self.exemplar_categories = exemplar_categories
+        self.threshold = threshold
+        self.max_chars = max_chars
+        self.languages = frozenset(languages)
+
+    @classmethod
+    def load(cls, embedder=None, path: Path = CONFIG_PATH, **kwargs: Any) -> "Prescreen":
+        """Compile the lexicon and, given an embedder, embed the exemplars."""
+        with open(path, encoding="utf-8") as f:
+            config = json.load(f)
+        categories = config["categories"]
+        kwargs.setdefault("languages", tuple(config.get("languages", ["en"])))
+        patterns, texts, cats = [], [], []
+        for code, cat in categories.items():
+            for pat in cat.get("patterns", []):
+                patterns.append((code, re.compile(pat, re.IGNORECASE)))
+            for text in cat.get("exemplars", []):
+                texts.append(text)
+                cats.append(code)
+        exemplars = None
+        if embedder is not None and texts:
+            exemplars = np.asarray(embedder.encode(texts, convert_to_numpy=True, normalize_embeddings=True),
+                                   dtype="float32")
+        return cls(patterns, exemplars, cats, **kwargs)
+
+    def lexicon_match(self, text: str) -> Optional[str]:
+        """The category of the first matching pattern, if any."""
+        for code, pat in self.patterns:
+            if pat.search(text):
+                return code
+        return None
+
+    def nearest(self, vec: np.ndarray) -> Tuple[float, str]:
+        """(cosine, category) of the closest unsafe exemplar."""
+        sims = self.exemplars @ np.asarray(vec, dtype="float32").reshape(-1)
+        i = int(np.argmax(sims))
+        return float(sims[i]), self.exemplar_categories[i]
+
+    def covers_language(self, text: str, language: Optional[str] = None) -> bool:
+        """Whether the exemplars (and the English embedding model) can judge
+        text, written in a chat set to language."""
+        if language and language not in self.languages:
+            return False
+        detected = detect_language(text)
+        if detected == "und":
+            return not _NON_ASCII_LETTER_RE.search(text)
+        return detected in self.languages
+
+    def screen(self, text: str, vec: Optional[np.ndarray] = None, language: Optional[str] = None) -> Screen:
+        """Whether text needs the guard model. vec is its normalized query
+        embedding; without it (or without exemplars) nothing can skip.
+        language is the chat's UI language, if known."""
+        code = self.lexicon_match(text)
+        if code:
+            return Screen(True, "lexicon", code)
+        if len(text) > self.max_chars:
+            return Screen(True, "length")
+        if _UNCOVERED_SCRIPT_RE.search(text):
+            return Screen(True, "script")
+        if not self.covers_language(text, language):
+            return Screen(True, "language")
+        if vec is None or self.exemplars is None:
+            return Screen(True, "no-embedder")
+        sim, code = self.nearest(vec)
+        if sim >= self.threshold:
+            return Screen(True, "similarity", code, round(sim, 3))
+        return Screen(False, similarity=round(sim, 3))
+
+
+def main():
+    import embedders
+    from rag_index import EMBED_MODEL_NAME
+
+    ap = argparse.ArgumentParser(description="Run the moderation pre-screen over sample messages")
+    ap.add_argument("messages", help="Text file, one message per line")
+    ap.add_argument("--threshold", type=float, default=SIMILARITY, help="Escalation cosine (default: $PRESCREEN_SIMILARITY)")
+    ap.add_argument("--backend", default=embedders.EMBED_BACKEND, choices=embedders.BACKENDS,
+                    help="Embedder backend (default: $RAG_EMBED_BACKEND or torch)")
+    args = ap.parse_args()
+
+    with open(args.messages, encoding="utf-8") as f:
+        messages = [line.strip() for line in f if line.strip()]
+    embedder = embedders.load_embedder(EMBED_MODEL_NAME, args.backend)
+    pre = Prescreen.load(embedder, threshold=args.threshold)
+    vecs = embedder.encode(messages, convert_to_numpy=True, normalize_embeddings=True)
+    reasons: Dict[str, int] = {}
+    for text, vec in zip(messages, vecs):
+        s = pre.screen(text, vec)
+        reasons[s.reason or "skip"] = reasons.get(s.reason or "skip", 0) + 1
+        verdict = f"guard ({s.reason}{' ' + s.category if s.category else ''})" if s.escalate else "skip"
+        print(f"[prescreen] {verdict:<22} sim={s.similarity}  {text[:100]}")
+    skipped = reasons.get("skip", 0)
+    print(f"[prescreen] {len(messages)} messages, {skipped} skip the guard "
+          f"({skipped / max(len(messages), 1):.0%}); by reason: {reasons}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2011 @@
+# rag_index.py — knowledge-base (RAG) build helpers shared by app_chat.py and create_index.py
+"""
+Reads the documents in server/resources, chunks them, embeds the chunks and
+writes the FAISS index + chunk metadata to server/index.
+
+Builds are incremental: a manifest (manifest.json, next to faiss.index and
+the chunk store) records each file's content hash and the extractor / chunking
+parameters used. A rebuild only extracts and embeds files that were added or
+changed since the last build, drops the vectors of deleted files and carries
+every other file's chunks and vectors over untouched.
+
+Chunk texts are kept in a binary chunk store (chunks.bin: one UTF-8 blob;
+chunks.idx.npy: fixed-width offset/length/source-id rows; chunks.sources.json)
+that is memory-mapped rather than parsed, so opening it is O(1) and every
+worker process shares the same page-cache pages. An older chunks.json is
+converted to the binary store the first time it is opened.
+
+The vector index type is picked from the corpus size: exact IndexFlatIP for
+small corpora, HNSW for mid-sized ones and IVF-flat for large ones (override
+with index_type / RAG_INDEX_TYPE). Approximate indexes are checked against the
+exact baseline before they are published and replaced by a flat index when
+their recall is too low. Vectors can also be stored compressed (fp16 scalar
+quantization or PQ codes), re-ranking the top candidates against the exact
+vectors. Those are kept next to the index (vectors.f32, memory-mapped), so
+incremental rebuilds never depend on the index type.
+
+Each snapshot also carries a BM25 inverted index (bm25.npz + bm25.vocab.json)
+over the same chunks, used for keyword retrieval when the embedder is
+unavailable or failing.
+
+Every build is written to its own versioned directory (server/index/snapshots/
+<version>/) and only then published by atomically replacing the CURRENT
+pointer file, so readers never see a half-written index. Indexes built before
+snapshots existed (faiss.index + chunks.json directly in server/index) are
+still loaded as the "legacy" snapshot.
+"""
+
+from __future__ import annotations
+
+import gzip
+import hashlib
+import importlib.metadata
+import itertools
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import queue
+import re
+import shutil
+import struct
+import threading
+import time
+import unicodedata
+import uuid
+import zlib
+from array import array
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+import embedders
+
+try:
+    import faiss  # type: ignore
+except Exception:
+    faiss = None
+
+try:
+    from pypdf import PdfReader  # type: ignore
+except Exception:
+    PdfReader = None
+
+try:
+    from pdfminer.high_level import extract_text as pdfminer_extract_text  # type: ignore
+except Exception:
+    pdfminer_extract_text = None
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger("uvicorn.error")
+
+EMBED_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+# Extensions the knowledge base can ingest.
+RESOURCE_EXTS = (".pdf", ".txt", ".md", ".markdown")
+
+# Bump whenever read_document() changes what text it produces for a file, so
+# the next rebuild re-extracts everything instead of reusing stale chunks.
+EXTRACTOR_VERSION = 1
+# Chunks are sized in (estimated) tokens for the prompt: each retrieved chunk is
+# sent to the LLM whole, so the embedded text is exactly the text the model
+# sees. 180 keeps a chunk inside MiniLM's 256 word-piece window as well.
+CHUNK_TOKENS = int(os.environ.get("RAG_CHUNK_TOKENS", "180"))
+CHUNK_OVERLAP_TOKENS = int(os.environ.get("RAG_CHUNK_OVERLAP_TOKENS", "30"))
+CHUNKER_VERSION = 2
+MIN_SENTENCE_TOKENS = 4  # shorter "sentences" are dropped by extract_sentences()
+# Passage selection: retrieval fetches MMR_FETCH x k candidates and picks the
+# prompt's passages by maximal marginal relevance over their stored vectors
+# (MMR_LAMBDA = 1 ranks by relevance alone).
+MMR_LAMBDA = float(os.environ.get("RAG_MMR_LAMBDA", "0.7"))
+MMR_FETCH = int(os.environ.get("RAG_MMR_FETCH", "3"))
+
+INDEX_NAME = "faiss.index"
+META_NAME = "chunks.json"  # legacy chunk metadata; converted to the binary store on open
+CHUNKS_BLOB_NAME = "chunks.bin"
+CHUNKS_TABLE_NAME = "chunks.idx.npy"
+CHUNKS_SOURCES_NAME = "chunks.sources.json"
+CHUNKS_ALIASES_NAME = "chunks.aliases.json"  # extra source names of deduplicated chunks
+CHUNKS_MINHASH_NAME = "chunks.minhash.npy"  # per-chunk MinHash signatures (near-duplicate detection)
+CHUNKS_META_NAME = "chunks.meta.npy"  # per-chunk step tags, source type and language
+VECTORS_NAME = "vectors.f32"  # exact float32 vectors, row-aligned with the chunk store
+BM25_NAME = "bm25.npz"
+BM25_VOCAB_NAME = "bm25.vocab.json"
+MANIFEST_NAME = "manifest.json"
+MANIFEST_FORMAT = 1
+SNAPSHOTS_DIRNAME = "snapshots"
+CURRENT_NAME = "CURRENT"
+BUILD_LOCK_NAME = "build.lock"  # held while a build writes into the index dir (see BuildLock)
+# Published snapshots kept on disk (the current one plus a couple of previous
+# ones, so a worker still reading an older version never loses its files).
+KEEP_SNAPSHOTS = 3
+# Open published indexes memory-mapped: vector codes and inverted lists then
+# live in the shared page cache instead of a private copy per worker.
+INDEX_MMAP = os.environ.get("RAG_INDEX_MMAP", "1") != "0"
+# Deduplication: byte-identical files are ingested once; a chunk whose MinHash
+# Jaccard estimate against an already stored chunk is >= NEAR_DUP_THRESHOLD
+# is not stored again, only recorded as also coming from its file.
+DEDUPE = os.environ.get("RAG_DEDUPE", "1") != "0"
+NEAR_DUP_THRESHOLD = 0.9
+SHINGLE_WORDS = 5
+MINHASH_PERM = 64
+MINHASH_BANDS = 8  # 8 bands x 8 rows: pairs above ~0.77 similarity become candidates
+# Extracted text is cached here across rebuilds (see TextCache).
+TEXT_CACHE_DIR = Path(os.environ.get(
+    "RAG_TEXT_CACHE_DIR", Path(__file__).parent.resolve() / "server" / "index" / "text_cache"))
+# Ingestion pipeline: PDF extraction runs on EXTRACT_WORKERS processes (0 = one
+# per core), chunks are embedded EMBED_BATCH at a time on EMBED_WORKERS threads.
+EXTRACT_WORKERS = int(os.environ.get("RAG_EXTRACT_WORKERS", "0"))
+EMBED_BATCH = int(os.environ.get("RAG_EMBED_BATCH", "64"))
+EMBED_WORKERS = int(os.environ.get("RAG_EMBED_WORKERS", "1"))
+
+# progress(stage, done, total) — called from the build thread.
+ProgressFn = Callable[[str, int, int], None]
+
+
+# ============================================================
+# Reading + chunking
+# ============================================================
+def read_txt(path: Path) -> str:
+    return path.read_text(encoding="utf-8", errors="ignore")
+
+
+def read_md(path: Path) -> str:
+    return path.read_text(encoding="utf-8", errors="ignore")
+
+
+def read_pdf(path: Path) -> str:
+    txt = ""
+    # Try pypdf first
+    if PdfReader is not None:
+        try:
+            reader = PdfReader(str(path))
+            txt = "\n".join((page.extract_text() or "") for page in reader.pages)
+        except Exception:
+            txt = ""
+    # Fallback to pdfminer if installed
+    if (not txt or not txt.strip()) and pdfminer_extract_text is not None:
+        try:
+            txt = pdfminer_extract_text(str(path)) or ""
+        except Exception:
+            txt = ""
+    return txt
+
+
+def read_document(path: Path) -> str:
+    """Extract the text of one resource file ("" for unsupported types)."""
+    ext = path.suffix.lower()
+    if ext == ".txt":
+        return read_txt(path)
+    if ext in (".md", ".markdown"):
+        return read_md(path)
+    if ext == ".pdf":
+        return read_pdf(path)
+    return ""
+
+
+def list_resource_files(docs_dir: Path) -> List[Path]:
+    """Every ingestible file under docs_dir, in a stable order."""
+    if not docs_dir.exists():
+        return []
+    return [p for p in sorted(docs_dir.glob("**/*"))
+            if p.is_file() and p.suffix.lower() in RESOURCE_EXTS]
+
+
+def resource_name(docs_dir: Optional[Path], path: Path) -> str:
+    """Key of a resource file in manifests, chunk sources and ingestion stats:
+    its path relative to docs_dir ("sub/notes.md"), so same-named files in
+    different subfolders stay apart. Top-level files keep their bare name."""
+    if docs_dir is not None:
+        try:
+            return path.relative_to(docs_dir).as_posix()
+        except ValueError:
+            pass
+    return path.as_posix()
+
+
+def load_docs(docs_dir: Path, workers: Optional[int] = None) -> List[Dict[str, str]]:
+    paths = list_resource_files(docs_dir)
+    texts = {p: text for p, text in extract_files(paths, workers, docs_dir=docs_dir)}
+    # unreadable files come back empty and are skipped
+    return [{"source": resource_name(docs_dir, p), "text": texts[p]} for p in paths if texts.get(p)]
+
+
+# CJK ideographs: one word piece each, and Chinese text has no spaces.
+_CJK_CHARS = "\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff"
+# A token is a CJK character, a word or a run of punctuation: close to
+# word-piece/BPE counts for English prose and Chinese text without depending
+# on any one model's tokenizer.
+_CHUNK_TOKEN_RE = re.compile(rf"[{_CJK_CHARS}]|[^\W{_CJK_CHARS}]+|[^\w\s]+")
+_PARAGRAPH_RE = re.compile(r"\n\s*\n")
+# A sentence end plus its closing quotes/brackets. Latin ends need following
+# whitespace; full-width ones never have any.
+_SENTENCE_RE = re.compile(r"[.!?…][\"'”’)\]]*(?=\s)|[。！？][\"'”’」』）)\]]*")
+_FULLWIDTH_END_RE = re.compile(r"[。！？][\"'”’」』）)\]]*$")
+
+
+def count_tokens(text: str) -> int:
+    return sum(1 for _ in _CHUNK_TOKEN_RE.finditer(text))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """The longest prefix of text with at most max_tokens tokens."""
+    for i, m in enumerate(_CHUNK_TOKEN_RE.finditer(text)):
+        if i == max_tokens:
+            return text[:m.start()].rstrip()
+    return text
+
+
+def _split_sentences(paragraph: str) -> List[str]:
+    out, start = [], 0
+    for m in _SENTENCE_RE.finditer(paragraph):
+        out.append(paragraph[start:m.end()].strip())
+        start = m.end()
+    out.append(paragraph[start:].strip())
+    return [s for s in out if s]
+
+
+def _sentences(paragraph: str, max_tokens: int) -> List[Tuple[str, int]]:
+    """(sentence, tokens) pairs; sentences longer than max_tokens are cut."""
+    out: List[Tuple[str, int]] = []
+    for sent in _split_sentences(paragraph):
+        sent = sent.strip()
+        while sent:
+            head = truncate_tokens(sent, max_tokens)
+            if not head:  # a single "token" longer than the budget can't be split further
+                head = sent
+            out.append((head, count_tokens(head)))
+            sent = sent[len(head):].strip()
+    return out
+
+
+def chunk_text(text: str, max_tokens: int = CHUNK_TOKENS,
+               overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> List[str]:
+    """Split text into chunks of at most max_tokens tokens on sentence
+    boundaries, preferring paragraph boundaries once a chunk is half full.
+    Consecutive chunks share up to overlap_tokens of trailing sentences."""
+    chunks: List[str] = []
+    cur: List[Tuple[str, int, bool]] = []  # (sentence, tokens, starts a paragraph)
+    size = 0
+
+    def flush():
+        parts: List[str] = []
+        for sent, _, para in cur:
+            sep = "" if not parts else "\n\n" if para else "" if _FULLWIDTH_END_RE.search(parts[-1]) else " "
+            parts.append(sep + sent)
+        chunks.append("".join(parts))
+
+    for paragraph in _PARAGRAPH_RE.split(text or ""):
+        paragraph = re.sub(r"\s+", " ", paragraph).strip()
+        for j, (sent, n) in enumerate(_sentences(paragraph, max_tokens) if paragraph else []):
+            starts_para = j == 0
+            if cur and (size + n > max_tokens or (starts_para and size >= max_tokens // 2)):
+                flush()
+                keep: List[Tuple[str, int, bool]] = []
+                kept = 0
+                for item in reversed(cur):
+                    if kept + item[1] > overlap_tokens or kept + item[1] + n > max_tokens:
+                        break
+                    keep.insert(0, item)
+                    kept += item[1]
+                cur, size = keep, kept
+            cur.append((sent, n, starts_para))
+            size += n
+    if cur:
+        flush()
+    return chunks
+
+
+def split_sentences(text: str) -> List[str]:
+    """The sentences of a chunk, split the way chunk_text() packed them."""
+    out: List[str] = []
+    for paragraph in _PARAGRAPH_RE.split(text or ""):
+        paragraph = re.sub(r"\s+", " ", paragraph).strip()
+        if paragraph:
+            out.extend(_split_sentences(paragraph))
+    return out
+
+
+def extract_sentences(sentences: List[str], scores, max_tokens: int) -> str:
+    """The highest-scoring sentences that fit in max_tokens, in their original
+    order; " … " marks where sentences were left out. The best sentence is
+    always kept, truncated if it alone exceeds the budget. Fragments shorter
+    than MIN_SENTENCE_TOKENS are dropped."""
+    sizes = [count_tokens(s) for s in sentences]
+    keep: List[int] = []
+    used = 0
+    for i in sorted(range(len(sentences)), key=lambda j: -float(scores[j])):
+        # Page numbers, bare citations and headings left over from PDF extraction.
+        if sizes[i] < MIN_SENTENCE_TOKENS:
+            continue
+        if used + sizes[i] <= max_tokens:
+            keep.append(i)
+            used += sizes[i]
+    if not keep:
+        return truncate_tokens(sentences[int(np.argmax(scores))], max_tokens) if sentences else ""
+    keep.sort()
+    parts = [sentences[keep[0]]]
+    for prev, i in zip(keep, keep[1:]):
+        parts.append((" " if i == prev + 1 else " … ") + sentences[i])
+    return ("… " if keep[0] else "") + "".join(parts) + (" …" if keep[-1] < len(sentences) - 1 else "")
+
+
+def file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+# ============================================================
+# Extracted-text cache
+# ============================================================
+def _package_version(name: str) -> str:
+    try:
+        return importlib.metadata.version(name)
+    except Exception:
+        return "none"
+
+
+_EXTRACTOR_IDS: Dict[str, str] = {}
+
+
+def extractor_id(path: Path) -> str:
+    """Name + version of the extractor read_document() uses for path. Library
+    versions are part of it because a pypdf/pdfminer upgrade changes the text."""
+    kind = "pdf" if path.suffix.lower() == ".pdf" else "text"
+    if kind not in _EXTRACTOR_IDS:
+        if kind == "pdf":
+            _EXTRACTOR_IDS[kind] = (f"pdf/{EXTRACTOR_VERSION}/pypdf-{_package_version('pypdf')}"
+                                    f"/pdfminer-{_package_version('pdfminer.six')}")
+        else:
+            _EXTRACTOR_IDS[kind] = f"text/{EXTRACTOR_VERSION}"
+    return _EXTRACTOR_IDS[kind]
+
+
+class TextCache:
+    """On-disk cache of extracted document text keyed by (content sha256,
+    extractor id), so rebuilds only run pypdf/pdfminer on new bytes. Each
+    entry also keeps how long the original extraction took and the path of
+    the file it came from. The cache is shared by every docs dir built on
+    this machine; see prune()."""
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _path(self, digest: str, extractor: str) -> Path:
+        tag = hashlib.sha1(extractor.encode("utf-8")).hexdigest()[:12]
+        return self.root / digest[:2] / f"{digest}-{tag}.json.gz"
+
+    def get(self, digest: str, extractor: str) -> Optional[Tuple[str, float]]:
+        """(text, original extraction seconds) or None."""
+        try:
+            with gzip.open(self._path(digest, extractor), "rt", encoding="utf-8") as f:
+                entry = json.load(f)
+            hit = entry.get("extractor") == extractor
+        except (OSError, ValueError, EOFError):
+            hit = False
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return (entry["text"], float(entry.get("seconds", 0.0))) if hit else None
+
+    def put(self, digest: str, extractor: str, text: str, seconds: float, source: str = "") -> None:
+        path = self._path(digest, extractor)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+            with gzip.open(tmp, "wt", encoding="utf-8") as f:
+                json.dump({"extractor": extractor, "source": source, "seconds": round(seconds, 4),
+                           "text": text}, f, ensure_ascii=False)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning("Could not cache extracted text of %s: %s", source or digest, e)
+
+    def prune(self, docs_dir: Path, keep_digests) -> int:
+        """Drop entries extracted from files in docs_dir whose content is no
+        longer there; returns the count removed. Entries of other docs dirs
+        (and older entries without a recorded path) are left alone."""
+        keep = set(keep_digests)
+        docs_dir = docs_dir.resolve()
+        removed = 0
+        for path in self.root.glob("*/*.json.gz"):
+            if path.name.split("-", 1)[0] in keep:
+                continue
+            try:
+                with gzip.open(path, "rt", encoding="utf-8") as f:
+                    source = json.load(f).get("source") or ""
+            except (OSError, ValueError, EOFError):
+                source = ""
+            if not os.path.isabs(source) or not Path(source).is_relative_to(docs_dir):
+                continue
+            try:
+                path.unlink()
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        entries = list(self.root.glob("*/*.json.gz")) if self.root.exists() else []
+        lookups = self.hits + self.misses
+        return {"dir": str(self.root), "entries": len(entries),
+                "bytes": sum(p.stat().st_size for p in entries if p.exists()),
+                "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0}
+
+
+text_cache = TextCache(TEXT_CACHE_DIR)
+
+
+# ============================================================
+# Ingestion pipeline
+# ============================================================
+@dataclass
+class IngestStats:
+    """Per-stage timings of one ingestion run. Stage seconds are time spent
+    inside that stage (summed over workers); wall_seconds is end to end."""
+    files: int = 0
+    failed: int = 0
+    chunks: int = 0
+    extract_seconds: float = 0.0
+    chunk_seconds: float = 0.0
+    embed_seconds: float = 0.0
+    wall_seconds: float = 0.0
+    extract_workers: int = 0
+    embed_workers: int = 0
+    embed_batch: int = 0
+    cache_hits: int = 0
+    cache_misses: int = 0
+    # Per file: how long extraction took (for cache hits, the original run's time).
+    file_seconds: Dict[str, float] = field(default_factory=dict)
+
+    def as_dict(self) -> Dict[str, Any]:
+        def rate(n, secs):
+            return round(n / secs, 2) if secs else None
+        slowest = sorted(self.file_seconds.items(), key=lambda kv: -kv[1])[:5]
+        return {
+            "files": self.files,
+            "failed": self.failed,
+            "chunks": self.chunks,
+            "wall_seconds": round(self.wall_seconds, 3),
+            "extract": {"seconds": round(self.extract_seconds, 3), "workers": self.extract_workers,
+                        "files_per_sec": rate(self.files, self.wall_seconds)},
+            "chunk": {"seconds": round(self.chunk_seconds, 3), "chunks_per_sec": rate(self.chunks, self.chunk_seconds)},
+            "embed": {"seconds": round(self.embed_seconds, 3), "workers": self.embed_workers,
+                      "batch": self.embed_batch, "chunks_per_sec": rate(self.chunks, self.embed_seconds)},
+            "text_cache": {"hits": self.cache_hits, "misses": self.cache_misses},
+            "slowest_files": [{"source": name, "seconds": round(secs, 3)} for name, secs in slowest],
+        }
+
+
+def _resolve_workers(workers: Optional[int]) -> int:
+    workers = EXTRACT_WORKERS if workers is None else workers
+    return workers if workers > 0 else (os.cpu_count() or 1)
+
+
+def _extract_file(path: str) -> Tuple[str, float, Optional[str]]:
+    """Process-pool worker: (text, seconds, error)."""
+    t0 = time.perf_counter()
+    try:
+        text, err = read_document(Path(path)), None
+    except Exception as e:
+        text, err = "", str(e)
+    return text, time.perf_counter() - t0, err
+
+
+def extract_files(paths: List[Path], workers: Optional[int] = None,
+                  stats: Optional[IngestStats] = None, cache: Optional[TextCache] = None,
+                  digests: Optional[Dict[str, str]] = None,
+                  docs_dir: Optional[Path] = None) -> Iterator[Tuple[Path, str]]:
+    """Extract the text of paths on a process pool, yielding (path, text) in
+    completion order. Finished texts pass through a bounded queue and only
+    workers*2 files are in flight, so a slow consumer holds extraction back
+    instead of letting texts pile up in memory. Failed files yield "".
+
+    Texts found in cache (default: text_cache) are yielded first without
+    touching the pool; fresh extractions are added to it. digests maps
+    resource_name(docs_dir, path) -> sha256 when the caller has already hashed
+    the files; stats.file_seconds uses the same keys."""
+    stats = stats if stats is not None else IngestStats()
+    cache = text_cache if cache is None else cache
+    digests = dict(digests or {})
+    misses: List[Path] = []
+    for p in paths:
+        name = resource_name(docs_dir, p)
+        try:
+            digest = digests.get(name) or file_sha256(p)
+        except OSError:
+            misses.append(p)  # let the extractor report the error
+            continue
+        digests[name] = digest
+        t0 = time.perf_counter()
+        cached = cache.get(digest, extractor_id(p))
+        if cached is None:
+            misses.append(p)
+            continue
+        text, secs = cached
+        stats.files += 1
+        stats.cache_hits += 1
+        stats.extract_seconds += time.perf_counter() - t0
+        stats.file_seconds[name] = secs
+        yield p, text
+    paths = misses
+    stats.cache_misses += len(paths)
+    workers = min(_resolve_workers(workers), max(len(paths), 1))
+    stats.extract_workers = workers
+
+    def record(p: Path, text: str, secs: float, err: Optional[str]) -> str:
+        name = resource_name(docs_dir, p)
+        stats.files += 1
+        stats.extract_seconds += secs
+        stats.file_seconds[name] = secs
+        if err is not None:
+            stats.failed += 1
+            logger.warning("Failed to extract %s: %s", name, err)
+        elif name in digests:
+            cache.put(digests[name], extractor_id(p), text, secs, str(p.resolve()))
+        return text
+
+    if workers <= 1:
+        for p in paths:
+            yield p, record(p, *_extract_file(str(p)))
+        return
+
+    results: "queue.Queue[Any]" = queue.Queue(maxsize=workers * 2)
+    stop = threading.Event()
+    finished = object()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.2)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            # spawn, not fork: the web worker that calls this is multi-threaded.
+            ctx = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+                todo = iter(paths)
+                inflight = {pool.submit(_extract_file, str(p)): p for p in itertools.islice(todo, workers * 2)}
+                while inflight and not stop.is_set():
+                    done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        p = inflight.pop(fut)
+                        if not put((p, fut.result())):
+                            return
+                        nxt = next(todo, None)
+                        if nxt is not None:
+                            inflight[pool.submit(_extract_file, str(nxt))] = nxt
+                for fut in inflight:
+                    fut.cancel()
+        except BaseException as e:
+            put(e)
+        finally:
+            put(finished)
+
+    producer = threading.Thread(target=produce, name="rag-extract", daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = results.get()
+            if item is finished:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            p, result = item
+            yield p, record(p, *result)
+    finally:
+        stop.set()
+        producer.join(timeout=5)
+
+
+def ingest_files(paths: List[Path], embedder, batch_size: Optional[int] = None,
+                 extract_workers: Optional[int] = None, embed_workers: Optional[int] = None,
+                 stats: Optional[IngestStats] = None, progress: Optional[ProgressFn] = None,
+                 digests: Optional[Dict[str, str]] = None,
+                 docs_dir: Optional[Path] = None) -> Iterator[Tuple[Path, List[str], np.ndarray]]:
+    """Extract -> chunk -> embed pipeline. Yields (path, chunks, vectors) for
+    each file as soon as all of its chunks are embedded, in completion order.
+
+    Chunks of consecutive files share embedding batches, and up to
+    embed_workers*2 batches are encoded concurrently while the next files are
+    still being extracted and chunked."""
+    stats = stats if stats is not None else IngestStats()
+    report = progress or (lambda stage, done, total: None)
+    batch_size = batch_size or EMBED_BATCH
+    embed_workers = max(1, embed_workers or EMBED_WORKERS)
+    stats.embed_batch, stats.embed_workers = batch_size, embed_workers
+    dim = embedder.get_sentence_embedding_dimension()
+    started = time.perf_counter()
+
+    # file seq -> [path, pieces, vectors, chunks still being embedded]
+    pending: Dict[int, List[Any]] = {}
+    batch: List[Tuple[int, int]] = []  # (file seq, piece index)
+    inflight: deque = deque()
+    embedded = chunked = 0
+
+    def encode(texts: List[str]) -> Tuple[np.ndarray, float]:
+        t0 = time.perf_counter()
+        vecs = embedder.encode(texts, batch_size=len(texts), convert_to_numpy=True, normalize_embeddings=True)
+        return np.asarray(vecs, dtype="float32"), time.perf_counter() - t0
+
+    def submit(pool):
+        nonlocal batch
+        owners, batch = batch, []
+        texts = [pending[seq][1][i] for seq, i in owners]
+        inflight.append((pool.submit(encode, texts), owners))
+
+    def collect() -> List[int]:
+        nonlocal embedded
+        fut, owners = inflight.popleft()
+        vecs, secs = fut.result()
+        stats.embed_seconds += secs
+        embedded += len(owners)
+        done = []
+        for (seq, i), v in zip(owners, vecs):
+            entry = pending[seq]
+            entry[2][i] = v
+            entry[3] -= 1
+            if entry[3] == 0:
+                done.append(seq)
+        return done
+
+    def finish(seqs: List[int]):
+        for seq in seqs:
+            path, pieces, vecs, _ = pending.pop(seq)
+            yield path, pieces, vecs
+
+    with ThreadPoolExecutor(max_workers=embed_workers, thread_name_prefix="rag-embed") as pool:
+        extracted = extract_files(paths, extract_workers, stats, digests=digests, docs_dir=docs_dir)
+        for seq, (path, text) in enumerate(extracted):
+            report("extract", stats.files, len(paths))
+            t0 = time.perf_counter()
+            pieces = chunk_text(text) if text else []
+            stats.chunk_seconds += time.perf_counter() - t0
+            stats.chunks += len(pieces)
+            chunked += len(pieces)
+            if not pieces:
+                yield path, [], np.zeros((0, dim), dtype="float32")
+                continue
+            pending[seq] = [path, pieces, np.empty((len(pieces), dim), dtype="float32"), len(pieces)]
+            for i in range(len(pieces)):
+                batch.append((seq, i))
+                if len(batch) >= batch_size:
+                    submit(pool)
+                    while len(inflight) >= embed_workers * 2:
+                        yield from finish(collect())
+        report("extract", len(paths), len(paths))
+        if batch:
+            submit(pool)
+        while inflight:
+            report("embed", embedded, chunked)
+            yield from finish(collect())
+    report("embed", embedded, chunked)
+    stats.wall_seconds += time.perf_counter() - started
+
+
+# ============================================================
+# Near-duplicate detection (MinHash / LSH)
+# ============================================================
+_SHINGLE_WORD_RE = re.compile(r"[^\W_]+")
+_hash_rng = np.random.default_rng(0x6D696E68)  # fixed: signatures are stored across builds
+_MINHASH_A = _hash_rng.integers(1, 2**63, MINHASH_PERM, dtype=np.uint64) | np.uint64(1)
+_MINHASH_B = _hash_rng.integers(0, 2**63, MINHASH_PERM, dtype=np.uint64)
+
+
+def minhash(text: str) -> np.ndarray:
+    """MINHASH_PERM-value signature of the text's word SHINGLE_WORDS-grams,
+    using multiply-shift hashes of each shingle's crc32."""
+    words = _SHINGLE_WORD_RE.findall(unicodedata.normalize("NFKC", text).casefold())
+    if len(words) <= SHINGLE_WORDS:
+        shingles = {" ".join(words)} if words else set()
+    else:
+        shingles = {" ".join(words[i: i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+    if not shingles:
+        return np.zeros(MINHASH_PERM, dtype="<u4")
+    h = np.fromiter((zlib.crc32(sh.encode("utf-8")) for sh in shingles), dtype=np.uint64, count=len(shingles))
+    with np.errstate(over="ignore"):
+        mixed = (h[:, None] * _MINHASH_A[None, :] + _MINHASH_B[None, :]) >> np.uint64(32)
+    return mixed.min(axis=0).astype("<u4")
+
+
+class NearDuplicateIndex:
+    """LSH over MinHash signatures. A signature is split into MINHASH_BANDS
+    bands; chunks sharing any band are candidates, confirmed when their
+    signatures agree on at least `threshold` of the positions."""
+
+    def __init__(self, threshold: float = NEAR_DUP_THRESHOLD):
+        self.threshold = threshold
+        self._buckets: Dict[int, int] = {}
+        self._sigs = np.zeros((1024, MINHASH_PERM), dtype="<u4")
+
+    @staticmethod
+    def _keys(sig: np.ndarray) -> List[int]:
+        r = MINHASH_PERM // MINHASH_BANDS
+        return [hash((b, sig[b * r: (b + 1) * r].tobytes())) for b in range(MINHASH_BANDS)]
+
+    def find(self, sig: np.ndarray) -> Optional[int]:
+        """Row of a stored near-duplicate of sig, or None."""
+        if not sig.any():
+            return None
+        for key in self._keys(sig):
+            row = self._buckets.get(key)
+            if row is not None and np.mean(self._sigs[row] == sig) >= self.threshold:
+                return row
+        return None
+
+    def add(self, row: int, sig: np.ndarray) -> None:
+        if not sig.any():
+            return
+        if row >= len(self._sigs):
+            grown = np.zeros((max(row + 1, 2 * len(self._sigs)), MINHASH_PERM), dtype="<u4")
+            grown[: len(self._sigs)] = self._sigs
+            self._sigs = grown
+        self._sigs[row] = sig
+        for key in self._keys(sig):
+            self._buckets.setdefault(key, row)
+
+
+_COPY_SUFFIX_RE = re.compile(r" \(\d+\)(?=\.[^.]+$)")
+
+
+def _canonical_rank(name: str) -> Tuple[bool, int, str]:
+    """Sort key choosing which of several identical files is ingested: prefer
+    names without a " (1)" download-copy suffix, then the shortest."""
+    return (bool(_COPY_SUFFIX_RE.search(name)), len(name), name)
+
+
+def dedupe_summary(files: Dict[str, Any]) -> Dict[str, Any]:
+    """What a build collapsed, from its manifest "files" section."""
+    return {
+        "files": [{"name": n, "duplicate_of": f["duplicate_of"]}
+                  for n, f in sorted(files.items()) if f.get("duplicate_of")],
+        "chunks_collapsed": sum(f.get("collapsed", 0) + f.get("collapsed_within", 0) for f in files.values()),
+        "collapsed": [{"source": n, "chunks": f["collapsed"], "into": f.get("collapsed_into", [])}
+                      for n, f in sorted(files.items()) if f.get("collapsed")],
+        # Chunks repeated inside one file (running headers, boilerplate) stored once.
+        "repeated": [{"source": n, "chunks": f["collapsed_within"]}
+                     for n, f in sorted(files.items()) if f.get("collapsed_within")],
+    }
+
+
+# ============================================================
+# Chunk metadata (step tags, source type, language)
+# ============================================================
+# Bit s of "steps" is set for material belonging to Step s; 0 marks general
+# material (papers, textbooks) that every step searches.
+CHUNK_META = np.dtype([("steps", "<u2"), ("kind", "u1"), ("lang", "u1")])
+SOURCE_KINDS = ("paper", "step_guide", "notes")
+LANGUAGES = ("und", "en", "es", "zh")
+_STEP_FILE_RE = re.compile(r"^step(\d)[_\-. ]", re.I)
+_EN_WORDS = frozenset("the and of to in is that for are with as this be on it by".split())
+_ES_WORDS = frozenset("el la los las de que y en es por para con una un del se".split())
+
+
+def source_metadata(name: str) -> Tuple[int, int]:
+    """(steps bitmask, SOURCE_KINDS index) for a resource file name."""
+    m = _STEP_FILE_RE.match(name.rsplit("/", 1)[-1])
+    if m:
+        return 1 << int(m.group(1)), SOURCE_KINDS.index("step_guide")
+    return 0, SOURCE_KINDS.index("paper" if name.lower().endswith(".pdf") else "notes")
+
+
+def detect_language(text: str) -> str:
+    """Rough en/es/zh guess from CJK share and stop-word counts."""
+    cjk = sum(len(run) for run in _CJK_RUN_RE.findall(text))
+    if cjk and cjk * 3 >= len(re.sub(r"\s+", "", text)):
+        return "zh"
+    words = re.findall(r"[^\W\d_]+", text.lower())
+    en = sum(w in _EN_WORDS for w in words)
+    es = sum(w in _ES_WORDS for w in words)
+    if not en and not es:
+        return "und"
+    return "es" if es > en else "en"
+
+
+def chunk_metadata(text: str, source: str) -> Tuple[int, int, int]:
+    steps, kind = source_metadata(source)
+    return steps, kind, LANGUAGES.index(detect_language(text))
+
+
+def _merge_steps(a: int, b: int) -> int:
+    """Steps of a chunk found in two files: general if either file is."""
+    return 0 if not a or not b else a | b
+
+
+# ============================================================
+# Chunk store (memory-mapped)
+# ============================================================
+CHUNK_ROW = np.dtype([("offset", "<u8"), ("length", "<u4"), ("source", "<u4")])
+
+
+class ChunkStore:
+    """Read-only, memory-mapped chunk texts. Indexing returns the same
+    {"id", "text", "source"} dicts the old chunks.json list held, decoding
+    only the chunk asked for."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._rows = np.load(path / CHUNKS_TABLE_NAME, mmap_mode="r")
+        self.sources: List[str] = json.loads((path / CHUNKS_SOURCES_NAME).read_text(encoding="utf-8"))
+        self._blob: Any = b""
+        if (path / CHUNKS_BLOB_NAME).stat().st_size:
+            with open(path / CHUNKS_BLOB_NAME, "rb") as f:
+                self._blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # Deduplicated content keeps every file it came from: whole files that
+        # are byte-identical to another (source_aliases) and single chunks
+        # that were near-duplicates of a stored one (row_aliases).
+        aliases: Dict[str, Any] = {}
+        if (path / CHUNKS_ALIASES_NAME).exists():
+            aliases = json.loads((path / CHUNKS_ALIASES_NAME).read_text(encoding="utf-8"))
+        self.source_aliases: Dict[str, List[str]] = aliases.get("sources", {})
+        self.row_aliases: Dict[int, List[str]] = {int(r): v for r, v in aliases.get("rows", {}).items()}
+        self._meta = np.load(path / CHUNKS_META_NAME, mmap_mode="r") if (path / CHUNKS_META_NAME).exists() else None
+        self._steps: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def text(self, i: int) -> str:
+        row = self._rows[i]
+        off = int(row["offset"])
+        return self._blob[off: off + int(row["length"])].decode("utf-8")
+
+    def source(self, i: int) -> str:
+        return self.sources[int(self._rows[i]["source"])]
+
+    def sources_of(self, i: int) -> List[str]:
+        """Every file chunk i appears in, its own source first."""
+        primary = self.source(i)
+        return [primary] + self.source_aliases.get(primary, []) + self.row_aliases.get(i, [])
+
+    def metadata(self) -> Optional[np.ndarray]:
+        """CHUNK_META rows, or None for stores written before metadata existed."""
+        return self._meta
+
+    def steps(self) -> np.ndarray:
+        """Steps bitmask per chunk; derived from the file names when the store
+        has no metadata column."""
+        if self._steps is None:
+            if self._meta is not None:
+                self._steps = np.asarray(self._meta["steps"])
+            else:
+                per_source = [source_metadata(n)[0] for n in self.sources]
+                for i, name in enumerate(self.sources):
+                    for dup in self.source_aliases.get(name, []):
+                        per_source[i] = _merge_steps(per_source[i], source_metadata(dup)[0])
+                steps = np.asarray(per_source, dtype="<u2")[np.asarray(self._rows["source"], dtype=np.int64)]
+                for row, names in self.row_aliases.items():
+                    for name in names:
+                        steps[row] = _merge_steps(int(steps[row]), source_metadata(name)[0])
+                self._steps = steps
+        return self._steps
+
+    def step_mask(self, step: int) -> np.ndarray:
+        """Chunks a Step `step` question searches: that step's material plus
+        general material."""
+        steps = self.steps()
+        return (steps == 0) | ((steps & (1 << step)) != 0)
+
+    def signatures(self) -> Optional[np.ndarray]:
+        if not (self.path / CHUNKS_MINHASH_NAME).exists():
+            return None
+        return np.load(self.path / CHUNKS_MINHASH_NAME, mmap_mode="r")
+
+    def __getitem__(self, i: int) -> Dict[str, Any]:
+        if not 0 <= i < len(self._rows):
+            raise IndexError(i)
+        out = {"id": i, "text": self.text(i), "source": self.source(i), "sources": self.sources_of(i)}
+        if self._meta is not None:
+            meta = self._meta[i]
+            out.update(steps=[s for s in range(1, 10) if int(meta["steps"]) >> s & 1],
+                       kind=SOURCE_KINDS[int(meta["kind"])], language=LANGUAGES[int(meta["lang"])])
+        return out
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def source_counts(self) -> Dict[str, int]:
+        """Chunks per source name, from the id column only (no text decoded).
+        Deduplicated chunks count towards every file they appear in."""
+        counts = np.bincount(np.asarray(self._rows["source"], dtype=np.int64), minlength=len(self.sources))
+        out = {name: int(n) for name, n in zip(self.sources, counts) if n}
+        for primary, dups in self.source_aliases.items():
+            for dup in dups:
+                out[dup] = out.get(dup, 0) + out.get(primary, 0)
+        for names in self.row_aliases.values():
+            for name in names:
+                out[name] = out.get(name, 0) + 1
+        return out
+
+
+_CHUNK_ROW_STRUCT = struct.Struct("<QII")  # byte layout of one CHUNK_ROW
+
+
+class ChunkStoreWriter:
+    """Appends chunks to a new store; files appear under their final names only
+    once close() has written everything. Texts and table rows go straight to
+    disk, so memory use does not grow with the number of chunks."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        path.mkdir(parents=True, exist_ok=True)
+        self._tmp = f".{os.getpid()}.tmp"
+        self._blob = open(path / (CHUNKS_BLOB_NAME + self._tmp), "wb")
+        self._rows = open(path / (CHUNKS_TABLE_NAME + self._tmp + ".raw"), "wb")
+        self._sigs = open(path / (CHUNKS_MINHASH_NAME + self._tmp + ".raw"), "wb")
+        self._count = 0
+        self._source_ids: Dict[str, int] = {}
+        self._source_names: List[str] = []
+        self._row_sources = array("I")
+        self._steps, self._kinds, self._langs = array("H"), array("B"), array("B")
+        self._source_aliases: Dict[str, List[str]] = {}
+        self._row_aliases: Dict[int, List[str]] = {}
+        self._offset = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def add(self, text: str, source: str, signature: Optional[np.ndarray] = None,
+            meta: Optional[Tuple[int, int, int]] = None) -> int:
+        data = text.encode("utf-8")
+        sid = self._source_ids.get(source)
+        if sid is None:
+            sid = self._source_ids[source] = len(self._source_names)
+            self._source_names.append(source)
+        self._blob.write(data)
+        self._rows.write(_CHUNK_ROW_STRUCT.pack(self._offset, len(data), sid))
+        if signature is None:
+            signature = minhash(text)
+        self._sigs.write(np.asarray(signature, dtype="<u4").tobytes())
+        steps, kind, lang = meta if meta is not None else chunk_metadata(text, source)
+        self._steps.append(steps)
+        self._kinds.append(kind)
+        self._langs.append(lang)
+        self._row_sources.append(sid)
+        self._offset += len(data)
+        self._count += 1
+        return self._count - 1
+
+    def source(self, row: int) -> str:
+        return self._source_names[self._row_sources[row]]
+
+    def alias_row(self, row: int, source: str) -> None:
+        """Record that chunk `row` also appears in `source`."""
+        names = self._row_aliases.setdefault(row, [])
+        if source not in names:
+            names.append(source)
+        self._steps[row] = _merge_steps(self._steps[row], source_metadata(source)[0])
+
+    def alias_source(self, source: str, duplicate: str) -> None:
+        """Record that file `duplicate` is byte-identical to `source`."""
+        self._source_aliases.setdefault(source, []).append(duplicate)
+        sid, steps = self._source_ids.get(source), source_metadata(duplicate)[0]
+        for row, row_sid in enumerate(self._row_sources):
+            if row_sid == sid:
+                self._steps[row] = _merge_steps(self._steps[row], steps)
+
+    def close(self) -> None:
+        self._blob.close()
+        self._rows.close()
+        self._sigs.close()
+        raw_sigs = self.path / (CHUNKS_MINHASH_NAME + self._tmp + ".raw")
+        sigs = np.lib.format.open_memmap(self.path / (CHUNKS_MINHASH_NAME + self._tmp), mode="w+",
+                                         dtype="<u4", shape=(self._count, MINHASH_PERM))
+        if self._count:
+            sigs[:] = np.memmap(raw_sigs, dtype="<u4", mode="r", shape=(self._count, MINHASH_PERM))
+        sigs.flush()
+        del sigs
+        raw_sigs.unlink()
+        aliases = {"sources": self._source_aliases,
+                   "rows": {str(r): v for r, v in sorted(self._row_aliases.items())}}
+        (self.path / (CHUNKS_ALIASES_NAME + self._tmp)).write_text(
+            json.dumps(aliases, ensure_ascii=False), encoding="utf-8")
+        meta = np.zeros(self._count, dtype=CHUNK_META)
+        meta["steps"], meta["kind"], meta["lang"] = self._steps, self._kinds, self._langs
+        with open(self.path / (CHUNKS_META_NAME + self._tmp), "wb") as f:
+            np.save(f, meta)
+        raw = self.path / (CHUNKS_TABLE_NAME + self._tmp + ".raw")
+        table = np.lib.format.open_memmap(self.path / (CHUNKS_TABLE_NAME + self._tmp), mode="w+",
+                                          dtype=CHUNK_ROW, shape=(self._count,))
+        if self._count:
+            table[:] = np.memmap(raw, dtype=CHUNK_ROW, mode="r", shape=(self._count,))
+        table.flush()
+        del table
+        raw.unlink()
+        (self.path / (CHUNKS_SOURCES_NAME + self._tmp)).write_text(
+            json.dumps(list(self._source_ids), ensure_ascii=False), encoding="utf-8")
+        # The table goes last: open_chunk_store() only trusts a directory
+        # whose table exists, and the table is only valid with its blob.
+        for name in (CHUNKS_BLOB_NAME, CHUNKS_SOURCES_NAME, CHUNKS_ALIASES_NAME, CHUNKS_MINHASH_NAME,
+                     CHUNKS_META_NAME, CHUNKS_TABLE_NAME):
+            os.replace(self.path / (name + self._tmp), self.path / name)
+
+
+def convert_chunks_json(path: Path) -> None:
+    """Write the binary chunk store for the chunks.json in `path`."""
+    chunks = json.loads((path / META_NAME).read_text(encoding="utf-8"))
+    writer = ChunkStoreWriter(path)
+    for c in chunks:
+        writer.add(c.get("text", ""), c.get("source", ""))
+    writer.close()
+    logger.info("Converted %s (%d chunks) to the binary chunk store", path / META_NAME, len(chunks))
+
+
+def has_chunks(path: Path) -> bool:
+    return (path / CHUNKS_TABLE_NAME).exists() or (path / META_NAME).exists()
+
+
+def open_chunk_store(path: Path) -> ChunkStore:
+    if not (path / CHUNKS_TABLE_NAME).exists():
+        convert_chunks_json(path)
+    return ChunkStore(path)
+
+
+# ============================================================
+# BM25 keyword index
+# ============================================================
+# Bump when tokenize() changes; stored indexes with another version are rebuilt.
+TOKENIZER_VERSION = 1
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_CJK_RUN_RE = re.compile(rf"[{_CJK_CHARS}]+")
+_TOKEN_RE = re.compile(rf"[{_CJK_CHARS}]+|[^\W_]+")
+_STOPWORDS = frozenset("""
+a an and are as at be but by can do does for from has have how i in is it its my of on or
+so that the their them there these they this to was we what when where which who why will
+with would you your
+el la los las un una unos unas y o de del al en con por para que es son se su sus lo como
+mi mis tu más pero este esta estos estas
+""".split())
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased, accent-folded word tokens for English/Spanish; overlapping
+    character bigrams for Chinese (which has no spaces between words)."""
+    text = unicodedata.normalize("NFKD", (text or "").lower())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    tokens: List[str] = []
+    for run in _TOKEN_RE.findall(text):
+        if _CJK_RUN_RE.fullmatch(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i: i + 2] for i in range(len(run) - 1))
+        elif len(run) > 1 and run not in _STOPWORDS:
+            tokens.append(run)
+    return tokens
+
+
+class BM25Index:
+    """Inverted index in CSR form. Each posting stores its precomputed BM25
+    term weight, so a query is a handful of array slices plus one bincount."""
+
+    def __init__(self, vocab: List[str], indptr: np.ndarray, doc_ids: np.ndarray, weights: np.ndarray,
+                 num_docs: int):
+        self.vocab = {term: i for i, term in enumerate(vocab)}
+        self._terms = vocab
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.num_docs = num_docs
+
+    @classmethod
+    def build(cls, texts, k1: float = BM25_K1, b: float = BM25_B) -> "BM25Index":
+        # Postings are collected as flat (term, doc, tf) int32 arrays, 12 bytes
+        # each, and turned into CSR with one stable sort at the end.
+        term_ids: Dict[str, int] = {}
+        p_term, p_doc, p_tf, doc_lens = array("i"), array("i"), array("i"), array("i")
+        for doc_id, text in enumerate(texts):
+            tf: Dict[str, int] = {}
+            tokens = tokenize(text)
+            for tok in tokens:
+                tf[tok] = tf.get(tok, 0) + 1
+            for tok, n in tf.items():
+                p_term.append(term_ids.setdefault(tok, len(term_ids)))
+                p_doc.append(doc_id)
+                p_tf.append(n)
+            doc_lens.append(len(tokens))
+        num_docs = len(doc_lens)
+        lens = np.frombuffer(doc_lens, dtype="int32").astype("float32") if num_docs else np.zeros(0, "float32")
+        avgdl = float(lens.mean()) if num_docs and lens.mean() > 0 else 1.0
+        vocab = sorted(term_ids)
+        rank = np.empty(len(vocab), dtype="int32")  # insertion id -> position in vocab
+        rank[np.fromiter((term_ids[t] for t in vocab), dtype="int32", count=len(vocab))] = \
+            np.arange(len(vocab), dtype="int32")
+        del term_ids
+        terms = rank[np.frombuffer(p_term, dtype="int32")] if len(p_term) else np.zeros(0, "int32")
+        del p_term
+        order = np.argsort(terms, kind="stable")  # stable: doc ids stay ascending per term
+        doc_ids = np.frombuffer(p_doc, dtype="int32")[order] if len(p_doc) else np.zeros(0, "int32")
+        tfs = np.frombuffer(p_tf, dtype="int32")[order].astype("float32") if len(p_tf) else np.zeros(0, "float32")
+        del p_doc, p_tf
+        df = np.bincount(terms, minlength=len(vocab))
+        term_of = terms[order]
+        del terms, order
+        indptr = np.zeros(len(vocab) + 1, dtype="int64")
+        np.cumsum(df, out=indptr[1:])
+        idf = np.log(1.0 + (num_docs - df + 0.5) / (df + 0.5)).astype("float32")
+        norm = k1 * (1.0 - b + b * lens[doc_ids] / avgdl)
+        weights = (idf[term_of] * tfs * (k1 + 1.0) / (tfs + norm)).astype("float32")
+        return cls(vocab, indptr, doc_ids, weights, num_docs)
+
+    def save(self, path: Path) -> None:
+        np.savez(path / BM25_NAME, indptr=self.indptr, doc_ids=self.doc_ids, weights=self.weights,
+                 num_docs=np.int64(self.num_docs), tokenizer_version=np.int64(TOKENIZER_VERSION))
+        (path / BM25_VOCAB_NAME).write_text(json.dumps(self._terms, ensure_ascii=False), encoding="utf-8")
+
+    @classmethod
+    def load(cls, path: Path) -> Optional["BM25Index"]:
+        """The stored index, or None if missing or built by another tokenizer."""
+        if not (path / BM25_NAME).exists() or not (path / BM25_VOCAB_NAME).exists():
+            return None
+        with np.load(path / BM25_NAME) as z:
+            if int(z["tokenizer_version"]) != TOKENIZER_VERSION:
+                return None
+            vocab = json.loads((path / BM25_VOCAB_NAME).read_text(encoding="utf-8"))
+            return cls(vocab, z["indptr"], z["doc_ids"], z["weights"], int(z["num_docs"]))
+
+    def search(self, query: str, k: int = 5, allowed: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """Top-k (doc_id, score) for the query, best first. allowed is an
+        optional boolean mask of the documents that may be returned."""
+        term_ids = {self.vocab[t] for t in tokenize(query) if t in self.vocab}
+        if not term_ids or not self.num_docs:
+            return []
+        spans = [(self.indptr[t], self.indptr[t + 1]) for t in term_ids]
+        ids = np.concatenate([self.doc_ids[a:b] for a, b in spans])
+        w = np.concatenate([self.weights[a:b] for a, b in spans])
+        scores = np.bincount(ids, weights=w, minlength=self.num_docs)
+        if allowed is not None:
+            scores[~allowed] = 0.0
+        k = min(k, int(np.count_nonzero(scores)))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(i), float(scores[i])) for i in top]
+
+
+def open_bm25(path: Path, chunks: ChunkStore) -> BM25Index:
+    """The snapshot's BM25 index, (re)built from its chunks if missing or stale."""
+    bm25 = BM25Index.load(path)
+    if bm25 is None or bm25.num_docs != len(chunks):
+        bm25 = BM25Index.build(chunks.text(i) for i in range(len(chunks)))
+        try:
+            bm25.save(path)
+        except OSError as e:
+            logger.warning("Could not persist BM25 index to %s: %s", path, e)
+    return bm25
+
+
+# ============================================================
+# Vector index types
+# ============================================================
+INDEX_TYPES = ("flat", "hnsw", "ivf")
+# "auto" picks flat below AUTO_HNSW_MIN chunks (exact search is only a few ms
+# there), HNSW up to AUTO_IVF_MIN and IVF-flat beyond, where HNSW's graph
+# memory and build time start to dominate.
+AUTO_HNSW_MIN = 10_000
+AUTO_IVF_MIN = 250_000
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+IVF_TRAIN_MAX = 100_000
+# Vectors are added to indexes (and scanned by exact_search) in blocks of this
+# many rows, straight from the memory-mapped vectors.f32.
+ADD_BLOCK = 16_384
+# Vector compression: fp16 scalar quantization halves the index; PQ stores
+# PQ_M one-byte codes per vector (16x smaller at dim 384). Compressed indexes
+# fetch RERANK x k candidates and re-score them against the exact vectors in
+# vectors.f32, which are memory-mapped and only paged in for those rows.
+COMPRESSIONS = ("none", "fp16", "pq")
+PQ_M = 96
+PQ_MIN_NBITS = 4
+RERANK = 4
+# Recall@RECALL_K of an approximate index against exact search, measured on
+# RECALL_SAMPLE stored vectors used as queries. Below MIN_RECALL the build
+# publishes a flat index instead.
+RECALL_K = 5
+RECALL_SAMPLE = 200
+MIN_RECALL = 0.9
+
+
+def resolve_index_type(index_type: str, n: int) -> str:
+    index_type = (index_type or "auto").strip().lower()
+    if index_type in INDEX_TYPES:
+        return index_type
+    if index_type != "auto":
+        logger.warning("Unknown index type %r; using auto", index_type)
+    if n < AUTO_HNSW_MIN:
+        return "flat"
+    return "hnsw" if n < AUTO_IVF_MIN else "ivf"
+
+
+def default_index_params(index_type: str, n: int, compression: str = "none",
+                         dim: int = 0) -> Dict[str, int]:
+    params: Dict[str, int] = {}
+    if index_type == "hnsw":
+        params = {"M": HNSW_M, "efConstruction": HNSW_EF_CONSTRUCTION, "efSearch": HNSW_EF_SEARCH}
+    elif index_type == "ivf":
+        # ~4*sqrt(n) lists, but never fewer than ~39 training points per list.
+        nlist = max(1, min(int(4 * np.sqrt(max(n, 1))), n // 39 or 1))
+        params = {"nlist": nlist, "nprobe": min(nlist, max(8, nlist // 16))}
+    if compression == "pq":
+        # Largest sub-quantizer count <= PQ_M that divides dim; 2^nbits
+        # centroids each, again with ~39 training points per centroid.
+        params["pq_m"] = max(m for m in range(1, PQ_M + 1) if dim % m == 0) if dim else PQ_M
+        params["pq_nbits"] = int(min(8, np.log2(max(n, 1) / 39))) if n >= 39 else 0
+    if compression != "none":
+        params["rerank"] = RERANK
+    return params
+
+
+def apply_search_params(index, info: Dict[str, Any]) -> None:
+    """Set the query-time knobs recorded in the manifest on a loaded index."""
+    params = info.get("params") or {}
+    kind = info.get("type", "flat")
+    if kind == "hnsw" and "efSearch" in params:
+        index.hnsw.efSearch = int(params["efSearch"])
+    elif kind == "ivf" and "nprobe" in params:
+        faiss.extract_index_ivf(index).nprobe = int(params["nprobe"])
+
+
+def _make_index(vecs: np.ndarray, index_type: str, params: Dict[str, int], compression: str = "none"):
+    dim = vecs.shape[1]
+    metric = faiss.METRIC_INNER_PRODUCT
+    fp16 = faiss.ScalarQuantizer.QT_fp16
+    if index_type == "hnsw":
+        if compression == "fp16":
+            index = faiss.IndexHNSWSQ(dim, fp16, int(params["M"]), metric)
+        elif compression == "pq":
+            index = faiss.IndexHNSWPQ(dim, int(params["pq_m"]), int(params["M"]), int(params["pq_nbits"]), metric)
+        else:
+            index = faiss.IndexHNSWFlat(dim, int(params["M"]), metric)
+        index.hnsw.efConstruction = int(params["efConstruction"])
+    elif index_type == "ivf":
+        quantizer = faiss.IndexFlatIP(dim)
+        nlist = int(params["nlist"])
+        if compression == "fp16":
+            index = faiss.IndexIVFScalarQuantizer(quantizer, dim, nlist, fp16, metric)
+        elif compression == "pq":
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, int(params["pq_m"]), int(params["pq_nbits"]), metric)
+        else:
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, metric)
+    elif compression == "fp16":
+        index = faiss.IndexScalarQuantizer(dim, fp16, metric)
+    elif compression == "pq":
+        index = faiss.IndexPQ(dim, int(params["pq_m"]), int(params["pq_nbits"]), metric)
+    else:
+        index = faiss.IndexFlatIP(dim)
+    if not index.is_trained:
+        sample = vecs
+        if len(vecs) > IVF_TRAIN_MAX:
+            rng = np.random.default_rng(0)
+            sample = vecs[np.sort(rng.choice(len(vecs), IVF_TRAIN_MAX, replace=False))]
+        index.train(np.ascontiguousarray(sample, dtype="float32"))
+    for at in range(0, len(vecs), ADD_BLOCK):
+        index.add(np.ascontiguousarray(vecs[at: at + ADD_BLOCK], dtype="float32"))
+    return index
+
+
+def supports_selector(index) -> bool:
+    """Whether index.search() takes SearchParameters with an id selector.
+    IndexPQ (flat + pq) rejects any params; see masked_search."""
+    return not isinstance(index, faiss.IndexPQ)
+
+
+def search_parameters(index, selector) -> Any:
+    """SearchParameters restricting index to the ids in selector. Parameters
+    passed to search() replace the index's own efSearch / nprobe, so those
+    are copied over."""
+    if isinstance(index, faiss.IndexHNSW):
+        params = faiss.SearchParametersHNSW()
+        params.efSearch = index.hnsw.efSearch
+    elif isinstance(index, faiss.IndexIVF):
+        params = faiss.SearchParametersIVF()
+        params.nprobe = index.nprobe
+    else:
+        params = faiss.SearchParameters()
+    params.sel = selector
+    return params
+
+
+def search_index(index, queries: np.ndarray, k: int, vectors: Optional[np.ndarray] = None,
+                 rerank: int = 0, params: Any = None) -> Tuple[np.ndarray, np.ndarray]:
+    """index.search(), optionally fetching rerank*k candidates and re-scoring
+    them against the exact vectors. params (see search_parameters) restricts
+    the ids searched. Returns (scores, ids) like faiss, with id -1 for empty
+    slots."""
+    if not rerank or vectors is None or not len(vectors):
+        return index.search(queries, k, params=params)
+    _, cand_ids = index.search(queries, k * rerank, params=params)
+    scores = np.full((len(queries), k), -np.inf, dtype="float32")
+    ids = np.full((len(queries), k), -1, dtype="int64")
+    for qi, cand in enumerate(cand_ids):
+        cand = np.sort(cand[cand >= 0])  # sorted rows keep the memmap reads sequential
+        if not len(cand):
+            continue
+        exact = np.asarray(vectors[cand], dtype="float32") @ queries[qi]
+        top = np.argsort(-exact)[:k]
+        ids[qi, :len(top)] = cand[top]
+        scores[qi, :len(top)] = exact[top]
+    return scores, ids
+
+
+def exact_search(vecs: np.ndarray, queries: np.ndarray, k: int,
+                 rows: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Brute-force inner-product top-k over vecs (only the given rows, if
+    any), ADD_BLOCK rows at a time so a memory-mapped vecs is never loaded
+    whole. Returns (scores, ids)."""
+    n = len(vecs) if rows is None else len(rows)
+    k = min(k, n)
+    best_s = np.full((len(queries), 0), -np.inf, dtype="float32")
+    best_i = np.zeros((len(queries), 0), dtype="int64")
+    for at in range(0, n, ADD_BLOCK):
+        if rows is None:
+            block_ids = np.arange(at, min(at + ADD_BLOCK, n), dtype="int64")
+            block = np.asarray(vecs[at: at + ADD_BLOCK], dtype="float32")
+        else:
+            block_ids = np.asarray(rows[at: at + ADD_BLOCK], dtype="int64")
+            block = np.asarray(vecs[block_ids], dtype="float32")
+        scores = queries @ block.T
+        ids = np.broadcast_to(block_ids, scores.shape)
+        cand_s = np.hstack([best_s, scores])
+        cand_i = np.hstack([best_i, ids])
+        top = np.argsort(-cand_s, axis=1, kind="stable")[:, :k]
+        best_s = np.take_along_axis(cand_s, top, axis=1)
+        best_i = np.take_along_axis(cand_i, top, axis=1)
+    return best_s, best_i
+
+
+def masked_search(index, queries: np.ndarray, k: int, mask: np.ndarray,
+                  vectors: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Top-k over the rows in mask for an index without selector support:
+    exact scores over those rows when the vectors are stored, otherwise an
+    over-fetch from the index with the other rows dropped. Same shapes and
+    -1 padding as index.search()."""
+    rows = np.flatnonzero(mask)
+    scores = np.full((len(queries), k), -np.inf, dtype="float32")
+    ids = np.full((len(queries), k), -1, dtype="int64")
+    if not len(rows):
+        return scores, ids
+    if vectors is not None and len(vectors):
+        s, i = exact_search(vectors, queries, k, rows=rows)
+        scores[:, :s.shape[1]], ids[:, :i.shape[1]] = s, i
+        return scores, ids
+    # Enough candidates that ~2k of them fall inside the mask on average.
+    fetch = min(index.ntotal, 2 * k * -(-len(mask) // len(rows)))
+    cand_s, cand_i = index.search(queries, fetch)
+    for qi in range(len(queries)):
+        keep = [j for j, row in enumerate(cand_i[qi]) if row >= 0 and mask[row]][:k]
+        ids[qi, :len(keep)] = cand_i[qi, keep]
+        scores[qi, :len(keep)] = cand_s[qi, keep]
+    return scores, ids
+
+
+def measure_recall(index, vecs: np.ndarray, k: int = RECALL_K, sample: int = RECALL_SAMPLE,
+                   rerank: int = 0) -> float:
+    """Mean recall@k of index (with optional re-ranking) against exact
+    inner-product search over vecs."""
+    if not len(vecs):
+        return 1.0
+    k = min(k, len(vecs))
+    rng = np.random.default_rng(0)
+    queries = np.asarray(vecs[np.sort(rng.choice(len(vecs), min(sample, len(vecs)), replace=False))],
+                         dtype="float32")
+    _, truth = exact_search(vecs, queries, k)
+    _, found = search_index(index, queries, k, vecs, rerank)
+    hits = sum(len(set(t) & set(f)) for t, f in zip(truth.tolist(), found.tolist()))
+    return hits / float(truth.size)
+
+
+def build_vector_index(vecs: np.ndarray, index_type: str = "auto",
+                       params: Optional[Dict[str, int]] = None, compression: str = "none",
+                       min_recall: float = MIN_RECALL) -> Tuple[Any, Dict[str, Any]]:
+    """Build the FAISS index for vecs. Returns (index, info) where info is the
+    manifest's "index" section: type, compression, params, requested type and
+    measured recall."""
+    requested = (index_type or "auto").strip().lower()
+    kind = resolve_index_type(requested, len(vecs))
+    if kind == "ivf" and len(vecs) < 2:
+        kind = "flat"
+    compression = (compression or "none").strip().lower()
+    if compression not in COMPRESSIONS:
+        logger.warning("Unknown compression %r; storing full vectors", compression)
+        compression = "none"
+    dim = vecs.shape[1]
+    merged = default_index_params(kind, len(vecs), compression, dim)
+    if compression == "pq" and merged["pq_nbits"] < PQ_MIN_NBITS:
+        logger.info("Too few vectors (%d) to train PQ codebooks; using fp16 instead", len(vecs))
+        compression = "fp16"
+        merged = default_index_params(kind, len(vecs), compression, dim)
+    merged.update({k: v for k, v in (params or {}).items() if k in merged})
+    if kind == "ivf":
+        merged["nlist"] = max(1, min(int(merged["nlist"]), len(vecs)))
+        merged["nprobe"] = max(1, min(int(merged["nprobe"]), merged["nlist"]))
+    info: Dict[str, Any] = {"type": kind, "compression": compression, "requested": requested,
+                            "params": merged}
+    index = _make_index(vecs, kind, merged, compression)
+    if kind == "flat" and compression == "none":
+        return index, info
+    apply_search_params(index, info)
+    recall = measure_recall(index, vecs, rerank=int(merged.get("rerank", 0)))
+    info[f"recall_at_{RECALL_K}"] = round(recall, 4)
+    info["recall_loss"] = round(1.0 - recall, 4)
+    if recall < min_recall:
+        logger.warning("%s/%s index recall@%d %.3f is below %.2f; publishing a flat index instead",
+                       kind, compression, RECALL_K, recall, min_recall)
+        return _make_index(vecs, "flat", {}), {"type": "flat", "compression": "none", "requested": requested,
+                                               "params": {}, "rejected": info}
+    logger.info("%s/%s index %s: recall@%d %.3f vs exact search", kind, compression, merged, RECALL_K, recall)
+    return index, info
+
+
+# ============================================================
+# Manifest
+# ============================================================
+def build_params(model_name: str, embed_backend: Optional[str] = None) -> Dict[str, Any]:
+    """Everything besides file contents that decides what a chunk/vector is.
+    If any of it differs from the stored manifest, nothing can be reused.
+    The backend counts too: torch and int8 ONNX vectors of the same model
+    differ slightly and must not be mixed in one index."""
+    return {
+        "embed_model": model_name,
+        "embed_backend": embed_backend,
+        "extractor_version": EXTRACTOR_VERSION,
+        "chunker_version": CHUNKER_VERSION,
+        "chunk_tokens": CHUNK_TOKENS,
+        "chunk_overlap_tokens": CHUNK_OVERLAP_TOKENS,
+    }
+
+
+def load_manifest(index_dir: Path) -> Optional[Dict[str, Any]]:
+    path = index_dir / MANIFEST_NAME
+    if not path.exists():
+        return None
+    try:
+        manifest = json.loads(path.read_text(encoding="utf-8"))
+    except Exception as e:
+        logger.warning("Ignoring unreadable index manifest %s: %s", path, e)
+        return None
+    if manifest.get("format") != MANIFEST_FORMAT:
+        return None
+    return manifest
+
+
+class VectorWriter:
+    """Appends float32 rows to vectors.f32 as they are produced, so a build
+    never holds the whole matrix in memory."""
+
+    def __init__(self, snap_dir: Path, dim: int):
+        self.path = snap_dir / VECTORS_NAME
+        self.dim = dim
+        self.count = 0
+        self._tmp = self.path.with_name(f".{VECTORS_NAME}.{os.getpid()}.tmp")
+        self._f = open(self._tmp, "wb")
+
+    def add(self, vecs: np.ndarray) -> None:
+        if len(vecs):
+            np.ascontiguousarray(vecs, dtype="float32").reshape(-1, self.dim).tofile(self._f)
+            self.count += len(vecs)
+
+    def close(self) -> np.ndarray:
+        self._f.close()
+        os.replace(self._tmp, self.path)
+        return load_vectors(self.path.parent, self.dim)
+
+
+def load_vectors(snap_dir: Path, dim: Optional[int]) -> Optional[np.ndarray]:
+    """Memory-map the exact vectors of a snapshot, or None if it has none."""
+    path = snap_dir / VECTORS_NAME
+    if not dim or not path.exists():
+        return None
+    if path.stat().st_size == 0:
+        return np.zeros((0, int(dim)), dtype="float32")
+    return np.memmap(path, dtype="float32", mode="r").reshape(-1, int(dim))
+
+
+def _load_previous(snap_dir: Path, params: Dict[str, Any]):
+    """Load the previous build if it can be reused for an incremental rebuild.
+    Returns (manifest, chunk_store, vectors) or (None, [], None)."""
+    manifest = load_manifest(snap_dir)
+    if manifest is None or faiss is None:
+        return None, [], None
+    if manifest.get("params") != params:
+        logger.info("Index build parameters changed; doing a full rebuild.")
+        return None, [], None
+    index_path = snap_dir / INDEX_NAME
+    if not index_path.exists() or not has_chunks(snap_dir):
+        return None, [], None
+    try:
+        chunks = open_chunk_store(snap_dir)
+        vectors = load_vectors(snap_dir, manifest.get("dim"))
+        if vectors is None:
+            # Snapshots from before vectors.f32 only ever held flat indexes.
+            index = faiss.read_index(str(index_path))
+            vectors = index.reconstruct_n(0, index.ntotal) if index.ntotal else None
+        n = 0 if vectors is None else len(vectors)
+        if n != len(chunks):
+            raise ValueError(f"index has {n} vectors but {len(chunks)} chunks")
+    except Exception as e:
+        logger.warning("Previous index unusable for incremental rebuild: %s", e)
+        return None, [], None
+    return manifest, chunks, vectors
+
+
+# ============================================================
+# Passage selection (MMR + adjacent-chunk merging)
+# ============================================================
+def mmr_order(query: np.ndarray, candidates: np.ndarray, lam: float = MMR_LAMBDA) -> List[int]:
+    """Candidate positions in maximal-marginal-relevance order: each pick
+    maximizes lam * similarity to the query - (1 - lam) * its highest
+    similarity to the candidates already picked. lam=1 keeps the ranking."""
+    cands = np.asarray(candidates, dtype="float32")
+    rel = cands @ np.asarray(query, dtype="float32").reshape(-1)
+    sim = cands @ cands.T
+    redundancy = np.zeros(len(cands), dtype="float32")
+    left = np.ones(len(cands), dtype=bool)
+    order: List[int] = []
+    for _ in range(len(cands)):
+        score = np.where(left, lam * rel - (1.0 - lam) * redundancy, -np.inf)
+        pick = int(np.argmax(score))
+        order.append(pick)
+        left[pick] = False
+        redundancy = np.maximum(redundancy, sim[pick])
+    return order
+
+
+def join_overlapping(a: str, b: str) -> str:
+    """a followed by b, without the text b repeats from the end of a (the
+    chunker's overlap sentences)."""
+    probe = b.split(None, 1)[0] if b.strip() else ""
+    at = a.find(probe) if probe else -1
+    while at != -1:
+        if (at == 0 or a[at - 1].isspace()) and b.startswith(a[at:]):
+            return a + b[len(a) - at:]
+        at = a.find(probe, at + 1)
+    return f"{a} {b}"
+
+
+def merge_adjacent(chunks, rows: Dict[int, float]) -> List[Dict[str, Any]]:
+    """Passages for the chosen chunk rows ({row: score}, in pick order):
+    consecutive rows of the same file become one passage, placed where its
+    first row was picked and scored by its best row."""
+    runs: List[List[int]] = []
+    for row in sorted(rows):
+        if runs and runs[-1][-1] == row - 1 and chunks.source(row) == chunks.source(row - 1):
+            runs[-1].append(row)
+        else:
+            runs.append([row])
+    first_pick = {row: n for n, row in enumerate(rows)}
+    out: List[Dict[str, Any]] = []
+    for run in sorted(runs, key=lambda r: min(first_pick[row] for row in r)):
+        start = run[0]
+        text = chunks.text(run[0])
+        sources = list(chunks.sources_of(run[0]))
+        for row in run[1:]:
+            text = join_overlapping(text, chunks.text(row))
+            sources += [s for s in chunks.sources_of(row) if s not in sources]
+        out.append({"text": text, "source": chunks.source(start), "sources": sources,
+                    "score": max(rows[r] for r in run), "rows": run})
+    return out
+
+
+def select_passages(chunks, ids, scores, k: int, passage_tokens: int,
+                    order: Optional[List[int]] = None) -> List[Dict[str, Any]]:
+    """Up to k passages from the candidate rows (ids/scores, visited in order)
+    filling the prompt budget of k * passage_tokens tokens. A candidate is
+    skipped when it no longer fits; merging it with a neighbouring row only
+    costs the tokens it adds beyond the overlap."""
+    pairs = list(zip(ids, scores))
+    if order is not None:
+        pairs = [pairs[j] for j in order]
+    cands = [(int(i), float(s)) for i, s in pairs if 0 <= int(i) < len(chunks)]
+    budget = k * passage_tokens
+    picked: Dict[int, float] = {}
+    passages: List[Dict[str, Any]] = []
+    for row, score in cands:
+        if row in picked:
+            continue
+        trial = merge_adjacent(chunks, {**picked, row: score})
+        cost = sum(min(count_tokens(p["text"]), passage_tokens * len(p["rows"])) for p in trial)
+        if len(trial) > k or cost > budget:
+            continue
+        picked[row] = score
+        passages = trial
+    return passages
+
+
+# ============================================================
+# Snapshots
+# ============================================================
+@dataclass
+class Snapshot:
+    """One immutable, fully-built index version. Readers grab a reference to
+    the published Snapshot once and use it for the whole query, so they never
+    mix an index with the chunk list of another build."""
+    version: str
+    path: Path
+    index: Any
+    chunks: ChunkStore
+    manifest: Dict[str, Any] = field(default_factory=dict)
+    bm25: Optional[BM25Index] = None
+    vectors: Optional[np.ndarray] = None  # memory-mapped exact vectors (vectors.f32)
+    mmapped: bool = False  # index read with IO_FLAG_MMAP_IFC (see read_index)
+    # step -> (mask, bitmap, selector, search params); the bitmap must outlive
+    # the selector. Params are None for indexes without selector support.
+    _step_filters: Dict[int, Tuple[np.ndarray, np.ndarray, Any, Any]] = field(default_factory=dict, repr=False)
+
+    def step_mask(self, step: Optional[int]) -> Optional[np.ndarray]:
+        """Boolean mask of the chunks a Step `step` question searches, or None
+        for everything (no step, or the step filter would keep every chunk)."""
+        return self._step_filter(step)[0] if step else None
+
+    def _step_filter(self, step: int) -> Tuple[Optional[np.ndarray], Any, Any, Any]:
+        if step not in self._step_filters:
+            mask = self.chunks.step_mask(step)
+            if mask.all():
+                self._step_filters[step] = (None, None, None, None)
+            else:
+                bitmap = np.packbits(mask, bitorder="little")
+                selector = params = None
+                if self.index is not None and supports_selector(self.index):
+                    selector = faiss.IDSelectorBitmap(len(mask), faiss.swig_ptr(bitmap))
+                    params = search_parameters(self.index, selector)
+                self._step_filters[step] = (mask, bitmap, selector, params)
+        return self._step_filters[step]
+
+    def search(self, queries: np.ndarray, k: int, step: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k vector search; with step, only over that step's material and
+        general material."""
+        rerank = int(((self.manifest.get("index") or {}).get("params") or {}).get("rerank", 0))
+        mask, _, _, params = self._step_filter(step) if step else (None, None, None, None)
+        if mask is not None and params is None:
+            return masked_search(self.index, queries, k, mask, self.vectors)
+        return search_index(self.index, queries, k, self.vectors, rerank, params)
+
+    def index_bytes(self) -> int:
+        """Size of the serialized index, i.e. what each worker holds in RAM."""
+        try:
+            return (self.path / INDEX_NAME).stat().st_size
+        except OSError:
+            return 0
+
+
+def read_current_version(index_dir: Path) -> Optional[str]:
+    try:
+        return (index_dir / CURRENT_NAME).read_text(encoding="utf-8").strip() or None
+    except OSError:
+        return None
+
+
+def current_snapshot_dir(index_dir: Path) -> Path:
+    """Directory of the published snapshot (index_dir itself for the legacy layout)."""
+    version = read_current_version(index_dir)
+    if version:
+        snap_dir = index_dir / SNAPSHOTS_DIRNAME / version
+        if snap_dir.is_dir():
+            return snap_dir
+    return index_dir
+
+
+def read_index(path: Path, use_mmap: bool = INDEX_MMAP) -> Tuple[Any, bool]:
+    """faiss.read_index(), memory-mapped when possible. Returns (index, mmapped).
+    Snapshot files are never modified after publishing, so mapping them is
+    safe; HNSW graphs and coarse quantizers are still read into memory."""
+    flag = getattr(faiss, "IO_FLAG_MMAP_IFC", None)
+    if use_mmap and flag is not None:
+        try:
+            return faiss.read_index(str(path), flag), True
+        except RuntimeError as e:
+            logger.warning("Could not memory-map %s, reading it instead: %s", path, e)
+    return faiss.read_index(str(path)), False
+
+
+def load_snapshot(index_dir: Path) -> Optional[Snapshot]:
+    """Load the published snapshot, or None if nothing has been built yet.
+    Without FAISS the snapshot still loads (index=None) so keyword retrieval
+    over its chunks keeps working."""
+    snap_dir = current_snapshot_dir(index_dir)
+    index_path = snap_dir / INDEX_NAME
+    if not index_path.exists() or not has_chunks(snap_dir):
+        return None
+    index, mmapped = read_index(index_path) if faiss is not None else (None, False)
+    chunks = open_chunk_store(snap_dir)
+    manifest = load_manifest(snap_dir) or {}
+    if index is not None and manifest.get("index"):
+        apply_search_params(index, manifest["index"])
+    version = manifest.get("version") or ("legacy" if snap_dir == index_dir else snap_dir.name)
+    return Snapshot(version=version, path=snap_dir, index=index, chunks=chunks, manifest=manifest,
+                    bm25=open_bm25(snap_dir, chunks), vectors=load_vectors(snap_dir, manifest.get("dim")),
+                    mmapped=mmapped)
+
+
+def _new_version() -> str:
+    # Sorts chronologically: the zero-padded nanosecond suffix orders two builds
+    # started in the same second (_prune_snapshots relies on this).
+    ns = time.time_ns()
+    stamp = datetime.fromtimestamp(ns // 1_000_000_000, timezone.utc).strftime("%Y%m%dT%H%M%S")
+    return f"{stamp}-{ns % 1_000_000_000:09d}"
+
+
+def publish_snapshot(index_dir: Path, version: str) -> None:
+    """Point CURRENT at a fully-written snapshot (atomic rename)."""
+    tmp = index_dir / f".{CURRENT_NAME}.{os.getpid()}.tmp"
+    tmp.write_text(version, encoding="utf-8")
+    os.replace(tmp, index_dir / CURRENT_NAME)
+    _prune_snapshots(index_dir, keep=version)
+
+
+def _prune_snapshots(index_dir: Path, keep: str) -> None:
+    root = index_dir / SNAPSHOTS_DIRNAME
+    if not root.is_dir():
+        return
+    versions = sorted((p.name for p in root.iterdir() if p.is_dir()), reverse=True)
+    for name in versions[KEEP_SNAPSHOTS:]:
+        if name != keep:
+            shutil.rmtree(root / name, ignore_errors=True)
+
+
+class BuildLock:
+    """Cross-process lock on index_dir/BUILD_LOCK_NAME, so create_index.py and
+    the web workers never build into (and prune/publish in) the same index
+    dir at once. acquire() doesn't block. The OS drops the lock if its holder
+    dies, so it never goes stale."""
+
+    def __init__(self, index_dir: Path):
+        self.path = index_dir / BUILD_LOCK_NAME
+        self._file = None
+
+    def acquire(self) -> bool:
+        if self._file is not None:
+            return True
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        f = open(self.path, "a+b")
+        try:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            f.close()
+            return False
+        self._file = f
+        return True
+
+    def release(self) -> None:
+        f, self._file = self._file, None
+        if f is None:
+            return
+        try:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        except OSError:
+            pass
+        f.close()
+
+
+# ============================================================
+# Build
+# ============================================================
+def build_snapshot(docs_dir: Path, index_dir: Path, embedder, model_name: str = EMBED_MODEL_NAME,
+                   full: bool = False, progress: Optional[ProgressFn] = None, index_type: str = "auto",
+                   index_params: Optional[Dict[str, int]] = None,
+                   compression: str = "none", extract_workers: Optional[int] = None,
+                   embed_workers: Optional[int] = None,
+                   embed_batch: Optional[int] = None,
+                   dedupe: bool = DEDUPE) -> Tuple[Snapshot, Dict[str, Any]]:
+    """Build a new snapshot from the files in docs_dir and publish it.
+
+    Only added/changed files are extracted and embedded; unchanged files keep
+    their chunks and vectors from the currently published snapshot. full=True
+    ignores the previous build entirely. index_type is "auto" or one of
+    INDEX_TYPES; index_params overrides its defaults; compression is one of
+    COMPRESSIONS. extract_workers / embed_workers / embed_batch override
+    the ingestion pipeline defaults. dedupe=True ingests byte-identical files
+    once and stores near-duplicate chunks once (see NearDuplicateIndex), keeping
+    every file name they came from. Nothing that is currently published is
+    modified: the new build goes to its own directory and CURRENT is swapped
+    once it is complete. Returns (snapshot, stats)."""
+    if faiss is None:
+        raise RuntimeError("FAISS is not installed")
+    report = progress or (lambda stage, done, total: None)
+    index_dir.mkdir(parents=True, exist_ok=True)
+    params = build_params(model_name, embedders.describe(embedder))
+    prev_dir = current_snapshot_dir(index_dir)
+    prev_manifest, prev_chunks, prev_vecs = (None, [], None) if full else _load_previous(prev_dir, params)
+    prev_files = (prev_manifest or {}).get("files", {})
+
+    entries: List[Tuple[Path, str, int]] = []
+    for p in list_resource_files(docs_dir):
+        try:
+            entries.append((p, file_sha256(p), p.stat().st_size))
+        except OSError as e:
+            logger.warning("Skipping unreadable resource %s: %s", resource_name(docs_dir, p), e)
+    # Keyed by path relative to docs_dir: subfolders may reuse a file name.
+    rel = {p: resource_name(docs_dir, p) for p, _, _ in entries}
+    names = set(rel.values())
+    added = [rel[p] for p, _, _ in entries if rel[p] not in prev_files]
+    changed = [rel[p] for p, d, _ in entries if rel[p] in prev_files and prev_files[rel[p]].get("sha256") != d]
+    removed = sorted(name for name in prev_files if name not in names)
+
+    # Byte-identical files: only one copy per content hash is extracted and embedded.
+    canonical: Dict[str, str] = {}
+    for p, digest, _ in sorted(entries, key=lambda e: _canonical_rank(rel[e[0]])):
+        canonical.setdefault(digest, rel[p])
+    duplicates = {rel[p]: canonical[d] for p, d, _ in entries if dedupe and canonical[d] != rel[p]}
+
+    reuse = {rel[p] for p, d, _ in entries
+             if rel[p] not in duplicates and rel[p] in prev_files
+             and prev_files[rel[p]].get("sha256") == d and "duplicate_of" not in prev_files[rel[p]]}
+    # Chunks collapsed into another file's rows are lost when that file is
+    # re-ingested, so such files have to be re-ingested too.
+    while True:
+        dependent = {n for n in reuse if set(prev_files[n].get("collapsed_into", [])) - reuse}
+        if not dependent:
+            break
+        reuse -= dependent
+    fresh = [(p, d, size) for p, d, size in entries if rel[p] not in duplicates and rel[p] not in reuse]
+    unchanged = [n for n in names if n not in added and n not in changed]
+
+    dim = embedder.get_sentence_embedding_dimension()
+    version = _new_version()
+    snap_dir = index_dir / SNAPSHOTS_DIRNAME / version
+    try:
+        chunks = ChunkStoreWriter(snap_dir)
+        vectors = VectorWriter(snap_dir, dim)
+        near = NearDuplicateIndex() if dedupe else None
+        files_out: Dict[str, Any] = {}
+
+        prev_sigs = prev_chunks.signatures() if reuse else None
+        prev_meta = prev_chunks.metadata() if reuse else None
+        row_map: Dict[int, int] = {}
+        for p, digest, size in entries:
+            if rel[p] not in reuse:
+                continue
+            rows = prev_files[rel[p]].get("rows", [])
+            start = len(chunks)
+            for r in rows:
+                text = prev_chunks.text(r)
+                sig = np.asarray(prev_sigs[r]) if prev_sigs is not None else minhash(text)
+                # Step tags are re-derived: the aliases merged into them may be gone.
+                meta = (*source_metadata(rel[p]), int(prev_meta[r]["lang"])) if prev_meta is not None else None
+                row_map[r] = chunks.add(text, rel[p], sig, meta)
+                if near is not None:
+                    near.add(row_map[r], sig)
+            for at in range(0, len(rows), ADD_BLOCK):
+                vectors.add(prev_vecs[rows[at: at + ADD_BLOCK]])
+            files_out[rel[p]] = {"sha256": digest, "size": size, "rows": list(range(start, len(chunks)))}
+            for key in ("extract_seconds", "collapsed", "collapsed_into", "collapsed_within"):
+                if key in prev_files[rel[p]]:
+                    files_out[rel[p]][key] = prev_files[rel[p]][key]
+        if reuse:
+            for r, also in prev_chunks.row_aliases.items():
+                for name in also:
+                    if r in row_map and name in reuse:
+                        chunks.alias_row(row_map[r], name)
+
+        if fresh:
+            logger.info("Extracting and embedding %d added/changed files", len(fresh))
+        ingest = IngestStats()
+        meta = {rel[p]: (d, size) for p, d, size in fresh}
+        digests = {name: d for name, (d, _) in meta.items()}
+        for path, pieces, vecs in ingest_files([p for p, _, _ in fresh], embedder, embed_batch, extract_workers,
+                                               embed_workers, ingest, report, digests, docs_dir):
+            start = len(chunks)
+            keep: List[int] = []
+            collapsed, within, into = 0, 0, set()
+            for i, piece in enumerate(pieces):
+                sig = minhash(piece)
+                hit = near.find(sig) if near is not None else None
+                if hit is not None:
+                    owner = chunks.source(hit)
+                    if owner == rel[path]:
+                        within += 1
+                    else:
+                        collapsed += 1
+                        chunks.alias_row(hit, rel[path])
+                        into.add(owner)
+                    continue
+                row = chunks.add(piece, rel[path], sig)
+                keep.append(i)
+                if near is not None:
+                    near.add(row, sig)
+            vectors.add(vecs[keep])
+            digest, size = meta[rel[path]]
+            files_out[rel[path]] = {"sha256": digest, "size": size, "rows": list(range(start, len(chunks))),
+                                    "extract_seconds": round(ingest.file_seconds.get(rel[path], 0.0), 3)}
+            if collapsed:
+                files_out[rel[path]].update(collapsed=collapsed, collapsed_into=sorted(into))
+            if within:
+                files_out[rel[path]]["collapsed_within"] = within
+        for p, digest, size in entries:
+            if rel[p] in duplicates:
+                chunks.alias_source(duplicates[rel[p]], rel[p])
+                files_out[rel[p]] = {"sha256": digest, "size": size, "rows": [],
+                                     "duplicate_of": duplicates[rel[p]]}
+        chunks.close()
+        if fresh:
+            logger.info("Ingestion: %s", json.dumps(ingest.as_dict()))
+
+        report("write", 0, 1)
+        vecs = vectors.close()
+        index, index_info = build_vector_index(vecs, index_type, index_params, compression)
+
+        faiss.write_index(index, str(snap_dir / INDEX_NAME))
+        index_info["bytes"] = (snap_dir / INDEX_NAME).stat().st_size
+        index_info["exact_bytes"] = int(len(vecs) * dim * 4)
+        manifest = {
+            "format": MANIFEST_FORMAT,
+            "version": version,
+            "built_at": datetime.now(timezone.utc).isoformat().replace("+00:00", "Z"),
+            "params": params,
+            "dim": dim,
+            "index": index_info,
+            "bm25": {"k1": BM25_K1, "b": BM25_B, "tokenizer_version": TOKENIZER_VERSION},
+            "files": files_out,
+        }
+        (snap_dir / MANIFEST_NAME).write_text(json.dumps(manifest, indent=1), encoding="utf-8")
+        store = ChunkStore(snap_dir)
+        bm25 = BM25Index.build(store.text(i) for i in range(len(store)))
+        bm25.save(snap_dir)
+        publish_snapshot(index_dir, version)
+    except BaseException:
+        # Don't leave a half-written snapshot directory behind.
+        shutil.rmtree(snap_dir, ignore_errors=True)
+        raise
+    text_cache.prune(docs_dir, (f["sha256"] for f in files_out.values()))
+    report("write", 1, 1)
+
+    stats = {
+        "rag_available": True,
+        "version": version,
+        "sources": len(store.source_counts()),
+        "chunks": len(store),
+        "embedded_chunks": ingest.chunks,
+        "added": added,
+        "changed": changed,
+        "removed": removed,
+        "unchanged": len(unchanged),
+        "index": index_info,
+        "ingest": ingest.as_dict(),
+        "duplicates": dedupe_summary(files_out),
+    }
+    logger.info("Index %s published: %d chunks (%d embedded) — added %d, changed %d, removed %d, unchanged %d",
+                version, len(store), ingest.chunks, len(added), len(changed), len(removed), len(unchanged))
+    # Serve the published file, not the build's private copy, so the building
+    # process shares the index pages with every other worker too.
+    del index
+    index, mmapped = read_index(snap_dir / INDEX_NAME)
+    apply_search_params(index, index_info)
+    snapshot = Snapshot(version=version, path=snap_dir, index=index, chunks=store, manifest=manifest,
+                        bm25=bm25, vectors=vecs, mmapped=mmapped)
+    return snapshot, stats
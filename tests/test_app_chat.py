@@ -0,0 +1,96 @@
+import asyncio
+import threading
+
+import numpy as np
+import pytest
+
+app_chat = pytest.importorskip("app_chat")
+
+
+def test_cancelled_embed_does_not_stop_the_batcher(monkeypatch):
+    started, release = threading.Event(), threading.Event()
+
+    def encode(queries):
+        started.set()
+        release.wait(5)
+        return np.ones((len(queries), 4), dtype="float32")
+
+    batcher = app_chat._RetrievalBatcher(3, 32)
+    monkeypatch.setattr(app_chat, "_retrieval_batcher", batcher)
+    monkeypatch.setattr(app_chat, "_encode_queries", encode)
+    monkeypatch.setattr(app_chat, "RAG_AVAILABLE", True)
+    monkeypatch.setattr(app_chat, "RAG_BATCH_WINDOW_MS", 3.0)
+
+    async def scenario():
+        first = asyncio.create_task(app_chat._embed_query_async("first question"))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+        first.cancel()  # client disconnected mid-batch
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        release.set()
+        return await app_chat._embed_query_async("next question")
+
+    qv = asyncio.run(scenario())
+    assert qv is not None and qv.shape == (1, 4)
+    assert batcher._thread.is_alive()
+
+
+def test_query_embed_overlaps_retrieval(monkeypatch):
+    seen = []
+
+    async def embed(query):
+        await asyncio.sleep(0.3)
+        return "qvec"
+
+    async def gate(user_msg, *args, qvec=None, language=None):
+        seen.append(qvec)
+        return False if args else (True, "")
+
+    def payload(*args):
+        threading.Event().wait(0.3)
+        return {"messages": []}
+
+    monkeypatch.setattr(app_chat, "_embed_query_async", embed)
+    monkeypatch.setattr(app_chat, "_moderate_input", gate)
+    monkeypatch.setattr(app_chat, "_asks_ai_to_author", gate)
+    monkeypatch.setattr(app_chat, "_chat_payload", payload)
+    monkeypatch.setattr(app_chat, "_intent_model", object())
+    sess = app_chat.SessionData(id="s", created_at="")
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        t0 = loop.time()
+        result = await app_chat._pre_generation(sess, "hello", 4, [], "en", False)
+        return result, loop.time() - t0
+
+    (is_safe, authoring, out), wall = asyncio.run(scenario())
+    assert (is_safe, authoring, out) == (True, False, {"messages": []})
+    assert seen == ["qvec", "qvec"]
+    assert wall < 0.5  # slowest stage, not embed + retrieval
+
+
+def test_unsafe_spanish_message_reaches_llama_guard(monkeypatch):
+    sent = []
+
+    class _Reply:
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return {"message": {"content": "unsafe\nS2"}}
+
+    async def post(url, **kwargs):
+        sent.append(kwargs["json"]["messages"][0]["content"])
+        return _Reply()
+
+    prescreen = app_chat.moderation_prescreen.Prescreen([], np.eye(4, dtype="float32")[:1], ["S1"])
+    monkeypatch.setattr(app_chat, "_prescreen", prescreen)
+    monkeypatch.setattr(app_chat, "MODERATION_PRESCREEN", "on")
+    monkeypatch.setattr(app_chat.llm_clients.async_moderation, "post", post)
+    benign = np.array([[0, 1, 0, 0]], dtype="float32")
+
+    english = "how should I choose my research methodology"
+    assert asyncio.run(app_chat._moderate_input(english, benign)) == (True, "")
+    spanish = "Quiero que me expliques cómo entrar en la cuenta de correo de mi profesor"
+    assert asyncio.run(app_chat._moderate_input(spanish, benign))[0] is False
+    assert sent == [spanish]
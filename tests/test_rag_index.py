@@ -0,0 +1,114 @@
+import numpy as np
+import pytest
+
+import rag_index
+
+faiss = pytest.importorskip("faiss")
+
+N, DIM, K, STEP = 2000, 32, 10, 3
+
+
+def _snapshot(tmp_path, index_type, compression, with_vectors):
+    rng = np.random.default_rng(0)
+    vecs = rng.standard_normal((N, DIM)).astype("float32")
+    vecs /= np.linalg.norm(vecs, axis=1, keepdims=True)
+    writer = rag_index.ChunkStoreWriter(tmp_path)
+    for i in range(N):
+        # A third general material, the rest spread over steps 1-9.
+        source = "paper.pdf" if i % 3 == 0 else f"step{i % 9 + 1}_resource_database.txt"
+        writer.add(f"chunk {i}", source)
+    writer.close()
+    index, info = rag_index.build_vector_index(vecs, index_type, compression=compression, min_recall=0.0)
+    assert (info["type"], info["compression"]) == (index_type, compression)
+    return vecs, rag_index.Snapshot(version="test", path=tmp_path, index=index,
+                                    chunks=rag_index.open_chunk_store(tmp_path),
+                                    manifest={"index": info}, vectors=vecs if with_vectors else None)
+
+
+@pytest.mark.parametrize("with_vectors", [True, False], ids=["vectors", "no-vectors"])
+@pytest.mark.parametrize("compression", rag_index.COMPRESSIONS)
+@pytest.mark.parametrize("index_type", rag_index.INDEX_TYPES)
+def test_step_filtered_search(tmp_path, index_type, compression, with_vectors):
+    vecs, snap = _snapshot(tmp_path, index_type, compression, with_vectors)
+    mask = snap.step_mask(STEP)
+    assert mask is not None and 0 < mask.sum() < N
+    rows = np.flatnonzero(mask)[:20]
+    scores, ids = snap.search(vecs[rows], K, step=STEP)
+    assert ids.shape == scores.shape == (len(rows), K)
+    assert (ids >= 0).all()
+    assert mask[ids].all()
+    if index_type == "flat":
+        # Each query is a chunk inside the filter, so exact search finds it.
+        assert all(row in found for row, found in zip(rows, ids))
+
+
+def test_masked_search_empty_mask():
+    index = faiss.IndexFlatIP(4)
+    index.add(np.eye(4, dtype="float32"))
+    scores, ids = rag_index.masked_search(index, np.eye(4, dtype="float32")[:1], 3, np.zeros(4, bool))
+    assert (ids == -1).all() and np.isneginf(scores).all()
+
+
+def test_chunk_text_english():
+    text = "\n\n".join(" ".join(f"Sentence {p}.{i} has a few words." for i in range(40)) for p in range(3))
+    chunks = rag_index.chunk_text(text)
+    assert len(chunks) > 1
+    assert all(rag_index.count_tokens(c) <= rag_index.CHUNK_TOKENS for c in chunks)
+    assert all(c.endswith(".") for c in chunks)
+
+
+def test_chunk_text_chinese():
+    sentence = "研究设计需要明确的研究问题，并且要与你的世界观和研究范式保持一致。"
+    text = "".join(sentence for _ in range(6000 // len(sentence)))
+    assert rag_index.count_tokens(sentence) == len(sentence)  # one token per character and mark
+    chunks = rag_index.chunk_text(text)
+    assert len(chunks) > 1
+    for c in chunks:
+        assert rag_index.count_tokens(c) <= rag_index.CHUNK_TOKENS
+        assert len(c) <= rag_index.CHUNK_TOKENS
+        assert c.startswith("研究") and c.endswith("。")
+    assert rag_index.split_sentences("你好吗？“这是引用。”然后继续。") == ["你好吗？", "“这是引用。”", "然后继续。"]
+
+
+def test_text_cache_prune_only_touches_its_docs_dir(tmp_path):
+    cache = rag_index.TextCache(tmp_path / "cache")
+    a, b = tmp_path / "a", tmp_path / "b"
+    a.mkdir()
+    b.mkdir()
+    cache.put("aa" * 32, "x", "text of a", 0.1, str(a / "one.pdf"))
+    cache.put("bb" * 32, "x", "text of b", 0.1, str(b / "two.pdf"))
+    cache.put("cc" * 32, "x", "text of a, deleted", 0.1, str(a / "gone.pdf"))
+    cache.put("dd" * 32, "x", "text of a/sub, deleted", 0.1, str(a / "sub" / "x.pdf"))
+    assert cache.prune(b, []) == 1
+    assert cache.prune(a, ["aa" * 32]) == 2
+    assert cache.get("aa" * 32, "x") is not None
+    assert cache.get("bb" * 32, "x") is None
+    assert cache.get("cc" * 32, "x") is None
+    assert cache.get("dd" * 32, "x") is None
+
+
+def test_snapshot_versions_sort_in_creation_order():
+    versions = [rag_index._new_version() for _ in range(50)]
+    assert versions == sorted(versions)
+    assert len(set(versions)) == len(versions)
+
+
+def test_load_docs_keeps_same_named_files_in_subfolders_apart(tmp_path, monkeypatch):
+    monkeypatch.setattr(rag_index, "text_cache", rag_index.TextCache(tmp_path / "cache"))
+    docs = tmp_path / "docs"
+    for sub, text in (("a", "first notes"), ("b", "second notes")):
+        (docs / sub).mkdir(parents=True)
+        (docs / sub / "notes.md").write_text(text, encoding="utf-8")
+    (docs / "step2_guide.md").write_text("guide", encoding="utf-8")
+    loaded = {d["source"]: d["text"] for d in rag_index.load_docs(docs, workers=1)}
+    assert loaded == {"a/notes.md": "first notes", "b/notes.md": "second notes", "step2_guide.md": "guide"}
+    assert rag_index.source_metadata("b/step3_notes.md") == rag_index.source_metadata("step3_notes.md")
+
+
+def test_build_lock_is_exclusive_across_holders(tmp_path):
+    first, second = rag_index.BuildLock(tmp_path), rag_index.BuildLock(tmp_path)
+    assert first.acquire()
+    assert not second.acquire()
+    first.release()
+    assert second.acquire()
+    second.release()